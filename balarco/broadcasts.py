@@ -0,0 +1,262 @@
+"""Coalesced "table changed" messages for the websocket groups of the tables
+(clients-table, contacts-table, igualas-table, users-table).
+
+Every change is reported with table_changed(). Changes made inside a transaction are
+collected and queued on TABLE_CHANGES_CHANNEL once it commits, changes made in a savepoint
+that is rolled back are dropped with it. The store_table_changes consumer saves the queued
+changes as works.models.PendingTableChange rows and, when there weren't any pending yet,
+asks the delay server (manage.py rundelay) to send a message to TABLE_CHANGES_FLUSH_CHANNEL
+after settings.TABLE_CHANGE_BROADCAST_WINDOW seconds. The send_table_changes consumer of
+that message takes every pending change and sends them, so each group receives a single
+message with every affected row instead of one message per save, and neither the requests
+nor the workers wait for the window to end.
+
+Each message lists the changed rows with their operation and their current representation,
+so the clients can update their data without requesting it again:
+{
+    'notif_type': 4,
+    'text': 'Se ha actualizado la tabla de clientes',
+    'ids': [1, 2],
+    'events': [
+        {'id': 1, 'operation': 'update', 'data': {'id': 1, 'name': ..., 'address': ...}},
+        {'id': 2, 'operation': 'delete', 'data': None},
+    ],
+}
+"""
+import json
+import threading
+import weakref
+
+from channels import Channel, Group
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils.module_loading import import_string
+from rest_framework.utils.encoders import JSONEncoder
+
+TABLE_CHANGES_CHANNEL = 'broadcasts.table_changes'
+TABLE_CHANGES_FLUSH_CHANNEL = 'broadcasts.table_changes.flush'
+
+# Channel of the delay server included in channels, see channels.delay
+DELAY_CHANNEL = 'asgi.delay'
+
+# Key of the PostgreSQL advisory lock that serializes the consumers of the pending changes
+PENDING_CHANGES_LOCK = 3717
+
+OPERATION_CREATE = 'create'
+OPERATION_UPDATE = 'update'
+OPERATION_DELETE = 'delete'
+
+
+def get_operation(created, is_active=True):
+    """Returns the operation of a save, deleted objects are the ones no longer active.
+    """
+    if not is_active:
+        return OPERATION_DELETE
+    return OPERATION_CREATE if created else OPERATION_UPDATE
+
+
+def merge_operations(previous, operation):
+    """Returns the operation that sums up two consecutive operations over the same row, e.g.
+    a row created and then updated is still new for the clients.
+    """
+    if previous == OPERATION_CREATE and operation == OPERATION_UPDATE:
+        return OPERATION_CREATE
+    return operation
+
+
+class TransactionChanges(object):
+    """on_commit callback that collects the changes made during a transaction, or during one
+    of its savepoints, and queues them once it commits. If the transaction or the savepoint
+    is rolled back Django drops the callback and nothing is sent.
+    """
+
+    def __init__(self):
+        self.changes = {}
+
+    def add(self, group_name, notif_type, text, serializer, operations):
+        add_change(self.changes, group_name, notif_type, text, serializer, operations)
+
+    def __call__(self):
+        queue_changes(self.changes)
+
+
+def add_change(changes, group_name, notif_type, text, serializer, operations):
+    change = changes.setdefault(group_name, {'notif_type': notif_type, 'text': text,
+                                             'serializer': serializer, 'operations': {}})
+    for row_id, operation in operations.items():
+        change['operations'][row_id] = merge_operations(change['operations'].get(row_id),
+                                                        operation)
+
+
+def queue_changes(changes):
+    """Sends the changes to TABLE_CHANGES_CHANNEL, where store_table_changes takes them.
+    """
+    Channel(TABLE_CHANGES_CHANNEL).send({'changes': [
+        {'group_name': group_name, 'notif_type': change['notif_type'], 'text': change['text'],
+         'serializer': change['serializer'],
+         'operations': [[row_id, operation]
+                        for row_id, operation in change['operations'].items()]}
+        for group_name, change in changes.items()]})
+
+
+class TableChangeBroadcaster(object):
+    """Collects the table changes of each transaction.
+
+    The changes of a transaction are kept by TransactionChanges callbacks, one for each
+    savepoint that made changes, found through weak references: the only strong reference
+    to them is Django's list of on_commit callbacks, so they disappear as soon as Django
+    runs them or drops them because their transaction or savepoint was rolled back.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def table_changed(self, group_name, notif_type, text, serializer, ids, operation):
+        """Reports that the rows with the given ids changed.
+
+        Parameters
+        ----------
+        group_name: string
+            Name of the websocket group of the table, e.g. 'clients-table'
+        notif_type: int
+            One of the utils.NOTIF_TYPE_*_TABLE_CHANGE constants
+        text: string
+            Text shown to the user
+        serializer: string
+            Dotted path of the serializer used to represent the rows, its Meta.model is
+            the model of the rows
+        ids: iterable
+            Ids of the rows that changed
+        operation: string
+            OPERATION_CREATE, OPERATION_UPDATE or OPERATION_DELETE
+        """
+        operations = {row_id: operation for row_id in ids}
+        connection = transaction.get_connection()
+        if not connection.in_atomic_block:
+            changes = {}
+            add_change(changes, group_name, notif_type, text, serializer, operations)
+            queue_changes(changes)
+            return
+        self.get_transaction_changes(connection).add(group_name, notif_type, text, serializer,
+                                                     operations)
+
+    def get_transaction_changes(self, connection):
+        """Returns the TransactionChanges of the current savepoint, registering it the first
+        time.
+        """
+        if not hasattr(self.local, 'transaction_changes'):
+            self.local.transaction_changes = weakref.WeakValueDictionary()
+        key = (connection.alias, tuple(connection.savepoint_ids))
+        transaction_changes = self.local.transaction_changes.get(key)
+        if transaction_changes is None:
+            transaction_changes = TransactionChanges()
+            self.local.transaction_changes[key] = transaction_changes
+            transaction.on_commit(transaction_changes, using=connection.alias)
+        return transaction_changes
+
+
+def lock_pending_changes():
+    """Waits until no other worker is storing or sending pending changes, until the end of
+    the current transaction.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_xact_lock(%s)', [PENDING_CHANGES_LOCK])
+
+
+def schedule_flush():
+    """Asks the delay server to message TABLE_CHANGES_FLUSH_CHANNEL once the broadcast window
+    ends, or messages it right away when there is no window.
+    """
+    window = getattr(settings, 'TABLE_CHANGE_BROADCAST_WINDOW', 0)
+    if window > 0:
+        Channel(DELAY_CHANNEL).send({'channel': TABLE_CHANGES_FLUSH_CHANNEL, 'content': {},
+                                     'delay': int(window * 1000)})
+    else:
+        Channel(TABLE_CHANGES_FLUSH_CHANNEL).send({})
+
+
+def store_table_changes(message):
+    """Consumer of TABLE_CHANGES_CHANNEL that saves the queued changes until they are sent.
+    The first change of a window schedules the flush, the following ones wait for it.
+    """
+    from works.models import PendingTableChange
+
+    with transaction.atomic():
+        lock_pending_changes()
+        is_scheduled = PendingTableChange.objects.exists()
+        PendingTableChange.objects.bulk_create([
+            PendingTableChange(group_name=change['group_name'], notif_type=change['notif_type'],
+                               text=change['text'], serializer=change['serializer'],
+                               row_id=row_id, operation=operation)
+            for change in message.content['changes']
+            for row_id, operation in change['operations']])
+        if not is_scheduled:
+            transaction.on_commit(schedule_flush)
+
+
+def send_table_changes(message):
+    """Consumer of TABLE_CHANGES_FLUSH_CHANNEL that takes every pending change and sends
+    them, one message per group.
+    """
+    from works.models import PendingTableChange
+
+    changes = {}
+    with transaction.atomic():
+        lock_pending_changes()
+        pending_changes = list(PendingTableChange.objects.order_by('id'))
+        PendingTableChange.objects.filter(
+            id__in=[pending.id for pending in pending_changes]).delete()
+    for pending in pending_changes:
+        add_change(changes, pending.group_name, pending.notif_type, pending.text,
+                   pending.serializer, {pending.row_id: pending.operation})
+    for group_name, change in changes.items():
+        send(group_name, change)
+
+
+def send(group_name, change):
+    operations = change['operations']
+    data = serialize_rows(change['serializer'], [
+        row_id for row_id, operation in operations.items()
+        if operation != OPERATION_DELETE])
+    notification = {
+        'notif_type': change['notif_type'],
+        'text': change['text'],
+        'ids': sorted(operations),
+        'events': [{'id': row_id, 'operation': operations[row_id], 'data': data.get(row_id)}
+                   for row_id in sorted(operations)],
+    }
+    Group(group_name).send({
+        'text': json.dumps(notification, cls=JSONEncoder),
+        })
+
+
+def serialize_rows(serializer_path, ids):
+    """Serializes the rows with the given ids with a single query per relation.
+
+    Returns
+    -------
+    dict
+        The serialized rows by id
+    """
+    if not ids:
+        return {}
+    from balarco import utils
+
+    serializer_class = import_string(serializer_path)
+    queryset = serializer_class.Meta.model.objects.filter(pk__in=ids)
+    select_related, prefetch_related = utils.get_eager_loading_lookups(serializer_class())
+    if select_related:
+        queryset = queryset.select_related(*select_related)
+    if prefetch_related:
+        queryset = queryset.prefetch_related(*prefetch_related)
+    return {obj['id']: obj for obj in serializer_class(queryset, many=True).data}
+
+
+broadcaster = TableChangeBroadcaster()
+
+
+def table_changed(group_name, notif_type, text, serializer, ids, operation):
+    """Reports a table change to the default broadcaster, see
+    TableChangeBroadcaster.table_changed.
+    """
+    broadcaster.table_changed(group_name, notif_type, text, serializer, ids, operation)
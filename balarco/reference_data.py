@@ -0,0 +1,262 @@
+"""In-process cache of the small reference tables (Status, WorkType, ArtType) that are read
+on almost every request.
+
+Each process loads every row of the registered models the first time one of them is
+needed and keeps them until they change. Saving or deleting a row invalidates the cache of
+the process right away, and once the transaction commits the change is published through
+Redis so every other process drops its copy too. If Redis can't be reached the copies
+expire after settings.REFERENCE_DATA_CACHE_TTL seconds, and Redis isn't tried again for
+REDIS_RETRY_INTERVAL seconds, so the requests don't wait for its connection timeout.
+
+Inside a transaction that changed reference rows, lookups read a snapshot of that
+transaction instead, so rows that may still be rolled back never reach the shared cache.
+The snapshots are on_commit callbacks found through weak references, so they disappear
+when Django runs them or drops them because their transaction or savepoint was rolled back.
+Changes made with queryset.update() or bulk_create() don't send signals, call invalidate()
+after them.
+"""
+import hashlib
+import threading
+import time
+import uuid
+import weakref
+
+import redis
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from rest_framework import serializers
+
+INVALIDATION_CHANNEL = 'reference-data.invalidate'
+
+# Seconds during which Redis isn't used after it fails
+REDIS_RETRY_INTERVAL = 30
+
+
+def load_rows(models):
+    return {model: {obj.pk: obj for obj in model.objects.order_by('pk')} for model in models}
+
+
+def get_rows_digest(data):
+    """Returns a digest of the rows, which changes whenever one of them does and is the same
+    in every process that has the same rows.
+    """
+    rows = [(model._meta.label, [[getattr(obj, field.attname)
+                                  for field in model._meta.concrete_fields]
+                                 for obj in objs.values()])
+            for model, objs in data.items()]
+    return hashlib.md5(repr(rows).encode('utf-8')).hexdigest()
+
+
+class TransactionSnapshot(object):
+    """on_commit callback registered by the first change to reference data in a transaction,
+    or in one of its savepoints. It keeps the rows as seen by the transaction and, on
+    commit, invalidates the shared cache. If the transaction or the savepoint is rolled back
+    Django drops it together with its rows.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.data = None
+
+    def get_data(self):
+        if self.data is None:
+            self.data = load_rows(self.cache.models)
+        return self.data
+
+    def __call__(self):
+        self.cache.invalidate()
+
+
+class ReferenceDataCache(object):
+    """Cache of every row of the registered models, by model and primary key.
+
+    Attributes
+    ----------
+    models: list
+        Registered model classes
+    version: int
+        Incremented every time the cache is invalidated
+    """
+
+    def __init__(self):
+        self.models = []
+        self.lock = threading.Lock()
+        # The cached rows and their digest, computed once per load
+        self.data = None
+        self.digest = None
+        self.loaded_at = None
+        self.redis = None
+        self.redis_retry_at = 0
+        self.version = 0
+        self.token = uuid.uuid4().hex
+        self.listener = None
+        self.local = threading.local()
+
+    def register(self, *models):
+        """Adds models to the cache and invalidates it whenever their rows change.
+        """
+        for model in models:
+            self.models.append(model)
+            post_save.connect(self.row_changed, sender=model, weak=False)
+            post_delete.connect(self.row_changed, sender=model, weak=False)
+        self.data = None
+
+    def row_changed(self, sender, **kwargs):
+        connection = transaction.get_connection()
+        if not connection.in_atomic_block:
+            self.invalidate()
+            return
+        snapshots = self.get_transaction_snapshots()
+        key = tuple(connection.savepoint_ids)
+        if key not in snapshots:
+            snapshot = TransactionSnapshot(self)
+            snapshots[key] = snapshot
+            transaction.on_commit(snapshot)
+        # The rows loaded before the change, in any savepoint, are outdated.
+        for snapshot in snapshots.values():
+            snapshot.data = None
+        self.data = None
+
+    def get_transaction_snapshots(self):
+        """Returns the pending snapshots of the current transaction by the savepoints they
+        were registered in.
+        """
+        if not hasattr(self.local, 'snapshots'):
+            self.local.snapshots = weakref.WeakValueDictionary()
+        return self.local.snapshots
+
+    def invalidate(self, publish=True):
+        """Drops the cached rows of this process and, if publish is True, of every other
+        process.
+        """
+        with self.lock:
+            self.data = None
+            self.digest = None
+            self.version += 1
+        if publish:
+            self.publish()
+
+    def get_data(self):
+        return self.get_data_and_digest()[0]
+
+    def get_data_and_digest(self):
+        """Returns the rows and their digest, the digest is None for the rows of a
+        transaction that changed reference data.
+        """
+        connection = transaction.get_connection()
+        if connection.in_atomic_block:
+            snapshots = self.get_transaction_snapshots()
+            if snapshots:
+                snapshot = snapshots.get(tuple(connection.savepoint_ids))
+                # Rows loaded in another savepoint could include changes that were rolled
+                # back, they are only kept for the savepoint that made the changes.
+                data = snapshot.get_data() if snapshot is not None else load_rows(self.models)
+                return data, None
+        with self.lock:
+            data, digest, loaded_at = self.data, self.digest, self.loaded_at
+        ttl = getattr(settings, 'REFERENCE_DATA_CACHE_TTL', 300)
+        if data is None or time.time() - loaded_at > ttl:
+            with self.lock:
+                version = self.version
+            data = load_rows(self.models)
+            digest = get_rows_digest(data)
+            with self.lock:
+                # Rows loaded while the cache was being invalidated may be outdated.
+                if version == self.version:
+                    self.data = data
+                    self.digest = digest
+                    self.loaded_at = time.time()
+            self.start_listener()
+        return data, digest
+
+    def get_digest(self):
+        """Returns a digest of every cached row, see get_rows_digest. It is computed once
+        every time the rows are loaded.
+        """
+        data, digest = self.get_data_and_digest()
+        return digest if digest is not None else get_rows_digest(data)
+
+    def get(self, model, pk):
+        """Returns the object of the model with the given primary key.
+        Raises model.DoesNotExist if there is no such object.
+        """
+        try:
+            return self.get_data()[model][pk]
+        except KeyError:
+            return model.objects.get(pk=pk)
+
+    def all(self, model):
+        """Returns every object of the model ordered by primary key.
+        """
+        return list(self.get_data()[model].values())
+
+    def get_redis(self):
+        """Returns the Redis client shared by the process, or None if there is no Redis
+        server or it failed less than REDIS_RETRY_INTERVAL seconds ago.
+        """
+        host = getattr(settings, 'REFERENCE_DATA_REDIS_HOST', None)
+        if host is None or time.time() < self.redis_retry_at:
+            return None
+        if self.redis is None:
+            self.redis = redis.StrictRedis(host=host, port=6379, socket_connect_timeout=1)
+        return self.redis
+
+    def redis_failed(self):
+        self.redis_retry_at = time.time() + REDIS_RETRY_INTERVAL
+
+    def publish(self):
+        client = self.get_redis()
+        if client is None:
+            return
+        try:
+            client.publish(INVALIDATION_CHANNEL, self.token)
+        except redis.RedisError:
+            self.redis_failed()
+
+    def start_listener(self):
+        """Starts the thread that invalidates the cache when another process publishes a
+        change, unless it is already running or Redis is not available.
+        """
+        if self.listener is not None:
+            return
+        client = self.get_redis()
+        if client is None:
+            return
+        pubsub = client.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(INVALIDATION_CHANNEL)
+        except redis.RedisError:
+            self.redis_failed()
+            return
+        self.listener = threading.Thread(target=self.listen, args=(pubsub,), daemon=True)
+        self.listener.start()
+
+    def listen(self, pubsub):
+        try:
+            for message in pubsub.listen():
+                if message['data'] != self.token.encode():
+                    self.invalidate(publish=False)
+        except redis.RedisError:
+            self.redis_failed()
+        self.listener = None
+        self.invalidate(publish=False)
+
+
+cache = ReferenceDataCache()
+
+
+class ReferenceDataField(serializers.Field):
+    """Read only field that serializes a reference data object taken from the cache, so the
+    relation doesn't have to be joined or fetched. The source must be the id of the relation,
+    e.g. ReferenceDataField(StatusSerializer, source='current_status_id').
+    """
+
+    def __init__(self, serializer_class, **kwargs):
+        kwargs['read_only'] = True
+        self.serializer_class = serializer_class
+        super(ReferenceDataField, self).__init__(**kwargs)
+
+    def to_representation(self, pk):
+        obj = cache.get(self.serializer_class.Meta.model, pk)
+        return self.serializer_class(obj, context=self.context).data
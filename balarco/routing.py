@@ -6,12 +6,23 @@ same URL if we wanted; Daphne separates by protocol as it negotiates with a brow
 """
 
 from channels import route
+from balarco import broadcasts
 from works import consumers as work_consumers
+from works.models import NOTIFICATIONS_CHANNEL, NOTIFICATIONS_PURGE_CHANNEL
 from users import consumers as user_consumers
 from clients import consumers as client_consumers
 
 
 channel_routing = [
+    # Called when notifications are created, see works.models.dispatch_notifications
+    route(NOTIFICATIONS_CHANNEL, work_consumers.send_notifications),
+    # Called when table changes are committed, see balarco.broadcasts.table_changed
+    route(broadcasts.TABLE_CHANGES_CHANNEL, broadcasts.store_table_changes),
+    # Sent by the delay server when the broadcast window of the stored table changes ends
+    route(broadcasts.TABLE_CHANGES_FLUSH_CHANNEL, broadcasts.send_table_changes),
+    # Sent by whatever schedules the purge of old notifications, e.g. a cron job
+    route(NOTIFICATIONS_PURGE_CHANNEL, work_consumers.run_notifications_purge),
+
     # @TODO: Correct urls
     # Called when incoming WebSockets connect
     route("websocket.connect", work_consumers.connect_work,
@@ -35,6 +35,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'users.apps.UsersConfig',
     'clients.apps.ClientsConfig',
     'works.apps.WorksConfig',
@@ -42,6 +43,7 @@ INSTALLED_APPS = [
     'rest_framework.authtoken',
     'corsheaders',
     'channels',
+    'channels.delay',
     'djoser',
 ]
 
@@ -201,3 +203,23 @@ CHANNEL_LAYERS = {
         "ROUTING": "balarco.routing.channel_routing",
     },
 }
+
+# Seconds during which the "table changed" websocket messages are collected before they are
+# sent, see balarco.broadcasts. The delay server, manage.py rundelay, must be running when it
+# isn't 0.
+TABLE_CHANGE_BROADCAST_WINDOW = float(os.environ.get('TABLE_CHANGE_BROADCAST_WINDOW', 0.5))
+
+# Seen notifications older than this number of days are deleted by the purge_notifications
+# command, which deletes NOTIFICATION_PURGE_BATCH_SIZE rows per statement.
+NOTIFICATION_RETENTION_DAYS = int(os.environ.get('NOTIFICATION_RETENTION_DAYS', 90))
+NOTIFICATION_PURGE_BATCH_SIZE = 1000
+
+# Redis server used to tell every process that the cached Status, WorkType and ArtType rows
+# changed, see balarco.reference_data. Without it the cached rows expire after
+# REFERENCE_DATA_CACHE_TTL seconds.
+REFERENCE_DATA_REDIS_HOST = redis_host
+REFERENCE_DATA_CACHE_TTL = 300
+
+# Seconds the ?since= cursors returned by the list endpoints stay behind the request, so
+# rows saved by transactions that were still running are sent in the next request.
+DELTA_SYNC_MARGIN = 5
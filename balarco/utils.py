@@ -1,12 +1,30 @@
+import collections
+import datetime
+import hashlib
+import warnings
+
 import django_filters.rest_framework
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramSimilarity
+from django.db import connection, transaction
+from django.db.models import Case, Count, F, FloatField, IntegerField, Max, Q, Value, When
+from django.db.models.functions import Cast, Greatest, Upper
+from django.db.models.signals import post_delete, post_save
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.http import http_date, parse_http_date_safe
 from django.shortcuts import get_object_or_404
+from django.core.exceptions import FieldDoesNotExist, ValidationError
 from django.core.urlresolvers import reverse
-from rest_framework import viewsets, status
+from rest_framework import pagination, serializers, viewsets, status
+from rest_framework.decorators import list_route
 from rest_framework.response import Response
 from rest_framework.authentication import TokenAuthentication, SessionAuthentication
 from rest_framework.test import APITestCase, APIRequestFactory, force_authenticate
 from rest_framework.authtoken.models import Token
 
+from balarco import broadcasts, reference_data
+
 
 GROUP_SUPERUSUARIO = "Super usuario"
 GROUP_DIR_CUENTAS = "Director de cuentas"
@@ -36,6 +54,40 @@ NOTIF_TYPE_USERS_TABLE_CHANGE = 3
 NOTIF_TYPE_CLIENTS_TABLE_CHANGE = 4
 NOTIF_TYPE_CONTACTS_TABLE_CHANGE = 5
 NOTIF_TYPE_IGUALAS_TABLE_CHANGE = 6
+NOTIF_TYPE_UNREAD_COUNT = 7
+
+# Query param of the delete requests that asks for the list of remaining objects, see
+# soft_delete_response
+RETURN_LIST_QUERY_PARAM = 'return_list'
+
+# Query param of the list requests that asks only for the changes after a cursor, see
+# GenericViewSet.delta_response
+SINCE_QUERY_PARAM = 'since'
+
+# Query param of the list requests with the words to search, see GenericViewSet.search
+SEARCH_QUERY_PARAM = 'q'
+# Text search configuration of the search_vector columns
+SEARCH_CONFIG = 'spanish'
+
+# Query params of the autocomplete requests, see AutocompleteMixin
+AUTOCOMPLETE_QUERY_PARAM = 'term'
+AUTOCOMPLETE_LIMIT_QUERY_PARAM = 'limit'
+
+
+def get_group_names(user):
+    """Returns the names of the groups the user belongs to, loaded with one query.
+    """
+    return frozenset(user.groups.values_list('name', flat=True))
+
+
+def get_request_group_names(request):
+    """Returns the names of the groups of request.user.
+    They are kept in the request, so they are loaded once per request however many times
+    they are needed, e.g. by a permission and by the view.
+    """
+    if not hasattr(request, '_group_names'):
+        request._group_names = get_group_names(request.user)
+    return request._group_names
 
 
 def notification_text(notification_type, work):
@@ -68,6 +120,143 @@ def update_object_from_data(serializer_class, update_obj, data):
         return False
 
 
+ChildrenChanges = collections.namedtuple('ChildrenChanges', ['created', 'updated', 'deactivated'])
+
+
+def upsert_children(parent, related_name, key_fields, serializer_class, items,
+                    existing_filter=None, create_if=None, before_save=None,
+                    deactivate_missing=False):
+    """Creates or updates the children of an object from the items of a payload, e.g. the
+    art_iguala of an iguala, matching them with the existing children by their natural key.
+    When several items have the same key the last one wins.
+    Every item is validated before writing anything, the existing children are loaded with
+    a single query and the changes are written with a single statement of each kind: one
+    INSERT for the new children, one UPDATE for the modified ones and one UPDATE for the
+    deactivated ones, so the number of queries doesn't depend on the number of children.
+
+    Bulk statements don't call save() nor send the signals of the children, the callers do
+    whatever those would have done with the returned changes.
+
+    e.g: upsert_children(iguala, 'art_iguala', ('art_type',), ArtIgualaSerializer, items)
+
+    Parameters
+    ----------
+    parent: Model
+        Object whose children are written
+    related_name: string
+        Name of the relation from the parent to the children
+    key_fields: tuple
+        Fields of the children that identify them within the parent
+    serializer_class: class
+        Serializer of the children, each item is validated with it except for the parent
+        field. Items of existing children are partial updates
+    items: list
+        Data of the children, as received in the request
+    existing_filter: dict
+        Optional. Filters that the existing children must match, e.g. {'is_active': True}
+    create_if: function
+        Optional. Receives the validated data of an item without an existing child and
+        returns whether the child should be created
+    before_save: function
+        Optional. Receives each child to create or update, and whether it is new, before
+        writing it
+    deactivate_missing: bool
+        If True, the existing children without an item are soft deleted
+
+    Returns
+    -------
+    ChildrenChanges
+        The created, updated and deactivated children, or None if an item is not valid
+    """
+    relation = parent._meta.get_field(related_name)
+    model = relation.related_model
+    parent_field = relation.field
+    key_model_fields = [model._meta.get_field(field_name) for field_name in key_fields]
+
+    existing = {}
+    children = model.objects.filter(**{parent_field.name: parent}).filter(
+        **(existing_filter or {})).order_by('pk')
+    for child in children:
+        setattr(child, parent_field.name, parent)
+        key = tuple(getattr(child, field.attname) for field in key_model_fields)
+        existing.setdefault(key, child)
+
+    # Items repeating a key replace the previous ones, so each key is written once
+    items_by_key = collections.OrderedDict()
+    for item in items:
+        try:
+            key = tuple(field.to_python(item.get(field.name)) for field in key_model_fields)
+        except ValidationError:
+            return None
+        items_by_key[key] = item
+
+    created = []
+    updated = []
+    for key, item in items_by_key.items():
+        child = existing.get(key)
+        if child is not None:
+            serializer = serializer_class(child, data=item, partial=True)
+        else:
+            serializer = serializer_class(data=item)
+        # The parent is already known, it doesn't need to be fetched for every item
+        serializer.fields.pop(parent_field.name, None)
+        if not serializer.is_valid():
+            return None
+        if child is not None:
+            for attr, value in serializer.validated_data.items():
+                setattr(child, attr, value)
+            if child not in updated:
+                updated.append(child)
+        elif create_if is None or create_if(serializer.validated_data):
+            created.append(model(**dict(serializer.validated_data, **{parent_field.name: parent})))
+
+    deactivated = []
+    if deactivate_missing:
+        deactivated = [child for child in existing.values()
+                       if child not in updated and child.is_active]
+
+    for child in created:
+        if before_save is not None:
+            before_save(child, True)
+    for child in updated:
+        if before_save is not None:
+            before_save(child, False)
+
+    with transaction.atomic():
+        if created:
+            created = model.objects.bulk_create(created)
+        if updated:
+            bulk_update(updated, [field for field in model._meta.concrete_fields
+                                  if not field.primary_key])
+        if deactivated:
+            changes = {'is_active': False}
+            if has_field(model, 'updated_at'):
+                changes['updated_at'] = timezone.now()
+            model.objects.filter(pk__in=[child.pk for child in deactivated]).update(**changes)
+            for child in deactivated:
+                child.is_active = False
+    return ChildrenChanges(created, updated, deactivated)
+
+
+def bulk_update(objs, fields):
+    """Writes the given fields of several objects of the same model with a single UPDATE,
+    setting each column with a CASE over the primary keys.
+    """
+    model = type(objs[0])
+    changes = {}
+    for field in fields:
+        if getattr(field, 'auto_now', False):
+            changes[field.attname] = timezone.now()
+            continue
+        # The values are cast to the type of the column, a CASE of NULLs would be text
+        changes[field.attname] = Cast(Case(
+            *[When(pk=obj.pk, then=Value(field.get_db_prep_save(getattr(obj, field.attname),
+                                                                connection)))
+              for obj in objs],
+            output_field=field), field)
+    model.objects.filter(pk__in=[obj.pk for obj in objs]).update(**changes)
+
+
 def response_object_could_not_be_created(obj_class):
     return Response({
         'status': 'Bad request',
@@ -94,37 +283,721 @@ def generic_rest_soft_delete(request, serializer_class, obj_class, pk):
     Returns
     -------
     Response
-        Response object containing the serializer data
+        Response object containing the id of the deleted object, see soft_delete_response
     """
     queryset = obj_class.objects.filter(is_active=True)
     obj = get_object_or_404(queryset, pk=pk)
     obj.is_active = False
     obj.save()
-    serializer = serializer_class(queryset, many=True)
-    return Response(serializer.data, status.HTTP_200_OK)
+    return soft_delete_response(request, serializer_class, queryset, obj)
+
+
+def cascade_soft_delete(model, ids):
+    """Soft deletes the children of the given objects, and the children of those, following
+    the related names listed in the SOFT_DELETE_CASCADE attribute of each model.
+    The rows of each child model are deactivated with a single UPDATE inside a transaction,
+    which also applies the SOFT_DELETE_CHANGES of the child model, if any, and a single
+    table change message is sent for each child model that declares TABLE_CHANGE, with the
+    ids of all its deactivated rows.
+
+    e.g: cascade_soft_delete(Client, [client.id]) deactivates all the client's contacts.
+
+    Parameters
+    ----------
+    model: class
+        Class of the model of the objects
+    ids: iterable
+        Ids of the objects whose children are deleted
+
+    Returns
+    -------
+    OrderedDict
+        Ids of the deactivated objects by model class
+    """
+    deactivated = collections.OrderedDict()
+    with transaction.atomic():
+        _cascade_soft_delete(model, list(ids), deactivated)
+        for child_model, child_ids in deactivated.items():
+            table_change = getattr(child_model, 'TABLE_CHANGE', None)
+            if table_change is not None:
+                broadcasts.table_changed(*table_change, ids=child_ids,
+                                         operation=broadcasts.OPERATION_DELETE)
+    return deactivated
 
 
-class GenericViewSet(viewsets.ModelViewSet):
+def _cascade_soft_delete(model, ids, deactivated):
+    for related_name in getattr(model, 'SOFT_DELETE_CASCADE', ()):
+        relation = model._meta.get_field(related_name)
+        child_model = relation.related_model
+        children = child_model.objects.filter(is_active=True,
+                                              **{'{}__in'.format(relation.field.name): ids})
+        child_ids = list(children.values_list('id', flat=True))
+        if not child_ids:
+            continue
+        changes = dict(getattr(child_model, 'SOFT_DELETE_CHANGES', {}), is_active=False)
+        if has_field(child_model, 'updated_at'):
+            changes['updated_at'] = timezone.now()
+        child_model.objects.filter(id__in=child_ids).update(**changes)
+        deactivated.setdefault(child_model, []).extend(child_ids)
+        _cascade_soft_delete(child_model, child_ids, deactivated)
+
+
+def has_field(model, field_name):
+    try:
+        model._meta.get_field(field_name)
+    except FieldDoesNotExist:
+        return False
+    return True
+
+
+def touch_parent_on_change(model, parent_field):
+    """Updates the updated_at field of the parent of the objects of a model every time one of
+    them is saved or deleted, so the parent, which includes them in its representation, is
+    known to have changed.
+
+    e.g: touch_parent_on_change(ArtWork, 'work')
+
+    Parameters
+    ----------
+    model: class
+        Class of the model of the children
+    parent_field: string
+        Name of the ForeignKey to the parent, whose model must have an updated_at field
+    """
+    field = model._meta.get_field(parent_field)
+
+    def touch_parent(sender, instance, **kwargs):
+        parent_id = getattr(instance, field.attname)
+        if parent_id is not None:
+            field.related_model.objects.filter(pk=parent_id).update(updated_at=timezone.now())
+
+    post_save.connect(touch_parent, sender=model, weak=False)
+    post_delete.connect(touch_parent, sender=model, weak=False)
+
+
+def soft_delete_response(request, serializer_class, queryset, obj):
+    """Builds the response of a soft delete, which only contains the id of the deleted object.
+    Clients that still expect the list of remaining objects can ask for it with the
+    ?return_list=true query param.
+
+    Parameters
+    ----------
+    request: request
+        The request that was made by the client
+    serializer_class: class
+        Class of the model serializer
+    queryset: QuerySet
+        The active objects, serialized when the list is requested
+    obj: Model
+        The deleted object
+
+    Returns
+    -------
+    Response
+        Response object containing {'id': <id of obj>} or the serializer data of the queryset
+    """
+    if request.query_params.get(RETURN_LIST_QUERY_PARAM, '').lower() in ('true', '1'):
+        serializer = serializer_class(queryset, many=True)
+        return Response(serializer.data, status.HTTP_200_OK)
+    return Response({'id': obj.pk}, status.HTTP_200_OK)
+
+
+def _remove_redundant_lookups(lookups):
+    """Drops every lookup that is a prefix of another one, e.g. 'contact' when
+    'contact__client' is also present, because Django already follows the whole path.
+    """
+    return tuple(sorted(lookup for lookup in lookups
+                        if not any(other.startswith(lookup + '__') for other in lookups)))
+
+
+def _collect_related_lookups(serializer, model, prefix, many, select_related, prefetch_related):
+    for field in serializer.fields.values():
+        if field.write_only or field.source == '*':
+            continue
+
+        if isinstance(field, serializers.ListSerializer):
+            nested_serializer = field.child
+        elif isinstance(field, serializers.BaseSerializer):
+            nested_serializer = field
+        else:
+            nested_serializer = None
+
+        source_attrs = field.source.split('.')
+        if nested_serializer is None:
+            # Only the relations traversed before reaching the final attribute are
+            # needed, e.g. 'art_type' for source='art_type.name'.
+            source_attrs = source_attrs[:-1]
+
+        current_model = model
+        current_path = prefix
+        current_many = many
+        for attr in source_attrs:
+            try:
+                model_field = current_model._meta.get_field(attr)
+            except FieldDoesNotExist:
+                break
+            if not model_field.is_relation or model_field.related_model is None:
+                break
+            current_path = '{}__{}'.format(current_path, attr) if current_path else attr
+            current_many = current_many or model_field.many_to_many or model_field.one_to_many
+            if current_many:
+                prefetch_related.add(current_path)
+            else:
+                select_related.add(current_path)
+            current_model = model_field.related_model
+        else:
+            if nested_serializer is not None and source_attrs:
+                _collect_related_lookups(nested_serializer, current_model, current_path,
+                                         current_many, select_related, prefetch_related)
+
+
+def get_eager_loading_lookups(serializer):
+    """Walks the fields of a model serializer, including its nested serializers, and
+    returns the relations that have to be loaded to serialize a queryset without
+    issuing one query per row.
+
+    Relations reached only through foreign keys are joined with select_related, while
+    anything behind a reverse foreign key or a many to many relation is prefetched.
+
+    Parameters
+    ----------
+    serializer: ModelSerializer
+        Instance of the serializer whose fields are going to be inspected
+
+    Returns
+    -------
+    tuple
+        A (select_related, prefetch_related) pair of tuples of lookups
+    """
+    select_related = set()
+    prefetch_related = set()
+    _collect_related_lookups(serializer, serializer.Meta.model, '', False,
+                             select_related, prefetch_related)
+    return (_remove_redundant_lookups(select_related),
+            _remove_redundant_lookups(prefetch_related))
+
+
+def get_unused_columns(serializer):
+    """Returns the names of the concrete, non relational columns of the serializer model
+    that none of its fields read, so they can be deferred.
+    When a field reads something that is not a model field (e.g. a method or the whole
+    instance) nothing is deferred, since it could touch any column.
+    """
+    model = serializer.Meta.model
+    column_names = {name for model_field in model._meta.concrete_fields
+                    for name in (model_field.name, model_field.attname)}
+    relation_names = {model_field.name for model_field in model._meta.get_fields()
+                      if model_field.is_relation}
+    used_names = set()
+    for field in serializer.fields.values():
+        if field.write_only:
+            continue
+        source_name = field.source.split('.')[0]
+        if source_name not in column_names and source_name not in relation_names:
+            return []
+        used_names.add(source_name)
+    return [model_field.name for model_field in model._meta.concrete_fields
+            if not model_field.is_relation and not model_field.primary_key and
+            model_field.name not in used_names]
+
+
+def parse_query_list(value):
+    """Splits a comma separated query param, e.g. '?fields=id,name', into a list.
+    """
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+class DynamicFieldsMixin(object):
+    """Mixin for model serializers that lets the client choose which fields to receive.
+    It takes two optional keyword arguments:
+
+    fields: list
+        Names of the fields to keep. When it's not given every field that is not listed
+        in Meta.expandable_fields is kept.
+    expand: list
+        Names of extra fields to include, usually the heavy nested ones declared in
+        Meta.expandable_fields.
+
+    When neither is given the serializer behaves as usual and returns every field.
+    GenericViewSet fills both arguments from the ?fields= and ?expand= query params.
+    """
+
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        expand = kwargs.pop('expand', None)
+        super(DynamicFieldsMixin, self).__init__(*args, **kwargs)
+        if fields is None and expand is None:
+            return
+
+        if fields is None:
+            expandable_fields = set(getattr(self.Meta, 'expandable_fields', ()))
+            allowed = set(self.fields) - expandable_fields
+        else:
+            allowed = set(fields)
+        allowed |= set(expand or ())
+        for field_name in set(self.fields) - allowed:
+            self.fields.pop(field_name)
+
+
+class KeysetPagination(pagination.CursorPagination):
+    """Cursor pagination used by GenericViewSet.
+    It is opt-in: lists are only paginated when the client sends the cursor or the
+    page_size query params, so existing clients keep receiving plain lists.
+
+    The ordering is taken from the cursor_ordering attribute of the view, which must
+    start with an indexed and (nearly) unique column so that rows inserted while a client
+    is paginating do not shift the pages.
+    """
+    ordering = ('-id',)
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.cursor_query_param not in request.query_params and \
+           self.page_size_query_param not in request.query_params:
+            return None
+        return super(KeysetPagination, self).paginate_queryset(queryset, request, view)
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def get_ordering(self, request, queryset, view):
+        if hasattr(view, 'get_cursor_ordering'):
+            ordering = view.get_cursor_ordering()
+        else:
+            ordering = getattr(view, 'cursor_ordering', None)
+        ordering = ordering or self.ordering
+        if isinstance(ordering, str):
+            ordering = (ordering,)
+        return tuple(ordering)
+
+
+class EagerLoadingMetaclass(type):
+    """Metaclass of GenericViewSet that computes, once per class, the select_related
+    and prefetch_related lookups needed by its serializer_class.
+    Lookups declared explicitly on the class body are kept as they are.
+    """
+
+    def __new__(mcs, name, bases, attrs):
+        cls = super(EagerLoadingMetaclass, mcs).__new__(mcs, name, bases, attrs)
+        model_serializer = getattr(cls, 'serializer_class', None)
+        if model_serializer is None or not hasattr(model_serializer, 'Meta'):
+            return cls
+        select_related, prefetch_related = get_eager_loading_lookups(model_serializer())
+        if attrs.get('select_related_fields') is None:
+            cls.select_related_fields = select_related
+        if attrs.get('prefetch_related_fields') is None:
+            cls.prefetch_related_fields = prefetch_related
+        return cls
+
+
+class GenericViewSet(viewsets.ModelViewSet, metaclass=EagerLoadingMetaclass):
     """Generic view set for basic CRUD REST Service.
     To use it a ViewSet has to inherit from it and add the attributes.
 
+    The relations needed by serializer_class are computed when the class is created and
+    applied to get_queryset(), so listing does not issue one query per row.
+
     Attributes
     ----------
     obj_class: class
         Class of the main model that the REST is going to work on
     serializer_class: class
         Class of the serializer that is going to represent the obj_class
+    select_related_fields: tuple
+        Optional. Lookups passed to select_related, computed from serializer_class
+        when not declared
+    prefetch_related_fields: tuple
+        Optional. Lookups passed to prefetch_related, computed from serializer_class
+        when not declared
+    cursor_ordering: tuple
+        Ordering used by KeysetPagination when the client asks for a page, its first
+        field must be indexed
+    last_modified_fields: tuple
+        Fields whose latest value tells when the representation of the objects changed,
+        including the updated_at of the related objects it contains, e.g.
+        'contact__updated_at'. Only used when obj_class has an updated_at field
+
+    When serializer_class uses DynamicFieldsMixin, GET requests accept the ?fields= and
+    ?expand= query params; the serializer is pruned accordingly and the eager loading
+    plan is recomputed from the pruned serializer, deferring the unused columns.
+
+    list and retrieve answer with ETag and Last-Modified headers computed from the count
+    and the latest last_modified_fields of the objects, and with 304 Not Modified, without
+    serializing anything, when the client already has them. A list only answers 304 to
+    If-None-Match, see conditional_response.
+
+    list also accepts ?since=<cursor> to return only the changes after the cursor, see
+    delta_response, and, when obj_class has a search_vector field, ?q=<words> to return the
+    objects that match the words ordered by relevance, see search.
     """
 
     authentication_classes = (TokenAuthentication, SessionAuthentication)
     obj_class = None
     serializer_class = None
     filter_backends = (django_filters.rest_framework.DjangoFilterBackend,)
+    select_related_fields = None
+    prefetch_related_fields = None
+    pagination_class = KeysetPagination
+    cursor_ordering = ('-id',)
+    last_modified_fields = ('updated_at',)
+
+    def get_queryset(self):
+        queryset = super(GenericViewSet, self).get_queryset()
+        return self.setup_eager_loading(queryset)
+
+    def get_serializer(self, *args, **kwargs):
+        kwargs.update(self.get_sparse_fieldset_kwargs())
+        return super(GenericViewSet, self).get_serializer(*args, **kwargs)
+
+    def get_sparse_fieldset_kwargs(self):
+        """Returns the fields/expand arguments requested by the client for serializers
+        that support them.
+        """
+        request = getattr(self, 'request', None)
+        if request is None or request.method != 'GET':
+            return {}
+        if not issubclass(self.get_serializer_class(), DynamicFieldsMixin):
+            return {}
+        sparse_kwargs = {}
+        for param in ('fields', 'expand'):
+            if param in request.query_params:
+                sparse_kwargs[param] = parse_query_list(request.query_params[param])
+        return sparse_kwargs
+
+    def setup_eager_loading(self, queryset):
+        """Hook to apply the eager loading plan to a queryset.
+        ViewSets can override it when the automatic plan is not enough.
+        """
+        select_related_fields = self.select_related_fields
+        prefetch_related_fields = self.prefetch_related_fields
+        if self.get_sparse_fieldset_kwargs():
+            serializer = self.get_serializer()
+            select_related_fields, prefetch_related_fields = \
+                get_eager_loading_lookups(serializer)
+            unused_columns = get_unused_columns(serializer)
+            if unused_columns:
+                queryset = queryset.defer(*unused_columns)
+        if select_related_fields:
+            queryset = queryset.select_related(*select_related_fields)
+        if prefetch_related_fields:
+            queryset = queryset.prefetch_related(*prefetch_related_fields)
+        return queryset
+
+    def get_search_terms(self):
+        request = getattr(self, 'request', None)
+        if request is None:
+            return None
+        terms = request.query_params.get(SEARCH_QUERY_PARAM, '').strip()
+        return terms or None
+
+    def filter_queryset(self, queryset):
+        queryset = super(GenericViewSet, self).filter_queryset(queryset)
+        terms = self.get_search_terms()
+        if terms is not None:
+            queryset = self.search(queryset, terms)
+        return queryset
+
+    def search(self, queryset, terms):
+        """Returns the objects of the queryset whose search_vector matches every word of
+        terms, with their relevance in the search_rank attribute and the most relevant
+        first. Words are stemmed with the Spanish configuration, so 'diseños' also
+        matches 'diseño'.
+        """
+        if not has_field(queryset.model, 'search_vector'):
+            raise serializers.ValidationError(
+                'The {} query param is not supported here'.format(SEARCH_QUERY_PARAM))
+        query = SearchQuery(terms, config=SEARCH_CONFIG)
+        # ts_rank returns a real, it is cast to double precision so the rank of the cursor
+        # of KeysetPagination is compared exactly
+        rank = Cast(SearchRank(F('search_vector'), query), FloatField())
+        return queryset.filter(search_vector=query).annotate(search_rank=rank).order_by(
+            '-search_rank', '-id')
+
+    def get_cursor_ordering(self):
+        """Returns the ordering used by KeysetPagination, search results are paginated by
+        relevance.
+        """
+        if self.get_search_terms() is not None:
+            return ('-search_rank', '-id')
+        return self.cursor_ordering
+
+    def list_response(self, queryset):
+        """Serializes a queryset the same way list() does, so custom list routes are
+        paginated when the client asks for a page.
+        """
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            serializer = self.get_serializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
+        serializer = self.get_serializer(queryset, many=True)
+        return Response(serializer.data, status.HTTP_200_OK)
+
+    def list(self, request, *args, **kwargs):
+        if SINCE_QUERY_PARAM in request.query_params:
+            return self.delta_response(request.query_params[SINCE_QUERY_PARAM])
+        queryset = self.filter_queryset(self.get_queryset())
+        return self.conditional_response(queryset, lambda: self.list_response(queryset),
+                                         many=True)
+
+    def delta_response(self, since):
+        """Returns the objects that changed after the since cursor, given by a previous
+        response or by the client as an ISO 8601 date.
+        The response contains the new objects or the ones whose last_modified_fields
+        changed, the ids of the objects deleted since then and the cursor for the next
+        request:
+        {'cursor': '2017-03-01T10:00:00.000000Z', 'results': [...], 'deleted': [1, 2]}
+        The cursor is a few seconds behind the request, DELTA_SYNC_MARGIN, so the rows saved
+        by transactions that are still running are returned by the next request.
+        """
+        if not has_field(self.obj_class, 'updated_at'):
+            raise serializers.ValidationError(
+                'The {} query param is not supported here'.format(SINCE_QUERY_PARAM))
+        since_date = parse_datetime(since)
+        if since_date is None:
+            raise serializers.ValidationError(
+                'The {} query param must be an ISO 8601 date'.format(SINCE_QUERY_PARAM))
+        if timezone.is_naive(since_date):
+            since_date = timezone.make_aware(since_date, timezone.utc)
+        cursor = timezone.now() - datetime.timedelta(seconds=settings.DELTA_SYNC_MARGIN)
+
+        changed_filter = Q()
+        for field in self.last_modified_fields:
+            changed_filter |= Q(**{'{}__gt'.format(field): since_date})
+        changed = self.filter_queryset(self.get_queryset()).filter(changed_filter)
+        deleted = self.filter_queryset(self.obj_class.objects.filter(is_active=False,
+                                                                     updated_at__gt=since_date))
+        serializer = self.get_serializer(changed, many=True)
+        return Response({
+            'cursor': max(cursor, since_date).astimezone(timezone.utc).strftime(
+                '%Y-%m-%dT%H:%M:%S.%fZ'),
+            'results': serializer.data,
+            'deleted': list(deleted.values_list('pk', flat=True)),
+        }, status.HTTP_200_OK)
+
+    def retrieve(self, request, *args, **kwargs):
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        queryset = self.filter_queryset(self.get_queryset()).filter(
+            **{self.lookup_field: kwargs[lookup_url_kwarg]})
+
+        def get_response():
+            serializer = self.get_serializer(self.get_object())
+            return Response(serializer.data)
+        return self.conditional_response(queryset, get_response)
+
+    def conditional_response(self, queryset, get_response, many=False):
+        """Returns 304 Not Modified if the client already has the current representation of
+        the queryset according to its If-None-Match or If-Modified-Since headers, otherwise
+        the response of get_response(). Both carry the ETag and Last-Modified headers.
+        If-Modified-Since is ignored when many is True: a list also changes when rows are
+        deleted or stop matching its filters, which doesn't change the latest date of the
+        rows left, only the count in the ETag tells it.
+        """
+        if not has_field(queryset.model, 'updated_at'):
+            return get_response()
+        etag, last_modified = self.get_validators(queryset)
+        if self.is_not_modified(etag, None if many else last_modified):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = get_response()
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified.timestamp())
+        return response
+
+    def get_validators(self, queryset):
+        """Returns the ETag and the last modification date of the queryset, computed with a
+        single query. The ETag also depends on the url, so every page, filter and field
+        selection has its own, on the user and on the reference data, whose rows are
+        embedded without an updated_at. The users shown in the representations don't have
+        one either, their changes must update the updated_at of the objects that show them.
+        """
+        aggregates = {'count': Count('pk')}
+        for idx, field in enumerate(self.last_modified_fields):
+            aggregates['last_modified_{}'.format(idx)] = Max(field)
+        values = queryset.order_by().aggregate(**aggregates)
+        dates = [values['last_modified_{}'.format(idx)]
+                 for idx in range(len(self.last_modified_fields))]
+        existing_dates = [date for date in dates if date is not None]
+        last_modified = max(existing_dates) if existing_dates else None
+        key = '|'.join([self.request.get_full_path(), str(self.request.user.pk),
+                        reference_data.cache.get_digest(),
+                        str(values['count'])] + [str(date) for date in dates])
+        etag = '"{}"'.format(hashlib.md5(key.encode('utf-8')).hexdigest())
+        return etag, last_modified
+
+    def is_not_modified(self, etag, last_modified):
+        if_none_match = self.request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match is not None:
+            etags = [value.strip() for value in if_none_match.split(',')]
+            return '*' in etags or etag in etags or 'W/' + etag in etags
+        if_modified_since = parse_http_date_safe(
+            self.request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+        if if_modified_since is not None and last_modified is not None:
+            return int(last_modified.timestamp()) <= if_modified_since
+        return False
 
     def destroy(self, request, pk=None):
         return generic_rest_soft_delete(request, self.serializer_class, self.obj_class, pk)
 
 
+_trigram_support = {}
+
+
+def has_trigram_support():
+    """Returns True if the pg_trgm extension is installed in the database, checked once
+    per process.
+    """
+    if connection.alias not in _trigram_support:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+            _trigram_support[connection.alias] = cursor.fetchone() is not None
+    return _trigram_support[connection.alias]
+
+
+def create_trigram_indexes(schema_editor, indexes, previous_migration):
+    """Creates trigram GIN indexes over UPPER(column), used by AutocompleteMixin, from a
+    RunPython migration. The pg_trgm extension is not created here, since the role of the
+    application usually isn't allowed to create extensions: the database administrator has
+    to run CREATE EXTENSION pg_trgm beforehand. When it isn't installed the indexes are
+    skipped with a warning, and the autocomplete routes fall back to a plain contains.
+
+    Parameters
+    ----------
+    schema_editor: BaseDatabaseSchemaEditor
+        The schema editor given to the migration
+    indexes: iterable
+        (index name, table, column) of each index
+    previous_migration: string
+        '<app label> <migration name>' of the migration before, given to manage.py migrate
+        to create the indexes again once the extension is installed
+    """
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+        if cursor.fetchone() is None:
+            app_label = previous_migration.split()[0]
+            warnings.warn(
+                'The pg_trgm extension is not installed, so the trigram indexes of the '
+                'autocomplete routes were not created and they will scan the tables. Ask the '
+                'database administrator to run "CREATE EXTENSION pg_trgm;", then run '
+                '"manage.py migrate {}" and "manage.py migrate {}" to create them.'.format(
+                    previous_migration, app_label))
+            return
+    for index_name, table, column in indexes:
+        schema_editor.execute('CREATE INDEX {} ON {} USING gin (UPPER({}) gin_trgm_ops)'.format(
+            index_name, table, column))
+
+
+def drop_trigram_indexes(schema_editor, indexes):
+    """Drops the indexes created by create_trigram_indexes, if they exist.
+    """
+    for index_name, _, _ in indexes:
+        schema_editor.execute('DROP INDEX IF EXISTS {}'.format(index_name))
+
+
+class AutocompleteMixin(object):
+    """Mixin for GenericViewSet that adds the autocomplete list route, used by the forms to
+    suggest objects while the user types:
+    GET .../autocomplete/?term=<text>&limit=<n> returns [{'id': 1, 'label': '...'}, ...]
+
+    The objects whose autocomplete_fields start with the term come first, followed by the
+    ones similar to it according to pg_trgm, which also matches typos and words in the
+    middle of the text. The trigram GIN indexes over UPPER(field) serve both conditions.
+    Databases without pg_trgm fall back to a case insensitive contains. The filters of
+    filter_class can be used to narrow the suggestions, e.g. the contacts of a client.
+
+    Attributes
+    ----------
+    autocomplete_fields: tuple
+        Text fields matched against the term
+    autocomplete_label: string
+        Format of the label, it receives the values of autocomplete_label_fields
+    autocomplete_label_fields: tuple
+        Fields used by autocomplete_label, autocomplete_fields when not declared
+    """
+    autocomplete_fields = ()
+    autocomplete_label = '{name}'
+    autocomplete_label_fields = None
+    autocomplete_limit = 10
+    autocomplete_max_limit = 50
+
+    def get_autocomplete_limit(self, request):
+        try:
+            limit = int(request.query_params[AUTOCOMPLETE_LIMIT_QUERY_PARAM])
+        except (KeyError, ValueError):
+            return self.autocomplete_limit
+        if limit <= 0:
+            return self.autocomplete_limit
+        return min(limit, self.autocomplete_max_limit)
+
+    def autocomplete_queryset(self, queryset, term):
+        """Returns the objects of the queryset that match the term, best matches first.
+        """
+        prefix_filter = Q()
+        for field in self.autocomplete_fields:
+            prefix_filter |= Q(**{'{}__istartswith'.format(field): term})
+        queryset = queryset.annotate(autocomplete_prefix=Case(
+            When(prefix_filter, then=Value(1)), default=Value(0), output_field=IntegerField()))
+        ordering = ['-autocomplete_prefix']
+        if has_trigram_support():
+            uppercase = {'autocomplete_{}'.format(field): Upper(field)
+                         for field in self.autocomplete_fields}
+            match_filter = Q()
+            for name in uppercase:
+                match_filter |= Q(**{'{}__trigram_similar'.format(name): term.upper()})
+            similarities = [TrigramSimilarity(field, term) for field in self.autocomplete_fields]
+            if len(similarities) == 1:
+                similarity = similarities[0]
+            else:
+                similarity = Greatest(*similarities)
+            queryset = queryset.annotate(autocomplete_similarity=similarity, **uppercase)
+            ordering.append('-autocomplete_similarity')
+        else:
+            match_filter = Q()
+            for field in self.autocomplete_fields:
+                match_filter |= Q(**{'{}__icontains'.format(field): term})
+        ordering.extend(self.autocomplete_fields)
+        return queryset.filter(prefix_filter | match_filter).order_by(*ordering)
+
+    @list_route(methods=['get'], url_path='autocomplete')
+    def autocomplete(self, request):
+        term = request.query_params.get(AUTOCOMPLETE_QUERY_PARAM, '').strip()
+        if not term:
+            return Response([], status.HTTP_200_OK)
+        queryset = self.filter_queryset(self.queryset.all())
+        label_fields = self.autocomplete_label_fields or self.autocomplete_fields
+        rows = self.autocomplete_queryset(queryset, term).values('id', *label_fields)
+        return Response([{'id': row['id'], 'label': self.autocomplete_label.format(**row)}
+                         for row in rows[:self.get_autocomplete_limit(request)]],
+                        status.HTTP_200_OK)
+
+
+class CommitHooksTestMixin(object):
+    """Mixin for TestCase classes, which never commit, to run the on_commit callbacks of the
+    test by hand.
+    """
+
+    def clear_commit_hooks(self):
+        """Drops the on_commit callbacks registered so far, e.g. by setUp.
+        """
+        connection.run_on_commit = []
+
+    def run_commit_hooks(self):
+        """Runs and drops the on_commit callbacks registered so far.
+        """
+        callbacks = [callback for _, callback in connection.run_on_commit]
+        connection.run_on_commit = []
+        for callback in callbacks:
+            callback()
+
+
 class GenericAPITest(APITestCase):
     """Tests to verify the basic usage of the REST API to create, modify and list objects.
     To use, a new class that inherits from utils.GenericAPITest has to be declared.
@@ -272,6 +1145,7 @@ class GenericAPITest(APITestCase):
         response = self.view(request, pk=edit_obj_instance.id)
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual({'id': edit_obj_instance.id}, response.data)
 
         request = self.factory.get(reverse(self.url_list))
         token = Token.objects.get(user=self.user)
@@ -0,0 +1,89 @@
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from balarco import utils
+from clients.models import Client, Contact
+from clients.views import ContactViewSet
+
+
+class Command(BaseCommand):
+    """Measures ContactViewSet.autocomplete while the contacts table grows.
+    Besides the whole request, it reports the time of the query that finds the suggestions.
+    Without the pg_trgm extension the route falls back to a case insensitive contains,
+    which can't use an index, so the timings are only representative of production when
+    the extension and the trigram indexes are installed; the first line says which case
+    was measured.
+    Every row is created inside a transaction that is rolled back at the end, so it can
+    be run against a development database without leaving data behind.
+
+    e.g: python manage.py benchmark_autocomplete --sizes 1000 10000 100000 --term Herna
+    """
+    help = 'Benchmarks the contacts autocomplete endpoint for growing numbers of contacts.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000, 100000],
+                            help='Total number of contacts to measure at.')
+        parser.add_argument('--repeat', type=int, default=5,
+                            help='Number of requests made at each size.')
+        parser.add_argument('--term', default='Hernandes',
+                            help='Term the user types, a typo of one of the seeded names.')
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Number of rows inserted per statement while seeding.')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.run_benchmark(sorted(options['sizes']), options['repeat'], options['term'],
+                               options['batch_size'])
+            transaction.set_rollback(True)
+
+    def run_benchmark(self, sizes, repeat, term, batch_size):
+        user = User.objects.create_user(username='benchmark_autocomplete')
+        client = Client.objects.create(name='Benchmark', address='Benchmark')
+        last_names = ['Hernandez', 'Garcia', 'Martinez', 'Lopez', 'Gonzalez', 'Perez',
+                      'Rodriguez', 'Sanchez', 'Ramirez', 'Cruz']
+
+        view = ContactViewSet.as_view({'get': 'autocomplete'})
+        factory = APIRequestFactory()
+
+        self.stdout.write('pg_trgm: {}'.format('yes' if utils.has_trigram_support() else
+                                               'no, contains fallback'))
+        self.stdout.write('{:>10} {:>12} {:>12} {:>12} {:>9} {:>10}'.format(
+            'contacts', 'median ms', 'max ms', 'query ms', 'queries', 'returned'))
+        total = 0
+        for size in sizes:
+            while total < size:
+                batch = min(batch_size, size - total)
+                Contact.objects.bulk_create([
+                    Contact(client=client, name='Contact{}'.format(total + idx),
+                            last_name=last_names[(total + idx) % len(last_names)],
+                            charge='Benchmark', landline='0', mobile_phone_1='0',
+                            email='contact{}@example.com'.format(total + idx))
+                    for idx in range(batch)])
+                total += batch
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE clients_contact;')
+
+            timings = []
+            query_timings = []
+            for _ in range(repeat):
+                request = factory.get('/api/clients/contacts/autocomplete/',
+                                      data={utils.AUTOCOMPLETE_QUERY_PARAM: term})
+                force_authenticate(request, user=user)
+                with CaptureQueriesContext(connection) as context:
+                    start = time.perf_counter()
+                    response = view(request)
+                    response.render()
+                    timings.append((time.perf_counter() - start) * 1000)
+                query_timings.append(float(next(
+                    query['time'] for query in context.captured_queries
+                    if 'FROM "clients_contact"' in query['sql'])) * 1000)
+            self.stdout.write('{:>10} {:>12.2f} {:>12.2f} {:>12.2f} {:>9} {:>10}'.format(
+                total, statistics.median(timings), max(timings),
+                statistics.median(query_timings), len(context.captured_queries),
+                len(response.data)))
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clients', '0007_auto_20170222_0417'),
+    ]
+
+    operations = [
+        migrations.RunSQL('CREATE INDEX clients_contact_active_client_idx ON clients_contact '
+                          '(client_id) WHERE is_active',
+                          'DROP INDEX clients_contact_active_client_idx'),
+    ]
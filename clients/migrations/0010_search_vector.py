@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-18 10:05
+from __future__ import unicode_literals
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+CLIENT_SEARCH_SQL = """
+CREATE FUNCTION clients_client_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('spanish', coalesce(NEW.name, '')), 'A') ||
+        setweight(to_tsvector('spanish', coalesce(NEW.address, '')), 'B');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER clients_client_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF name, address ON clients_client
+    FOR EACH ROW EXECUTE PROCEDURE clients_client_search_vector_update();
+UPDATE clients_client SET name = name;
+CREATE INDEX clients_client_search_vector_idx ON clients_client USING gin (search_vector);
+"""
+
+CLIENT_SEARCH_REVERSE_SQL = """
+DROP INDEX clients_client_search_vector_idx;
+DROP TRIGGER clients_client_search_vector_trigger ON clients_client;
+DROP FUNCTION clients_client_search_vector_update();
+"""
+
+CONTACT_SEARCH_SQL = """
+CREATE FUNCTION clients_contact_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('spanish', coalesce(NEW.name, '') || ' ' ||
+                                         coalesce(NEW.last_name, '')), 'A') ||
+        setweight(to_tsvector('spanish', coalesce(NEW.charge, '') || ' ' ||
+                                         coalesce(NEW.email, '')), 'B');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER clients_contact_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF name, last_name, charge, email ON clients_contact
+    FOR EACH ROW EXECUTE PROCEDURE clients_contact_search_vector_update();
+UPDATE clients_contact SET name = name;
+CREATE INDEX clients_contact_search_vector_idx ON clients_contact USING gin (search_vector);
+"""
+
+CONTACT_SEARCH_REVERSE_SQL = """
+DROP INDEX clients_contact_search_vector_idx;
+DROP TRIGGER clients_contact_search_vector_trigger ON clients_contact;
+DROP FUNCTION clients_contact_search_vector_update();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clients', '0009_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='client',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='contact',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunSQL(CLIENT_SEARCH_SQL, CLIENT_SEARCH_REVERSE_SQL),
+        migrations.RunSQL(CONTACT_SEARCH_SQL, CONTACT_SEARCH_REVERSE_SQL),
+    ]
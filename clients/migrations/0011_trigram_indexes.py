@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-18 11:20
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+from balarco import utils
+
+# (index name, table, column) of the trigram indexes used by the autocomplete routes
+TRIGRAM_INDEXES = (
+    ('clients_client_name_trgm_idx', 'clients_client', 'name'),
+    ('clients_contact_name_trgm_idx', 'clients_contact', 'name'),
+    ('clients_contact_last_name_trgm_idx', 'clients_contact', 'last_name'),
+    ('clients_contact_email_trgm_idx', 'clients_contact', 'email'),
+)
+
+
+def create_trigram_indexes(apps, schema_editor):
+    utils.create_trigram_indexes(schema_editor, TRIGRAM_INDEXES, 'clients 0010_search_vector')
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    utils.drop_trigram_indexes(schema_editor, TRIGRAM_INDEXES)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clients', '0010_search_vector'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
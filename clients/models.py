@@ -1,15 +1,21 @@
-import json
+from django.contrib.postgres.search import SearchVectorField
+from django.db import models, transaction
 
-from django.db import models
-from channels import Group
-
-from balarco import utils
+from balarco import broadcasts, utils
 
 
 class Client(models.Model):
+    SOFT_DELETE_CASCADE = ('contacts',)
+    TABLE_CHANGE = ('clients-table', utils.NOTIF_TYPE_CLIENTS_TABLE_CHANGE,
+                    "Se ha actualizado la tabla de clientes",
+                    'clients.serializers.ClientSerializer')
+
     name = models.CharField(max_length=100)
     address = models.CharField(max_length=100)
     is_active = models.BooleanField(default=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+    # Spanish full-text index kept current by a trigger of the database, see migration 0010
+    search_vector = SearchVectorField(null=True, editable=False)
 
     def __str__(self):
         return '{}'.format(self.name)
@@ -19,25 +25,23 @@ class Client(models.Model):
         Override of save function.
         If the is_active field is false, it means that the object was deleted so it starts
         a CASCADE soft deletion over all model dependencies.
+        Everything happens in a transaction so the table change messages of the client and
+        its contacts are sent together once it commits.
         """
-        if not self.is_active:
-            queryset = Contact.objects.filter(client=self)
-            for contact in queryset:
-                contact.is_active = False
-                contact.save()
-        super(Client, self).save(*args, **kwargs)
-        """Sends a notification to the user.
-        """
-        notification = {
-            'notif_type': utils.NOTIF_TYPE_CLIENTS_TABLE_CHANGE,
-            'text': "Se ha actualizado la tabla de clientes",
-        }
-        Group('clients-table').send({
-            'text': json.dumps(notification),
-            })
+        created = self.pk is None
+        with transaction.atomic():
+            super(Client, self).save(*args, **kwargs)
+            if not self.is_active:
+                utils.cascade_soft_delete(Client, [self.id])
+            broadcasts.table_changed(*self.TABLE_CHANGE, ids=[self.id],
+                                     operation=broadcasts.get_operation(created, self.is_active))
 
 
 class Contact(models.Model):
+    TABLE_CHANGE = ('contacts-table', utils.NOTIF_TYPE_CONTACTS_TABLE_CHANGE,
+                    "Se ha actualizado la tabla de contactos",
+                    'clients.serializers.ContactSerializer')
+
     client = models.ForeignKey(Client, related_name='contacts', on_delete=models.CASCADE)
 
     name = models.CharField(max_length=255)
@@ -50,6 +54,9 @@ class Contact(models.Model):
     email = models.EmailField(max_length=255)
     alternate_email = models.EmailField(max_length=255, blank=True)
     is_active = models.BooleanField(default=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+    # Spanish full-text index kept current by a trigger of the database, see migration 0010
+    search_vector = SearchVectorField(null=True, editable=False)
 
     def __str__(self):
         return '{} {}'.format(self.name, self.last_name)
@@ -57,13 +64,7 @@ class Contact(models.Model):
     def save(self, *args, **kwargs):
         """Override of save function.
         """
+        created = self.pk is None
         super(Contact, self).save(*args, **kwargs)
-        """Sends a notification to the user.
-        """
-        notification = {
-            'notif_type': utils.NOTIF_TYPE_CONTACTS_TABLE_CHANGE,
-            'text': "Se ha actualizado la tabla de contactos",
-        }
-        Group('contacts-table').send({
-            'text': json.dumps(notification),
-            })
+        broadcasts.table_changed(*self.TABLE_CHANGE, ids=[self.id],
+                                 operation=broadcasts.get_operation(created, self.is_active))
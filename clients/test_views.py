@@ -1,7 +1,10 @@
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
+from django.test import override_settings
 
-from rest_framework.test import APIRequestFactory
+from rest_framework import status
+from rest_framework.test import APIRequestFactory, force_authenticate
+from rest_framework.authtoken.models import Token
 
 from .models import Client, Contact
 from .views import ContactViewSet, ClientViewSet
@@ -97,6 +100,34 @@ class ContactTest(utils.GenericAPITest):
         self.url_detail = 'clients:contacts-detail'
         self.factory = APIRequestFactory()
 
+    def test_autocomplete(self):
+        """Test that autocomplete matches the name, the last name and the email of the
+        contacts, and that the contacts can be narrowed to the ones of a client.
+        """
+        other_client = Client.objects.create(name='Test OXXO', address='Reforma 190')
+        other_hector = Contact.objects.create(
+            name='Hector', last_name='Lopez', charge='Manager', landline='4471172395',
+            mobile_phone_1='26416231', email='hector@oxxo.com', client=other_client)
+        autocomplete_view = ContactViewSet.as_view({'get': 'autocomplete'})
+        token = Token.objects.get(user=self.user)
+        hector = self.test_objects[1]
+
+        def autocomplete(**data):
+            request = self.factory.get(reverse('clients:contacts-autocomplete'), data=data)
+            force_authenticate(request, user=self.user, token=token)
+            response = autocomplete_view(request)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return response.data
+
+        self.assertEqual([{'id': hector.id, 'label': 'Hector Sanchez (hector@eldominio.com)'}],
+                         autocomplete(**{utils.AUTOCOMPLETE_QUERY_PARAM: 'sanch'}))
+        self.assertEqual([hector.id], [obj['id'] for obj in autocomplete(
+            **{utils.AUTOCOMPLETE_QUERY_PARAM: 'eldominio'})])
+        self.assertEqual(sorted([hector.id, other_hector.id]), sorted(
+            obj['id'] for obj in autocomplete(**{utils.AUTOCOMPLETE_QUERY_PARAM: 'hector'})))
+        self.assertEqual([hector.id], [obj['id'] for obj in autocomplete(
+            client=hector.client_id, **{utils.AUTOCOMPLETE_QUERY_PARAM: 'hector'})])
+
 
 class ClientTest(utils.GenericAPITest):
     """
@@ -157,3 +188,200 @@ class ClientTest(utils.GenericAPITest):
         self.url_list = 'clients:clients-list'
         self.url_detail = 'clients:clients-detail'
         self.factory = APIRequestFactory()
+
+    def test_cursor_pagination(self):
+        """Test that clients are paginated by cursor only when a page is requested.
+        """
+        for idx in range(3):
+            Client.objects.create(name='Client {}'.format(idx), address='Address')
+        token = Token.objects.get(user=self.user)
+
+        request = self.factory.get(reverse(self.url_list), data={'page_size': 2})
+        force_authenticate(request, user=self.user, token=token)
+        response = self.view(request)
+        self.assertEqual(2, len(response.data['results']))
+        self.assertIsNone(response.data['previous'])
+        first_page_ids = [obj['id'] for obj in response.data['results']]
+        self.assertEqual(sorted(first_page_ids, reverse=True), first_page_ids)
+
+        received_ids = list(first_page_ids)
+        next_link = response.data['next']
+        while next_link is not None:
+            request = self.factory.get(next_link)
+            force_authenticate(request, user=self.user, token=token)
+            response = self.view(request)
+            received_ids += [obj['id'] for obj in response.data['results']]
+            next_link = response.data['next']
+
+        expected_ids = list(Client.objects.filter(is_active=True)
+                            .order_by('-id').values_list('id', flat=True))
+        self.assertEqual(expected_ids, received_ids)
+
+    def conditional_get(self, url, pk=None, **headers):
+        """Makes a GET request to the list, or to the detail of the client pk.
+        """
+        request = self.factory.get(url, **headers)
+        force_authenticate(request, user=self.user, token=Token.objects.get(user=self.user))
+        if pk is None:
+            return self.view(request)
+        return ClientViewSet.as_view({'get': 'retrieve'})(request, pk=pk)
+
+    def test_conditional_get(self):
+        """Test that list and detail answer 304 until the clients change.
+        """
+        obj = self.test_objects[0]
+
+        for url, pk in ((reverse(self.url_list), None),
+                        (reverse(self.url_detail, kwargs={'pk': obj.id}), obj.id)):
+            response = self.conditional_get(url, pk)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            etag = response['ETag']
+            self.assertIn('Last-Modified', response)
+
+            response = self.conditional_get(url, pk, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertEqual(etag, response['ETag'])
+
+            obj.name = '{} edited'.format(obj.name)
+            obj.save()
+            response = self.conditional_get(url, pk, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotEqual(etag, response['ETag'])
+
+    def test_conditional_get_after_delete(self):
+        """Test that the list doesn't answer 304 to If-Modified-Since after a client that
+        isn't the latest changed one is deleted, while the detail still does.
+        """
+        deleted, latest = self.test_objects[0], self.test_objects[1]
+        latest.save()
+
+        list_url = reverse(self.url_list)
+        detail_url = reverse(self.url_detail, kwargs={'pk': latest.id})
+        last_modified = self.conditional_get(list_url)['Last-Modified']
+        detail_last_modified = self.conditional_get(detail_url, latest.id)['Last-Modified']
+
+        Client.objects.filter(pk=deleted.pk).update(is_active=False)
+        response = self.conditional_get(list_url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn(deleted.id, [obj['id'] for obj in response.data])
+        response = self.conditional_get(detail_url, latest.id,
+                                        HTTP_IF_MODIFIED_SINCE=detail_last_modified)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    @override_settings(DELTA_SYNC_MARGIN=0)
+    def test_delta_sync(self):
+        """Test that ?since= returns only the clients changed or deleted after the cursor.
+        """
+        token = Token.objects.get(user=self.user)
+
+        def get_changes(since):
+            request = self.factory.get(reverse(self.url_list),
+                                       data={utils.SINCE_QUERY_PARAM: since})
+            force_authenticate(request, user=self.user, token=token)
+            response = self.view(request)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return response.data
+
+        response_data = get_changes('2000-01-01T00:00:00Z')
+        self.assertEqual(self.number_of_initial_objects, len(response_data['results']))
+        self.assertEqual([], response_data['deleted'])
+
+        edited, deleted = self.test_objects[0], self.test_objects[1]
+        edited.name = 'Edited'
+        edited.save()
+        deleted.is_active = False
+        deleted.save()
+        new_client = Client.objects.create(name='New client', address='Address')
+
+        response_data = get_changes(response_data['cursor'])
+        self.assertEqual(sorted([edited.id, new_client.id]),
+                         sorted(obj['id'] for obj in response_data['results']))
+        self.assertEqual([deleted.id], response_data['deleted'])
+
+        response_data = get_changes(response_data['cursor'])
+        self.assertEqual([], response_data['results'])
+        self.assertEqual([], response_data['deleted'])
+
+    def test_search(self):
+        """Test that ?q= returns the matching clients, the best matches first and paginated by
+        relevance.
+        """
+        by_name = Client.objects.create(name='Diseños Gráficos', address='Zaragoza 12')
+        by_address = Client.objects.create(name='Imprenta Morales', address='Plaza del Diseño')
+        for idx in range(3):
+            Client.objects.create(name='Diseño {}'.format(idx), address='Juárez 10')
+        token = Token.objects.get(user=self.user)
+
+        request = self.factory.get(reverse(self.url_list), data={utils.SEARCH_QUERY_PARAM:
+                                                                 'diseño'})
+        force_authenticate(request, user=self.user, token=token)
+        response = self.view(request)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        ids = [obj['id'] for obj in response.data]
+        self.assertEqual(5, len(ids))
+        self.assertIn(by_name.id, ids)
+        self.assertEqual(by_address.id, ids[-1])
+
+        request = self.factory.get(reverse(self.url_list), data={utils.SEARCH_QUERY_PARAM:
+                                                                 'diseño', 'page_size': 2})
+        force_authenticate(request, user=self.user, token=token)
+        response = self.view(request)
+        received_ids = [obj['id'] for obj in response.data['results']]
+        while response.data['next'] is not None:
+            request = self.factory.get(response.data['next'])
+            force_authenticate(request, user=self.user, token=token)
+            response = self.view(request)
+            received_ids += [obj['id'] for obj in response.data['results']]
+        self.assertEqual(ids, received_ids)
+
+    def test_autocomplete(self):
+        """Test that autocomplete returns the ids and labels of the matching clients, the ones
+        starting with the term first.
+        """
+        contains = Client.objects.create(name='Grupo Starbucks', address='Address')
+        Client.objects.create(name='Starbucks eliminado', address='Address', is_active=False)
+        autocomplete_view = ClientViewSet.as_view({'get': 'autocomplete'})
+        token = Token.objects.get(user=self.user)
+
+        def autocomplete(**data):
+            request = self.factory.get(reverse('clients:clients-autocomplete'), data=data)
+            force_authenticate(request, user=self.user, token=token)
+            response = autocomplete_view(request)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return response.data
+
+        response_data = autocomplete(**{utils.AUTOCOMPLETE_QUERY_PARAM: 'grupo star'})
+        self.assertEqual({'id': contains.id, 'label': 'Grupo Starbucks'}, response_data[0])
+        response_data = autocomplete(**{utils.AUTOCOMPLETE_QUERY_PARAM: 'STARBUCKS'})
+        self.assertEqual(sorted([self.test_objects[0].id, contains.id]),
+                         sorted(obj['id'] for obj in response_data))
+        response_data = autocomplete(**{utils.AUTOCOMPLETE_QUERY_PARAM: 'starbucks',
+                                        utils.AUTOCOMPLETE_LIMIT_QUERY_PARAM: 1})
+        self.assertEqual(1, len(response_data))
+        self.assertEqual([], autocomplete(**{utils.AUTOCOMPLETE_QUERY_PARAM: ' '}))
+
+    def test_autocomplete_typos(self):
+        """Test that autocomplete also suggests the clients whose name is similar to the term,
+        which needs the pg_trgm extension.
+        """
+        if not utils.has_trigram_support():
+            self.skipTest('The pg_trgm extension is not installed')
+        autocomplete_view = ClientViewSet.as_view({'get': 'autocomplete'})
+        request = self.factory.get(reverse('clients:clients-autocomplete'),
+                                   data={utils.AUTOCOMPLETE_QUERY_PARAM: 'Starbuks'})
+        force_authenticate(request, user=self.user, token=Token.objects.get(user=self.user))
+        response = autocomplete_view(request)
+        self.assertEqual([self.test_objects[0].id], [obj['id'] for obj in response.data])
+
+    def test_delete_object_returning_list(self):
+        """Test that the remaining objects are returned when a delete asks for them.
+        """
+        obj = self.test_objects[self.edition_obj_idx]
+        url = '{}?{}=true'.format(reverse(self.url_detail, kwargs={'pk': obj.id}),
+                                  utils.RETURN_LIST_QUERY_PARAM)
+        request = self.factory.delete(url)
+        force_authenticate(request, user=self.user, token=Token.objects.get(user=self.user))
+        response = self.view(request, pk=obj.id)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.number_of_initial_objects - 1, len(response.data))
@@ -1,4 +1,13 @@
-from django.test import TestCase
+import json
+
+from channels import Channel, Group
+from channels.tests import ChannelTestCase
+from django.db import connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from balarco import broadcasts, utils
+from works.models import PendingTableChange
 from .models import Client, Contact
 
 
@@ -42,3 +51,148 @@ class ContactTestCase(ClientTestCase):
         client_instance = Contact.objects.get(name='Fernando')
         starbucks = Client.objects.get(name='Test Starbucks')
         self.assertEqual(client_instance.client, starbucks)
+
+
+@override_settings(TABLE_CHANGE_BROADCAST_WINDOW=0)
+class TableChangeBroadcastTestCase(utils.CommitHooksTestMixin, ChannelTestCase):
+    """Tests that the table change messages of a transaction are queued after it commits
+    and that the consumers send them together once the broadcast window ends.
+    """
+
+    def setUp(self):
+        self.client_obj = Client.objects.create(name='Test Starbucks',
+                                                address='Felipe Ángeles 225')
+        self.contacts = [Contact.objects.create(
+            name='Contact {}'.format(idx), last_name='Last name', charge='Manager',
+            landline='4471172395', mobile_phone_1='26416231', email='contact@example.com',
+            client=self.client_obj) for idx in range(3)]
+        self.clear_commit_hooks()
+        Group('clients-table').add('test-clients')
+        Group('contacts-table').add('test-contacts')
+
+    def store_table_changes(self):
+        """Runs the consumer that stores the changes queued by the commit hooks, and the
+        commit hooks it registers.
+        """
+        message = self.get_next_message(broadcasts.TABLE_CHANGES_CHANNEL, require=True)
+        while message is not None:
+            broadcasts.store_table_changes(message)
+            message = self.get_next_message(broadcasts.TABLE_CHANGES_CHANNEL)
+        self.run_commit_hooks()
+
+    def send_table_changes(self):
+        """Runs the consumers that store the changes queued by the commit hooks and that
+        send them.
+        """
+        self.store_table_changes()
+        message = self.get_next_message(broadcasts.TABLE_CHANGES_FLUSH_CHANNEL, require=True)
+        broadcasts.send_table_changes(message)
+        self.assertIsNone(self.get_next_message(broadcasts.TABLE_CHANGES_FLUSH_CHANNEL))
+        self.assertFalse(PendingTableChange.objects.exists())
+
+    def test_client_deletion_is_broadcast_once(self):
+        self.client_obj.is_active = False
+        self.client_obj.save()
+        self.assertIsNone(self.get_next_message(broadcasts.TABLE_CHANGES_CHANNEL))
+
+        self.run_commit_hooks()
+        self.send_table_changes()
+        message = json.loads(self.get_next_message('test-contacts', require=True)['text'])
+        self.assertEqual(utils.NOTIF_TYPE_CONTACTS_TABLE_CHANGE, message['notif_type'])
+        self.assertEqual(sorted(contact.id for contact in self.contacts), message['ids'])
+        self.assertEqual(['delete'] * 3, [event['operation'] for event in message['events']])
+        self.assertIsNone(self.get_next_message('test-contacts'))
+        message = json.loads(self.get_next_message('test-clients', require=True)['text'])
+        self.assertEqual([self.client_obj.id], message['ids'])
+        self.assertIsNone(self.get_next_message('test-clients'))
+
+    def test_events_carry_the_changed_rows(self):
+        contact = Contact.objects.create(
+            name='New', last_name='Contact', charge='Manager', landline='4471172395',
+            mobile_phone_1='26416231', email='contact@example.com', client=self.client_obj)
+        contact.charge = 'Director'
+        contact.save()
+        self.contacts[0].name = 'Edited'
+        self.contacts[0].save()
+        self.run_commit_hooks()
+        self.send_table_changes()
+
+        message = json.loads(self.get_next_message('test-contacts', require=True)['text'])
+        events = {event['id']: event for event in message['events']}
+        self.assertEqual({self.contacts[0].id, contact.id}, set(events))
+        self.assertEqual('create', events[contact.id]['operation'])
+        self.assertEqual('Director', events[contact.id]['data']['charge'])
+        self.assertEqual('update', events[self.contacts[0].id]['operation'])
+        self.assertEqual('Edited', events[self.contacts[0].id]['data']['name'])
+        self.assertEqual('Test Starbucks',
+                         events[contact.id]['data']['client_complete']['name'])
+
+    def test_rolled_back_savepoints_are_not_broadcast(self):
+        self.contacts[0].name = 'Edited'
+        self.contacts[0].save()
+        with transaction.atomic():
+            self.contacts[1].name = 'Rolled back'
+            self.contacts[1].save()
+            transaction.set_rollback(True)
+        self.run_commit_hooks()
+        self.send_table_changes()
+
+        message = json.loads(self.get_next_message('test-contacts', require=True)['text'])
+        self.assertEqual([self.contacts[0].id], message['ids'])
+
+    def test_changes_of_several_transactions_are_sent_together(self):
+        for contact in self.contacts:
+            contact.name = 'Edited'
+            contact.save()
+            self.run_commit_hooks()
+        self.send_table_changes()
+
+        message = json.loads(self.get_next_message('test-contacts', require=True)['text'])
+        self.assertEqual(sorted(contact.id for contact in self.contacts), message['ids'])
+        self.assertIsNone(self.get_next_message('test-contacts'))
+
+    @override_settings(TABLE_CHANGE_BROADCAST_WINDOW=0.5)
+    def test_changes_wait_for_the_window(self):
+        for contact in self.contacts[:2]:
+            contact.name = 'Edited'
+            contact.save()
+            self.run_commit_hooks()
+            self.store_table_changes()
+        delayed = self.get_next_message(broadcasts.DELAY_CHANNEL, require=True)
+        self.assertEqual(broadcasts.TABLE_CHANGES_FLUSH_CHANNEL, delayed['channel'])
+        self.assertEqual(500, delayed['delay'])
+        self.assertIsNone(self.get_next_message(broadcasts.DELAY_CHANNEL))
+        self.assertIsNone(self.get_next_message(broadcasts.TABLE_CHANGES_FLUSH_CHANNEL))
+        self.assertIsNone(self.get_next_message('test-contacts'))
+
+        # What the delay server does once the window ends
+        Channel(delayed['channel']).send(delayed['content'])
+        self.contacts[2].name = 'Edited'
+        self.contacts[2].save()
+        self.run_commit_hooks()
+        self.store_table_changes()
+        broadcasts.send_table_changes(self.get_next_message(
+            broadcasts.TABLE_CHANGES_FLUSH_CHANNEL, require=True))
+
+        message = json.loads(self.get_next_message('test-contacts', require=True)['text'])
+        self.assertEqual(sorted(contact.id for contact in self.contacts), message['ids'])
+        self.assertIsNone(self.get_next_message('test-contacts'))
+        self.assertIsNone(self.get_next_message(broadcasts.DELAY_CHANNEL))
+
+    def test_client_deletion_queries_do_not_grow(self):
+        def count_deletion_queries(client):
+            with CaptureQueriesContext(connection) as context:
+                client.is_active = False
+                client.save()
+            return len(context.captured_queries)
+
+        initial_queries = count_deletion_queries(self.client_obj)
+        client = Client.objects.create(name='Test OXXO', address='Reforma 190')
+        for idx in range(10):
+            Contact.objects.create(name='Contact {}'.format(idx), last_name='Last name',
+                                   charge='Manager', landline='4471172395',
+                                   mobile_phone_1='26416231', email='contact@example.com',
+                                   client=client)
+
+        self.assertEqual(initial_queries, count_deletion_queries(client))
+        self.assertFalse(Contact.objects.filter(is_active=True).exists())
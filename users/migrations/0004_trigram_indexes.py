@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-18 11:20
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+from balarco import utils
+
+# (index name, table, column) of the trigram indexes used by the autocomplete route
+TRIGRAM_INDEXES = (
+    ('users_user_first_name_trgm_idx', 'auth_user', 'first_name'),
+    ('users_user_last_name_trgm_idx', 'auth_user', 'last_name'),
+)
+
+
+def create_trigram_indexes(apps, schema_editor):
+    utils.create_trigram_indexes(schema_editor, TRIGRAM_INDEXES, 'users 0003_auto_20170217_0137')
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    utils.drop_trigram_indexes(schema_editor, TRIGRAM_INDEXES)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0003_auto_20170217_0137'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
@@ -1,11 +1,14 @@
-import json
+import collections
 
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, transaction
 from django.db.models.signals import post_save
-from channels import Group
 
-from balarco import utils
+from balarco import broadcasts, utils
+from .signals import users_bulk_changed
+
+TABLE_CHANGE = ('users-table', utils.NOTIF_TYPE_USERS_TABLE_CHANGE,
+                "Se ha actualizado la tabla de usuarios", 'users.serializers.UserSerializer')
 
 
 class UserProfile(models.Model):
@@ -13,16 +16,149 @@ class UserProfile(models.Model):
     profile_picture = models.ImageField(upload_to='media/profile_pictures')
 
 
-def save_profile(sender, instance, **kwargs):
+def save_profile(sender, instance, created, **kwargs):
     """Sends a notification to the user.
     """
-    notification = {
-        'notif_type': utils.NOTIF_TYPE_USERS_TABLE_CHANGE,
-        'text': "Se ha actualizado la tabla de usuarios",
-    }
-    Group('users-table').send({
-        'text': json.dumps(notification),
-        })
+    broadcasts.table_changed(*TABLE_CHANGE, ids=[instance.id],
+                             operation=broadcasts.get_operation(created, instance.is_active))
 
 
 post_save.connect(save_profile, sender=User)
+
+
+def set_groups(group_ids_by_user):
+    """Sets the groups of several users with a single diff of the users-groups table: one
+    query reads their current rows, one INSERT adds the missing ones and one DELETE removes
+    the ones that are no longer selected. users_bulk_changed is sent with the users whose
+    groups changed.
+
+    Parameters
+    ----------
+    group_ids_by_user: dict
+        Ids of the groups that each user must belong to, by user id
+    """
+    if not group_ids_by_user:
+        return
+    through = User.groups.through
+    group_ids_by_user = {user_id: set(group_ids)
+                         for user_id, group_ids in group_ids_by_user.items()}
+    current_group_ids = collections.defaultdict(set)
+    removed_ids = []
+    changed_user_ids = set()
+    with transaction.atomic():
+        rows = through.objects.filter(user_id__in=group_ids_by_user).values_list(
+            'id', 'user_id', 'group_id')
+        for row_id, user_id, group_id in rows:
+            if group_id in group_ids_by_user[user_id]:
+                current_group_ids[user_id].add(group_id)
+            else:
+                removed_ids.append(row_id)
+                changed_user_ids.add(user_id)
+        added = [through(user_id=user_id, group_id=group_id)
+                 for user_id, group_ids in group_ids_by_user.items()
+                 for group_id in sorted(group_ids - current_group_ids[user_id])]
+        if added:
+            through.objects.bulk_create(added)
+        if removed_ids:
+            through.objects.filter(id__in=removed_ids).delete()
+        changed_user_ids.update(row.user_id for row in added)
+        if changed_user_ids:
+            users_bulk_changed.send(sender=User, created_ids=[],
+                                    updated_ids=sorted(changed_user_ids))
+
+
+def provision_users(users_data, reactivate=False):
+    """Creates or updates several users, matched by username, and sets their groups with a
+    handful of statements no matter how many users there are: one query for the existing
+    users, one INSERT for the new ones, one UPDATE for the rest and the groups diff of
+    set_groups. New users without a password can't log in until they reset it.
+    users_bulk_changed is sent with the created and updated users.
+    The users must have been checked with check_provisioning first.
+
+    Parameters
+    ----------
+    users_data: list
+        Validated data of each user, see serializers.UserProvisioningSerializer. The groups
+        of a user are only changed when its data includes them
+    reactivate: bool
+        If True, the inactive existing users are activated again
+
+    Returns
+    -------
+    tuple
+        The created users and the updated users
+    """
+    existing = get_existing_users(users_data)
+    created = []
+    updated = []
+    updated_fields = {'is_active'} if reactivate else set()
+    groups_by_username = {}
+    for data in users_data:
+        data = dict(data)
+        password = data.pop('password', None)
+        if 'groups' in data:
+            groups_by_username[data['username']] = [group.id for group in data.pop('groups')]
+        user = existing.get(data['username'])
+        if user is None:
+            user = User(**data)
+            created.append(user)
+        else:
+            for attr, value in data.items():
+                setattr(user, attr, value)
+            updated_fields.update(data)
+            updated.append(user)
+            if reactivate:
+                user.is_active = True
+        if password:
+            user.set_password(password)
+            updated_fields.add('password')
+        elif user.pk is None:
+            user.set_unusable_password()
+
+    with transaction.atomic():
+        if created:
+            created = User.objects.bulk_create(created)
+        if updated:
+            utils.bulk_update(updated, [User._meta.get_field(field_name)
+                                        for field_name in sorted(updated_fields)])
+        users_bulk_changed.send(sender=User, created_ids=[user.id for user in created],
+                                updated_ids=[user.id for user in updated])
+        users_by_username = {user.username: user for user in created + updated}
+        set_groups({users_by_username[username].id: group_ids
+                    for username, group_ids in groups_by_username.items()})
+        if created:
+            broadcasts.table_changed(*TABLE_CHANGE, ids=[user.id for user in created],
+                                     operation=broadcasts.OPERATION_CREATE)
+        if updated:
+            broadcasts.table_changed(*TABLE_CHANGE, ids=[user.id for user in updated],
+                                     operation=broadcasts.OPERATION_UPDATE)
+    return created, updated
+
+
+def get_existing_users(users_data):
+    """Returns the existing users of the provisioning data, by username, with one query.
+    """
+    usernames = [data['username'] for data in users_data]
+    return {user.username: user for user in User.objects.filter(username__in=usernames)}
+
+
+def check_provisioning(users_data, reactivate=False):
+    """Returns the errors that prevent provisioning each user, in a list with a dict for
+    each one, empty when it can be provisioned: repeated usernames, staff or superuser
+    accounts, which can't be changed through provisioning, and inactive users unless they
+    are reactivated.
+    """
+    existing = get_existing_users(users_data)
+    usernames = [data['username'] for data in users_data]
+    errors = []
+    for username in usernames:
+        user = existing.get(username)
+        if usernames.count(username) > 1:
+            errors.append({'username': ['Repeated username']})
+        elif user is not None and (user.is_staff or user.is_superuser):
+            errors.append({'username': ['Staff accounts can not be provisioned']})
+        elif user is not None and not user.is_active and not reactivate:
+            errors.append({'username': ['Inactive user, send reactivate=true to activate it']})
+        else:
+            errors.append({})
+    return errors
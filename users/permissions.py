@@ -0,0 +1,15 @@
+from rest_framework import permissions
+
+from balarco import utils
+
+
+class IsStaffOrAdministracion(permissions.BasePermission):
+    """Allows the request only to staff users and to the users of the Administración group.
+    """
+
+    def has_permission(self, request, view):
+        user = request.user
+        if user is None or not user.is_authenticated:
+            return False
+        return (user.is_staff or
+                utils.GROUP_ADMINISTRACION in utils.get_request_group_names(request))
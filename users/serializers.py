@@ -23,3 +23,27 @@ class UserSerializer(serializers.ModelSerializer):
                   'last_name',
                   'groups_complete',
                   )
+
+
+class UserProvisioningSerializer(serializers.ModelSerializer):
+    """Validates a user of UserViewSet.provision, which may already exist.
+    The groups are given by name and looked up in the groups_by_name dict of the context, so
+    validating many users doesn't query the groups for each one.
+    """
+
+    # Existing usernames are updated, so they don't have to be unique
+    username = serializers.CharField(max_length=150, validators=[User.username_validator])
+    password = serializers.CharField(write_only=True, required=False, allow_blank=True)
+    groups = serializers.ListField(child=serializers.CharField(), required=False)
+
+    class Meta:
+        model = User
+        fields = ('username', 'password', 'first_name', 'last_name', 'email', 'groups',)
+
+    def validate_groups(self, value):
+        groups_by_name = self.context['groups_by_name']
+        unknown_names = [name for name in value if name not in groups_by_name]
+        if unknown_names:
+            raise serializers.ValidationError(
+                'Unknown groups: {}'.format(', '.join(unknown_names)))
+        return [groups_by_name[name] for name in value]
@@ -0,0 +1,6 @@
+from django.dispatch import Signal
+
+# Sent by provision_users and set_groups, which write the users and their groups with bulk
+# statements that don't send post_save nor m2m_changed. created_ids are the ids of the new
+# users and updated_ids the ids of the existing users whose data or groups changed.
+users_bulk_changed = Signal(providing_args=['created_ids', 'updated_ids'])
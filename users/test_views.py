@@ -1,5 +1,9 @@
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.core.urlresolvers import reverse
-from rest_framework.test import APITestCase, APIRequestFactory
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APITestCase, APIRequestFactory, force_authenticate
 from rest_framework import status
 from django.contrib.auth.models import User, Group
 from . import views, serializers
@@ -149,6 +153,126 @@ class UserAPITest(utils.GenericAPITest):
         self.url_detail = 'users:users-detail'
         self.factory = APIRequestFactory()
 
+    def test_update_groups(self):
+        """Test that updating a user with groups_complete leaves them in exactly those groups.
+        """
+        groups = [Group.objects.create(name=name) for name in ('Group A', 'Group B', 'Group C')]
+        user = self.test_objects[1]
+        user.groups.add(groups[0], groups[1])
+        request = self.factory.patch(reverse(self.url_detail, kwargs={'pk': user.id}),
+                                     {'username': user.username,
+                                      'groups_complete': [{'id': groups[1].id},
+                                                          {'id': groups[2].id}]},
+                                     format='json')
+        force_authenticate(request, user=self.user, token=Token.objects.get(user=self.user))
+        response = self.view(request, pk=user.id)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(['Group B', 'Group C'],
+                         sorted(group['name'] for group in response.data['groups_complete']))
+
+    def test_autocomplete(self):
+        """Test that autocomplete matches the first and last names of the users, and with
+        pg_trgm also the names with typos.
+        """
+        autocomplete_view = views.UserViewSet.as_view({'get': 'autocomplete'})
+        token = Token.objects.get(user=self.user)
+        marco = self.test_objects[1]
+
+        def autocomplete(term):
+            request = self.factory.get(reverse('users:users-autocomplete'),
+                                       data={utils.AUTOCOMPLETE_QUERY_PARAM: term})
+            force_authenticate(request, user=self.user, token=token)
+            response = autocomplete_view(request)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return response.data
+
+        self.assertEqual([{'id': marco.id, 'label': 'Marco Lopez'}], autocomplete('lop'))
+        self.assertEqual([marco.id], [obj['id'] for obj in autocomplete('MARCO')])
+        if utils.has_trigram_support():
+            self.assertEqual([marco.id], [obj['id'] for obj in autocomplete('Lopes')])
+
+    def test_provision(self):
+        """Test that provisioning creates the new users, updates the existing ones and sets
+        their groups, with a number of queries that doesn't depend on the number of users.
+        Only the Administración group can provision, staff accounts are refused and
+        inactive users are only reactivated when asked.
+        """
+        provision_view = views.UserViewSet.as_view({'post': 'provision'})
+        token = Token.objects.get(user=self.user)
+        Group.objects.create(name=utils.GROUP_DISENADOR_JR)
+        Group.objects.create(name=utils.GROUP_DISENADOR_SR)
+        existing = self.test_objects[1]
+        existing.groups.add(Group.objects.create(name=utils.GROUP_EJECUTIVO_JR))
+
+        def provision(data, format='json'):
+            request = self.factory.post(reverse('users:users-provision'), data, format=format)
+            force_authenticate(request, user=self.user, token=token)
+            with CaptureQueriesContext(connection) as context:
+                response = provision_view(request)
+            return response, len(context.captured_queries)
+
+        response, _ = provision([{'username': 'designer@example.com'}])
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.user.groups.add(Group.objects.create(name=utils.GROUP_ADMINISTRACION))
+
+        response, _ = provision([{'username': 'designer@example.com', 'groups': ['Unknown']}])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('groups', response.data[0])
+
+        def designers(start, end):
+            return [{'username': 'designer{}@example.com'.format(idx), 'first_name': 'Designer',
+                     'groups': [utils.GROUP_DISENADOR_JR]} for idx in range(start, end)]
+
+        response, initial_queries = provision(designers(0, 1) + [
+            {'username': existing.username, 'groups': [utils.GROUP_DISENADOR_JR]}])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response, queries = provision(designers(1, 6) + [
+            {'username': existing.username, 'first_name': 'Marco Antonio',
+             'groups': [utils.GROUP_DISENADOR_SR]}])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(initial_queries, queries)
+        self.assertEqual(5, len(response.data['created']))
+        self.assertEqual([existing.id], [user['id'] for user in response.data['updated']])
+        self.assertEqual(6, User.objects.filter(
+            username__startswith='designer', groups__name=utils.GROUP_DISENADOR_JR).count())
+        existing.refresh_from_db()
+        self.assertEqual('Marco Antonio', existing.first_name)
+        self.assertTrue(existing.check_password('marcolopez'))
+        self.assertEqual([utils.GROUP_DISENADOR_SR],
+                         list(existing.groups.values_list('name', flat=True)))
+
+        csv_file = SimpleUploadedFile('users.csv', '\n'.join([
+            'username,password,first_name,last_name,email,groups',
+            'ana@example.com,secret,Ana,Pérez,ana@example.com,{};{}'.format(
+                utils.GROUP_DISENADOR_JR, utils.GROUP_DISENADOR_SR),
+        ]).encode('utf-8'), content_type='text/csv')
+        response, _ = provision({'file': csv_file}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        ana = User.objects.get(username='ana@example.com')
+        self.assertEqual('Pérez', ana.last_name)
+        self.assertTrue(ana.check_password('secret'))
+        self.assertEqual(2, ana.groups.count())
+
+        admin = User.objects.create_user(username='admin@example.com', password='admin',
+                                         is_staff=True)
+        response, _ = provision([{'username': admin.username, 'password': 'changed'}])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('username', response.data[0])
+        admin.refresh_from_db()
+        self.assertTrue(admin.check_password('admin'))
+
+        User.objects.filter(id=ana.id).update(is_active=False)
+        response, _ = provision([{'username': ana.username, 'first_name': 'Anita'}])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(User.objects.get(id=ana.id).is_active)
+        request = self.factory.post(reverse('users:users-provision') + '?reactivate=true',
+                                    [{'username': ana.username}], format='json')
+        force_authenticate(request, user=self.user, token=token)
+        response = provision_view(request)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(User.objects.get(id=ana.id).is_active)
+
 
 class GroupAPITest(utils.GenericAPITest):
     """Tests to verify the basic usage of the REST API to create, modify and list groups.
@@ -1,41 +1,51 @@
+import csv
+import io
+
 from django.contrib.auth.models import Group
 from django.shortcuts import get_object_or_404
 from django.http import Http404
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework import serializers as serializers_library
-from . import models, serializers
+from rest_framework.decorators import list_route
+from . import models, permissions, serializers
 from . import filters as users_filters
 from balarco import utils
 from works.models import Work
 
 
-class UserViewSet(utils.GenericViewSet):
+def read_users_csv(csv_file):
+    """Reads the users of a CSV file uploaded to UserViewSet.provision.
+    Empty passwords are left out and the groups are split by semicolons.
+    """
+    users_data = []
+    for row in csv.DictReader(io.StringIO(csv_file.read().decode('utf-8-sig'))):
+        data = {field: (value or '').strip() for field, value in row.items() if field}
+        if not data.get('password'):
+            data.pop('password', None)
+        if 'groups' in data:
+            data['groups'] = [name.strip() for name in data['groups'].split(';') if name.strip()]
+        users_data.append(data)
+    return users_data
+
+
+class UserViewSet(utils.AutocompleteMixin, utils.GenericViewSet):
     """ViewSet for User CRUD REST Service that inherits from utils.GenericViewSet
     """
     obj_class = models.User
     queryset = models.User.objects.filter(is_active=True)
     serializer_class = serializers.UserSerializer
     filter_class = users_filters.UserFilter
+    autocomplete_fields = ('first_name', 'last_name')
+    autocomplete_label = '{first_name} {last_name}'
 
     def create(self, request, pk=None):
         serializer = self.serializer_class(data=request.data)
         if serializer.is_valid():
+            group_ids = self.get_group_ids(request)
             new_user = self.obj_class.objects.create_user(**serializer.validated_data)
-            if 'groups_complete' not in request.data:
-                return Response(self.serializer_class(new_user).data, status.HTTP_201_CREATED)
-            groups = request.data['groups_complete']
-            selected_groups = []
-            for group in groups:
-                group_id = group['id']
-                current_group = Group.objects.get(id=group_id)
-                current_group.user_set.add(new_user)
-                selected_groups.append(group_id)
-                current_group.save()
-            unselected_groups = Group.objects.exclude(id__in=selected_groups)
-            for group in unselected_groups:
-                group.user_set.remove(new_user)
-                group.save()
+            if group_ids is not None:
+                models.set_groups({new_user.id: group_ids})
             return Response(self.serializer_class(new_user).data, status.HTTP_201_CREATED)
         else:
             return utils.response_object_could_not_be_created(self.obj_class)
@@ -45,21 +55,10 @@ class UserViewSet(utils.GenericViewSet):
         obj = get_object_or_404(queryset, pk=pk)
         serializer = self.serializer_class(obj, data=request.data)
         if serializer.is_valid():
+            group_ids = self.get_group_ids(request)
             updated_user = serializer.save()
-            if 'groups_complete' not in request.data:
-                return Response(self.serializer_class(updated_user).data, status.HTTP_200_OK)
-            groups = request.data['groups_complete']
-            selected_groups = []
-            for group in groups:
-                group_id = group['id']
-                current_group = Group.objects.get(id=group_id)
-                current_group.user_set.add(updated_user)
-                selected_groups.append(group_id)
-                current_group.save()
-            unselected_groups = Group.objects.exclude(id__in=selected_groups)
-            for group in unselected_groups:
-                group.user_set.remove(updated_user)
-                group.save()
+            if group_ids is not None:
+                models.set_groups({updated_user.id: group_ids})
             return Response(self.serializer_class(updated_user).data, status.HTTP_200_OK)
         else:
             return utils.response_object_could_not_be_created(self.obj_class)
@@ -67,6 +66,65 @@ class UserViewSet(utils.GenericViewSet):
     def partial_update(self, request, pk=None):
         return self.update(request, pk)
 
+    def get_group_ids(self, request):
+        """Returns the ids of the groups selected in the groups_complete list of the request,
+        or None if it doesn't have one. Raises a validation error if a group doesn't exist.
+        """
+        if 'groups_complete' not in request.data:
+            return None
+        try:
+            group_ids = {int(group['id']) for group in request.data['groups_complete']}
+        except (KeyError, TypeError, ValueError):
+            raise serializers_library.ValidationError('groups_complete must be a list of groups')
+        if Group.objects.filter(id__in=group_ids).count() != len(group_ids):
+            raise serializers_library.ValidationError('Some of the groups do not exist')
+        return group_ids
+
+    def get_permissions(self):
+        if self.action == 'provision':
+            return [permissions.IsStaffOrAdministracion()]
+        return super(UserViewSet, self).get_permissions()
+
+    @list_route(methods=['post'], url_path='provision')
+    def provision(self, request):
+        """Creates or updates many users at once, matched by username, and sets their groups.
+        Only staff users and the Administración group can provision users, and staff or
+        superuser accounts are never changed. Inactive users are refused unless the
+        ?reactivate=true query param is sent, which activates them again.
+        The users are received as a JSON list or as a CSV file uploaded in the file field,
+        with a header row:
+        username,password,first_name,last_name,email,groups
+        where groups are the names of the groups separated by semicolons, e.g.
+        diseno1@example.com,secret,Ana,Pérez,ana@example.com,Diseñador JR;Diseñador SR
+
+        Every user is validated before writing anything, and none is written if any of them
+        is invalid; the errors are returned in a list with an item for each user, empty for
+        the valid ones. The writes take a handful of statements no matter how many users
+        there are, see models.provision_users.
+        """
+        if 'file' in request.FILES:
+            users_data = read_users_csv(request.FILES['file'])
+        else:
+            users_data = request.data
+        groups_by_name = {group.name: group for group in Group.objects.all()}
+        serializer = serializers.UserProvisioningSerializer(
+            data=users_data, many=True, context={'groups_by_name': groups_by_name})
+        if not serializer.is_valid():
+            return Response(serializer.errors, status.HTTP_400_BAD_REQUEST)
+        reactivate = request.query_params.get('reactivate', '').lower() in ('true', '1')
+        errors = models.check_provisioning(serializer.validated_data, reactivate)
+        if any(errors):
+            return Response(errors, status.HTTP_400_BAD_REQUEST)
+
+        created, updated = models.provision_users(serializer.validated_data, reactivate)
+        queryset = self.obj_class.objects.prefetch_related('groups').order_by('id')
+        return Response({
+            'created': self.serializer_class(
+                queryset.filter(id__in=[user.id for user in created]), many=True).data,
+            'updated': self.serializer_class(
+                queryset.filter(id__in=[user.id for user in updated]), many=True).data,
+        }, status.HTTP_200_OK)
+
     def destroy(self, request, pk=None):
         """Override of destroy method, with raises an exception when the selected
            user to delete belongs to a work object via executive relationship
@@ -75,14 +133,14 @@ class UserViewSet(utils.GenericViewSet):
         obj = get_object_or_404(queryset, pk=pk)
         works_queryset = Work.objects.filter(executive=obj)
         error_message = 'Antes de eliminar al usuario, reasigna todos sus proyectos'
-        if works_queryset.count() > 0:
+        if works_queryset.exists():
             raise serializers_library.ValidationError(error_message)
         else:
             obj.is_active = False
             try:
                 obj.save()
-                serializer = self.serializer_class(queryset, many=True)
-                return Response(serializer.data, status.HTTP_200_OK)
+                return utils.soft_delete_response(request, self.serializer_class, queryset,
+                                                  obj)
             except:
                 raise Http404('No se pudo borrar el usuario en este momento')
 
@@ -14,3 +14,4 @@ admin.site.register(models.File)
 admin.site.register(models.WorkDesigner)
 admin.site.register(models.StatusChange)
 admin.site.register(models.Notification)
+admin.site.register(models.UnreadNotificationCounter)
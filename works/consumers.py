@@ -1,5 +1,8 @@
 from channels import Group
 
+from .models import Notification, UnreadNotificationCounter, purge_notifications
+from .serializers import NotificationSerializer
+
 
 def connect_work(message, pk):
     """When the user opens a WebSocket to a work stream, adds them to the
@@ -41,3 +44,28 @@ def disconnect_igualas_table(message):
     @TODO: Disconnect socket to correct group depending on user id
     """
     Group("igualas-table").discard(message.reply_channel)
+
+
+def send_notifications(message):
+    """Sends the notifications queued by works.models.dispatch_notifications to the group
+    of each user, followed by the updated unread count of the users. It runs on a channels
+    worker, so the requests that create notifications don't wait for them to be delivered.
+    """
+    user_ids = set(message.content.get('user_ids', []))
+    notifications = list(Notification.objects.filter(id__in=message.content['ids']))
+    serialized_notifications = NotificationSerializer(notifications, many=True).data
+    for notification, data in zip(notifications, serialized_notifications):
+        notification.send_notification(data)
+        user_ids.add(notification.user_id)
+    UnreadNotificationCounter.send_counts(user_ids)
+
+
+def run_notifications_purge(message):
+    """Runs works.models.purge_notifications on a channels worker, so the purge can be
+    scheduled by sending a message to works.models.NOTIFICATIONS_PURGE_CHANNEL. The message
+    may contain the days and batch_size to use, and if it has a reply channel the result
+    is sent back to it.
+    """
+    result = purge_notifications(message.content.get('days'), message.content.get('batch_size'))
+    if message.reply_channel is not None:
+        message.reply_channel.send(dict(result._asdict()))
@@ -0,0 +1,106 @@
+import datetime
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from clients.models import Client, Contact
+from works import models, views
+
+
+class Command(BaseCommand):
+    """Measures WorkViewSet.unassigned_works while the works table grows.
+    Only the first --unassigned works in design are left without a designer, so the
+    response size stays the same. Besides the whole request, it reports the time of the
+    query that finds the unassigned works. That query reads the works in design and the
+    active assignments, which here are a fixed share of the table since the statuses are
+    spread evenly, so it still grows with it; the rest of the request (serializing the same
+    works, the nested objects' queries) does not depend on the size of the table.
+    Every row is created inside a transaction that is rolled back at the end, so it can
+    be run against a development database without leaving data behind.
+
+    e.g: python manage.py benchmark_unassigned_works --sizes 1000 10000 100000
+    """
+    help = 'Benchmarks the unassigned_works endpoint for growing numbers of works.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000, 100000],
+                            help='Total number of works to measure at.')
+        parser.add_argument('--repeat', type=int, default=5,
+                            help='Number of requests made at each size.')
+        parser.add_argument('--unassigned', type=int, default=50,
+                            help='Number of works in design left without a designer.')
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Number of rows inserted per statement while seeding.')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.run_benchmark(sorted(options['sizes']), options['repeat'],
+                               options['unassigned'], options['batch_size'])
+            transaction.set_rollback(True)
+
+    def run_benchmark(self, sizes, repeat, unassigned, batch_size):
+        user = User.objects.create_user(username='benchmark_unassigned_works')
+        designer = User.objects.create_user(username='benchmark_unassigned_designer')
+        client = Client.objects.create(name='Benchmark', address='Benchmark')
+        contact = Contact.objects.create(client=client, name='Benchmark', last_name='Benchmark',
+                                         charge='Benchmark', landline='0', mobile_phone_1='0',
+                                         email='benchmark@example.com')
+        work_type = models.WorkType.objects.create(work_type_id=models.WorkType.ID_PROJECT)
+        statuses = [models.Status.objects.create(status_id=status_id)
+                    for status_id, _ in models.Status.STATUS]
+        status_diseno = statuses[models.Status.STATUS_DISENO]
+
+        view = views.WorkViewSet.as_view({'get': 'unassigned_works'})
+        factory = APIRequestFactory()
+
+        self.stdout.write('{:>10} {:>12} {:>12} {:>12} {:>9} {:>10}'.format(
+            'works', 'median ms', 'max ms', 'query ms', 'queries', 'returned'))
+        total = 0
+        unassigned_left = unassigned
+        for size in sizes:
+            while total < size:
+                batch = min(batch_size, size - total)
+                works = models.Work.objects.bulk_create([
+                    models.Work(executive=user, contact=contact, work_type=work_type,
+                                current_status=statuses[(total + idx) % len(statuses)],
+                                creation_date=datetime.date.today(),
+                                name='Benchmark {}'.format(total + idx),
+                                expected_delivery_date=datetime.date.today(),
+                                brief='Benchmark')
+                    for idx in range(batch)])
+                work_designers = []
+                for work in works:
+                    if work.current_status != status_diseno:
+                        continue
+                    if unassigned_left > 0:
+                        unassigned_left -= 1
+                        continue
+                    work_designers.append(models.WorkDesigner(designer=designer, work=work,
+                                                              active_work=True))
+                models.WorkDesigner.objects.bulk_create(work_designers)
+                total += batch
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE works_work; ANALYZE works_workdesigner;')
+
+            timings = []
+            query_timings = []
+            for _ in range(repeat):
+                request = factory.get('/api/works/works/unassigned_works/')
+                force_authenticate(request, user=user)
+                with CaptureQueriesContext(connection) as context:
+                    start = time.perf_counter()
+                    response = view(request)
+                    response.render()
+                    timings.append((time.perf_counter() - start) * 1000)
+                query_timings.append(float(next(
+                    query['time'] for query in context.captured_queries
+                    if 'FROM "works_work"' in query['sql'])) * 1000)
+            self.stdout.write('{:>10} {:>12.2f} {:>12.2f} {:>12.2f} {:>9} {:>10}'.format(
+                total, statistics.median(timings), max(timings),
+                statistics.median(query_timings), len(context.captured_queries),
+                len(response.data)))
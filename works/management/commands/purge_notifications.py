@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from works import models
+
+
+class Command(BaseCommand):
+    """Deletes the seen notifications older than the retention period in small batches,
+    optionally appending them to a CSV file first, and reports how many were removed and
+    how long it took. It is meant to be run periodically, e.g. from cron.
+
+    e.g: python manage.py purge_notifications --days 90 --archive notifications.csv
+    """
+    help = 'Deletes old seen notifications in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help='Age in days of the notifications to delete, '
+                                 'NOTIFICATION_RETENTION_DAYS by default.')
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help='Number of notifications deleted per statement, '
+                                 'NOTIFICATION_PURGE_BATCH_SIZE by default.')
+        parser.add_argument('--archive', default=None,
+                            help='CSV file the deleted notifications are appended to.')
+
+    def handle(self, *args, **options):
+        if options['archive']:
+            with open(options['archive'], 'a', newline='') as archive:
+                result = models.purge_notifications(options['days'], options['batch_size'],
+                                                    archive)
+        else:
+            result = models.purge_notifications(options['days'], options['batch_size'])
+        self.stdout.write('Removed {} notifications in {} batches in {:.2f} s'.format(
+            result.deleted, result.batches, result.seconds))
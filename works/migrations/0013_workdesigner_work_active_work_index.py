@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-18 08:02
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('works', '0012_notification_date_index'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='workdesigner',
+            index_together=set([('work', 'active_work')]),
+        ),
+    ]
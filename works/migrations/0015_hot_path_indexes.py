@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+# Partial indexes, which Django can't declare in the models. Every viewset only reads
+# active rows, so those are the only ones indexed. The primary keys and the foreign keys
+# already have their own indexes.
+PARTIAL_INDEXES = (
+    ('works_work_active_delivery_idx',
+     'works_work (expected_delivery_date) WHERE is_active'),
+    ('works_notification_unseen_idx',
+     'works_notification (user_id) WHERE is_active AND NOT seen'),
+    ('works_notification_active_user_date_idx',
+     'works_notification (user_id, date DESC, id DESC) WHERE is_active'),
+    ('works_workdesigner_active_designer_idx',
+     'works_workdesigner (designer_id) WHERE active_work'),
+)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('works', '0014_unreadnotificationcounter'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='artiguala',
+            index_together=set([('iguala', 'art_type')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='artwork',
+            index_together=set([('work', 'art_type')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='workdesigner',
+            index_together=set([('work', 'designer', 'active_work'), ('work', 'active_work')]),
+        ),
+    ] + [
+        migrations.RunSQL('CREATE INDEX {} ON {}'.format(name, definition),
+                          'DROP INDEX {}'.format(name))
+        for name, definition in PARTIAL_INDEXES
+    ]
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-18 10:05
+from __future__ import unicode_literals
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+WORK_SEARCH_SQL = """
+CREATE FUNCTION works_work_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('spanish', coalesce(NEW.name, '')), 'A') ||
+        setweight(to_tsvector('spanish', coalesce(NEW.brief, '')), 'B');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER works_work_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF name, brief ON works_work
+    FOR EACH ROW EXECUTE PROCEDURE works_work_search_vector_update();
+UPDATE works_work SET name = name;
+CREATE INDEX works_work_search_vector_idx ON works_work USING gin (search_vector);
+"""
+
+WORK_SEARCH_REVERSE_SQL = """
+DROP INDEX works_work_search_vector_idx;
+DROP TRIGGER works_work_search_vector_trigger ON works_work;
+DROP FUNCTION works_work_search_vector_update();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('works', '0016_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='work',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunSQL(WORK_SEARCH_SQL, WORK_SEARCH_REVERSE_SQL),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-18 14:05
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations
+from django.db.models import Count
+
+
+def backfill_unread_counters(apps, schema_editor):
+    """Creates the missing counters, counted from the active unseen notifications, so every
+    user has one before notifications are added to it.
+    """
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split('.'))
+    Notification = apps.get_model('works', 'Notification')
+    UnreadNotificationCounter = apps.get_model('works', 'UnreadNotificationCounter')
+    counts = dict(Notification.objects.filter(is_active=True, seen=False)
+                  .values_list('user_id').annotate(count=Count('id')))
+    UnreadNotificationCounter.objects.bulk_create([
+        UnreadNotificationCounter(user_id=user_id, count=counts.get(user_id, 0))
+        for user_id in User.objects.filter(unread_notification_counter__isnull=True)
+        .values_list('id', flat=True)])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('works', '0017_search_vector'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_unread_counters, migrations.RunPython.noop),
+    ]
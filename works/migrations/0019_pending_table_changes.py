@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-18 09:33
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('works', '0018_backfill_unread_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingTableChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('group_name', models.CharField(max_length=100)),
+                ('notif_type', models.IntegerField()),
+                ('text', models.CharField(max_length=200)),
+                ('serializer', models.CharField(max_length=200)),
+                ('row_id', models.IntegerField()),
+                ('operation', models.CharField(max_length=10)),
+            ],
+        ),
+    ]
@@ -1,13 +1,21 @@
+import collections
+import csv
 import datetime
 import json
-
-from django.db import models
-from django.contrib.auth.models import User
+import time
+
+from django.conf import settings
+from django.contrib.postgres.search import SearchVectorField
+from django.db import models, transaction
+from django.db.models import DEFERRED, F, Q
+from django.db.models.signals import m2m_changed, post_save
+from django.contrib.auth.models import Group as AuthGroup, User
 from django.utils import timezone
-from channels import Group
+from channels import Channel, Group
 
 from clients.models import Client, Contact
-from balarco import utils
+from balarco import broadcasts, reference_data, utils
+from users.signals import users_bulk_changed
 
 
 class WorkType(models.Model):
@@ -72,30 +80,36 @@ class Iguala(models.Model):
         Date when the Iguala starts.
     end_date: DateField
         Date when the Iguala ends.
+    updated_at: DateTimeField
+        Date when the Iguala or its art types were last changed.
     """
+    SOFT_DELETE_CASCADE = ('art_iguala',)
+    TABLE_CHANGE = ('igualas-table', utils.NOTIF_TYPE_IGUALAS_TABLE_CHANGE,
+                    "Se ha actualizado la tabla de igualas",
+                    'works.serializers.IgualaSerializer')
+
     client = models.ForeignKey(Client, related_name='igualas', on_delete=models.CASCADE)
 
     name = models.CharField(max_length=100)
     start_date = models.DateField()
     end_date = models.DateField()
     is_active = models.BooleanField(default=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     def __str__(self):
         return '{}'.format(self.name)
 
     def save(self, *args, **kwargs):
         """Override of save function.
+        If the is_active field is false the art types of the iguala are soft deleted too.
         """
-        super(Iguala, self).save(*args, **kwargs)
-        """Sends a notification to the user.
-        """
-        notification = {
-            'notif_type': utils.NOTIF_TYPE_IGUALAS_TABLE_CHANGE,
-            'text': "Se ha actualizado la tabla de igualas",
-        }
-        Group('igualas-table').send({
-            'text': json.dumps(notification),
-            })
+        created = self.pk is None
+        with transaction.atomic():
+            super(Iguala, self).save(*args, **kwargs)
+            if not self.is_active:
+                utils.cascade_soft_delete(Iguala, [self.id])
+            broadcasts.table_changed(*self.TABLE_CHANGE, ids=[self.id],
+                                     operation=broadcasts.get_operation(created, self.is_active))
 
 
 class ArtIguala(models.Model):
@@ -116,6 +130,11 @@ class ArtIguala(models.Model):
     quantity = models.IntegerField()
     is_active = models.BooleanField(default=True)
 
+    class Meta:
+        index_together = [
+            ['iguala', 'art_type'],
+        ]
+
     def __str__(self):
         return '{} - {} - {}'.format(self.iguala, self.art_type, self.quantity)
 
@@ -155,6 +174,84 @@ class Status(models.Model):
         return self.STATUS[self.status_id][1]
 
 
+# Statuses that each group can move a work to, depending on the current status of the work.
+# Groups that are not listed for a status can't change it.
+STATUS_TRANSITION_RULES = {
+    Status.STATUS_PENDIENTE: {
+        utils.GROUP_DIR_CUENTAS: (Status.STATUS_PENDIENTE, Status.STATUS_DISENO,
+                                  Status.STATUS_CANCELADO),
+        utils.GROUP_EJECUTIVO_SR: (Status.STATUS_PENDIENTE, Status.STATUS_DISENO,
+                                   Status.STATUS_CANCELADO),
+    },
+    Status.STATUS_DISENO: {
+        utils.GROUP_DIR_ARTE: (Status.STATUS_DISENO, Status.STATUS_CUENTAS),
+        utils.GROUP_DISENADOR_SR: (Status.STATUS_DISENO, Status.STATUS_CUENTAS),
+    },
+    Status.STATUS_CUENTAS: {
+        utils.GROUP_DIR_CUENTAS: (Status.STATUS_CUENTAS, Status.STATUS_DISENO,
+                                  Status.STATUS_VALIDACION, Status.STATUS_CANCELADO),
+        utils.GROUP_EJECUTIVO_SR: (Status.STATUS_CUENTAS, Status.STATUS_DISENO,
+                                   Status.STATUS_VALIDACION, Status.STATUS_CANCELADO),
+    },
+    Status.STATUS_VALIDACION: {
+        utils.GROUP_DIR_CUENTAS: (Status.STATUS_VALIDACION, Status.STATUS_CUENTAS,
+                                  Status.STATUS_DISENO, Status.STATUS_PRODUCCION,
+                                  Status.STATUS_POR_COBRAR, Status.STATUS_CANCELADO),
+        utils.GROUP_EJECUTIVO_SR: (Status.STATUS_VALIDACION, Status.STATUS_CUENTAS,
+                                   Status.STATUS_DISENO, Status.STATUS_PRODUCCION,
+                                   Status.STATUS_POR_COBRAR, Status.STATUS_CANCELADO),
+    },
+    Status.STATUS_PRODUCCION: {
+        utils.GROUP_DIR_CUENTAS: (Status.STATUS_PRODUCCION, Status.STATUS_DISENO,
+                                  Status.STATUS_POR_COBRAR, Status.STATUS_CANCELADO),
+        utils.GROUP_EJECUTIVO_SR: (Status.STATUS_PRODUCCION, Status.STATUS_DISENO,
+                                   Status.STATUS_POR_COBRAR, Status.STATUS_CANCELADO),
+    },
+    Status.STATUS_POR_COBRAR: {
+        utils.GROUP_ADMINISTRACION: (Status.STATUS_POR_COBRAR, Status.STATUS_POR_FACTURAR,
+                                     Status.STATUS_CUENTAS, Status.STATUS_TERMINADO,
+                                     Status.STATUS_CANCELADO),
+    },
+    Status.STATUS_POR_FACTURAR: {
+        utils.GROUP_ADMINISTRACION: (Status.STATUS_POR_FACTURAR, Status.STATUS_CUENTAS,
+                                     Status.STATUS_TERMINADO, Status.STATUS_CANCELADO),
+    },
+}
+
+# Groups that can move a work to any status, whatever its current status is.
+UNRESTRICTED_STATUS_GROUPS = (utils.GROUP_SUPERUSUARIO,)
+
+
+def compile_status_transitions(rules, unrestricted_groups):
+    """Builds a {current status id: {group name: frozenset of status ids}} table from the
+    transition rules, so looking up the allowed statuses is a dictionary access.
+    """
+    all_status_ids = frozenset(status_id for status_id, _ in Status.STATUS)
+    transitions = {}
+    for status_id in all_status_ids:
+        status_rules = rules.get(status_id, {})
+        transitions[status_id] = {group_name: frozenset(status_ids)
+                                  for group_name, status_ids in status_rules.items()}
+        for group_name in unrestricted_groups:
+            transitions[status_id][group_name] = all_status_ids
+    return transitions
+
+
+STATUS_TRANSITIONS = compile_status_transitions(STATUS_TRANSITION_RULES,
+                                                UNRESTRICTED_STATUS_GROUPS)
+
+
+def get_possible_status_ids(current_status_id, group_names):
+    """Returns the set of status ids a work can be moved to from current_status_id by a
+    user that belongs to the groups in group_names.
+    """
+    group_transitions = STATUS_TRANSITIONS.get(current_status_id, {})
+    possible_status_ids = set()
+    for group_name in group_names:
+        possible_status_ids |= group_transitions.get(group_name, frozenset())
+    return possible_status_ids
+
+
 class Work(models.Model):
     """ Model that represents a work.
 
@@ -181,9 +278,17 @@ class Work(models.Model):
     final_link: CharField
         Optional attribute that exists only when a designer finishes a work, it contains
         a url link to the location of the product.
+    updated_at: DateTimeField
+        Date when the work, its art works, files, designers or status changes were last
+        changed.
+    search_vector: SearchVectorField
+        Spanish full-text index of the name and the brief, kept current by a trigger of the
+        database.
 
     @TODO: Confirm Status changes with client
     """
+    SOFT_DELETE_CASCADE = ('art_works', 'files', 'work_designers')
+
     executive = models.ForeignKey(User, related_name='managed_works', on_delete=models.CASCADE)
     contact = models.ForeignKey(Contact, related_name='works', on_delete=models.CASCADE)
     current_status = models.ForeignKey(Status, related_name='works', on_delete=models.CASCADE)
@@ -197,143 +302,119 @@ class Work(models.Model):
     brief = models.TextField()
     final_link = models.CharField(max_length=1000, blank=True)
     is_active = models.BooleanField(default=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+    search_vector = SearchVectorField(null=True, editable=False)
 
     def __str__(self):
         return '{}'.format(self.name)
 
     def save(self, *args, **kwargs):
+        """Override of save function.
+        If the is_active field is false, the art works, files and designers of the work are
+        soft deleted too. Everything happens in a transaction, so the work is never left
+        deleted with active children.
+        """
         if self.pk is None:
             self.creation_date = datetime.date.today()
-        super(Work, self).save(*args, **kwargs)
-        for related_user in self.get_related_users():
-            text = utils.notification_text(utils.NOTIF_TYPE_WORK_CHANGE, self)
-            Notification.objects.create(work=self, user=related_user, text=text,
-                                        notif_type=utils.NOTIF_TYPE_WORK_CHANGE)
-        if self.current_status.status_id == Status.STATUS_CUENTAS:
-            self.deactivate_work_designers_relations()
+        with transaction.atomic():
+            super(Work, self).save(*args, **kwargs)
+            if not self.is_active:
+                utils.cascade_soft_delete(Work, [self.id])
+            related_user_ids = [related_user.id for related_user in self.get_related_users()]
+            Notification.create_for_users(self, related_user_ids,
+                                          utils.NOTIF_TYPE_WORK_CHANGE)
+            if self.get_current_status().status_id == Status.STATUS_CUENTAS:
+                self.deactivate_work_designers_relations()
+
+    @classmethod
+    def create_many(cls, works_data, user):
+        """Creates several works with their art works, designers and first status change,
+        inserting the rows of each model with a single INSERT. It does the same as creating
+        the works one by one: the executive gets a work change notification and the designers
+        an assignment notification, all of them created with a single INSERT too.
+
+        Parameters
+        ----------
+        works_data: list
+            Validated data of each work, see serializers.WorkBulkCreateSerializer
+        user: User
+            User that creates the works, recorded in their status changes
+
+        Returns
+        -------
+        list
+            The created works, in the same order as works_data
+        """
+        today = datetime.date.today()
+        now = timezone.now()
+        child_fields = ('art_works', 'work_designers')
+        with transaction.atomic():
+            works = cls.objects.bulk_create([
+                cls(creation_date=today,
+                    **{field: value for field, value in data.items() if field not in child_fields})
+                for data in works_data
+            ])
+            art_works = []
+            work_designers = []
+            status_changes = []
+            notifications = []
+            for work, data in zip(works, works_data):
+                notifications.append((work, work.executive_id, utils.NOTIF_TYPE_WORK_CHANGE))
+                for art_work_data in data.get('art_works', ()):
+                    art_works.append(ArtWork(work=work, **art_work_data))
+                for work_designer_data in data.get('work_designers', ()):
+                    work_designer = WorkDesigner(work=work, **work_designer_data)
+                    WorkDesigner.prepare_save(work_designer, True)
+                    work_designers.append(work_designer)
+                    notifications.append((work, work_designer.designer_id,
+                                          utils.NOTIF_TYPE_ASSIGNMENT if work_designer.active_work
+                                          else utils.NOTIF_TYPE_END_ASSIGNMENT))
+                status_changes.append(StatusChange(work=work, status_id=work.current_status_id,
+                                                   user=user, date=now))
+            ArtWork.objects.bulk_create(art_works)
+            WorkDesigner.objects.bulk_create(work_designers)
+            StatusChange.objects.bulk_create(status_changes)
+            Notification.create_many(notifications)
+        return works
 
     def deactivate_work_designers_relations(self):
-        work_designers = [work_designer for work_designer in self.work_designers.all()
-                          if work_designer.active_work]
-        for work_designer in work_designers:
-            work_designer.active_work = False
-            work_designer.save()
+        """Ends every active assignment of the work with one UPDATE and notifies the
+        designers with one INSERT.
+        """
+        active_work_designers = self.work_designers.filter(active_work=True)
+        designer_ids = list(active_work_designers.values_list('designer', flat=True))
+        if not designer_ids:
+            return
+        active_work_designers.update(active_work=False, end_date=timezone.now())
+        Notification.create_for_users(self, designer_ids, utils.NOTIF_TYPE_END_ASSIGNMENT)
 
     def get_possible_status_ids(self, user):
-        possible_status_ids = set()
-
         if user is None:
-            return possible_status_ids
+            return set()
         if self.pk is None:
-            return possible_status_ids
-
-        if user.groups.filter(name=utils.GROUP_SUPERUSUARIO).exists():
-            possible_status_ids.add(Status.STATUS_PENDIENTE)
-            possible_status_ids.add(Status.STATUS_DISENO)
-            possible_status_ids.add(Status.STATUS_CUENTAS)
-            possible_status_ids.add(Status.STATUS_VALIDACION)
-            possible_status_ids.add(Status.STATUS_PRODUCCION)
-            possible_status_ids.add(Status.STATUS_POR_COBRAR)
-            possible_status_ids.add(Status.STATUS_POR_FACTURAR)
-            possible_status_ids.add(Status.STATUS_TERMINADO)
-            possible_status_ids.add(Status.STATUS_CANCELADO)
-
-        if self.current_status.status_id == Status.STATUS_PENDIENTE:
-            if user.groups.filter(name=utils.GROUP_DIR_CUENTAS).exists():
-                possible_status_ids.add(Status.STATUS_PENDIENTE)
-                possible_status_ids.add(Status.STATUS_DISENO)
-                possible_status_ids.add(Status.STATUS_CANCELADO)
-
-            if user.groups.filter(name=utils.GROUP_EJECUTIVO_SR).exists():
-                possible_status_ids.add(Status.STATUS_PENDIENTE)
-                possible_status_ids.add(Status.STATUS_DISENO)
-                possible_status_ids.add(Status.STATUS_CANCELADO)
-
-        elif self.current_status.status_id == Status.STATUS_DISENO:
-            if user.groups.filter(name=utils.GROUP_DIR_ARTE):
-                possible_status_ids.add(Status.STATUS_DISENO)
-                possible_status_ids.add(Status.STATUS_CUENTAS)
-
-            if user.groups.filter(name=utils.GROUP_DISENADOR_SR):
-                possible_status_ids.add(Status.STATUS_DISENO)
-                possible_status_ids.add(Status.STATUS_CUENTAS)
-
-        elif self.current_status.status_id == Status.STATUS_CUENTAS:
-            if user.groups.filter(name=utils.GROUP_DIR_CUENTAS):
-                possible_status_ids.add(Status.STATUS_CUENTAS)
-                possible_status_ids.add(Status.STATUS_DISENO)
-                possible_status_ids.add(Status.STATUS_VALIDACION)
-                possible_status_ids.add(Status.STATUS_CANCELADO)
-
-            if user.groups.filter(name=utils.GROUP_EJECUTIVO_SR):
-                possible_status_ids.add(Status.STATUS_CUENTAS)
-                possible_status_ids.add(Status.STATUS_DISENO)
-                possible_status_ids.add(Status.STATUS_VALIDACION)
-                possible_status_ids.add(Status.STATUS_CANCELADO)
-
-        elif self.current_status.status_id == Status.STATUS_VALIDACION:
-            if user.groups.filter(name=utils.GROUP_DIR_CUENTAS):
-                possible_status_ids.add(Status.STATUS_VALIDACION)
-                possible_status_ids.add(Status.STATUS_CUENTAS)
-                possible_status_ids.add(Status.STATUS_DISENO)
-                possible_status_ids.add(Status.STATUS_PRODUCCION)
-                possible_status_ids.add(Status.STATUS_POR_COBRAR)
-                possible_status_ids.add(Status.STATUS_CANCELADO)
-
-            if user.groups.filter(name=utils.GROUP_EJECUTIVO_SR):
-                possible_status_ids.add(Status.STATUS_VALIDACION)
-                possible_status_ids.add(Status.STATUS_CUENTAS)
-                possible_status_ids.add(Status.STATUS_DISENO)
-                possible_status_ids.add(Status.STATUS_PRODUCCION)
-                possible_status_ids.add(Status.STATUS_POR_COBRAR)
-                possible_status_ids.add(Status.STATUS_CANCELADO)
-
-        elif self.current_status.status_id == Status.STATUS_PRODUCCION:
-            if user.groups.filter(name=utils.GROUP_DIR_CUENTAS):
-                possible_status_ids.add(Status.STATUS_PRODUCCION)
-                possible_status_ids.add(Status.STATUS_DISENO)
-                possible_status_ids.add(Status.STATUS_POR_COBRAR)
-                possible_status_ids.add(Status.STATUS_CANCELADO)
-
-            if user.groups.filter(name=utils.GROUP_EJECUTIVO_SR):
-                possible_status_ids.add(Status.STATUS_PRODUCCION)
-                possible_status_ids.add(Status.STATUS_DISENO)
-                possible_status_ids.add(Status.STATUS_POR_COBRAR)
-                possible_status_ids.add(Status.STATUS_CANCELADO)
-
-        elif self.current_status.status_id == Status.STATUS_POR_COBRAR:
-            if user.groups.filter(name=utils.GROUP_ADMINISTRACION):
-                possible_status_ids.add(Status.STATUS_POR_COBRAR)
-                possible_status_ids.add(Status.STATUS_POR_FACTURAR)
-                possible_status_ids.add(Status.STATUS_CUENTAS)
-                possible_status_ids.add(Status.STATUS_TERMINADO)
-                possible_status_ids.add(Status.STATUS_CANCELADO)
-
-        elif self.current_status.status_id == Status.STATUS_POR_FACTURAR:
-            if user.groups.filter(name=utils.GROUP_ADMINISTRACION):
-                possible_status_ids.add(Status.STATUS_POR_FACTURAR)
-                possible_status_ids.add(Status.STATUS_CUENTAS)
-                possible_status_ids.add(Status.STATUS_TERMINADO)
-                possible_status_ids.add(Status.STATUS_CANCELADO)
-
-        elif self.current_status.status_id == Status.STATUS_TERMINADO:
-            pass
-
-        return possible_status_ids
+            return set()
+        return get_possible_status_ids(self.get_current_status().status_id,
+                                       utils.get_group_names(user))
 
     def get_possible_status_changes(self, user):
         possible_status_ids = self.get_possible_status_ids(user)
-        return Status.objects.filter(status_id__in=possible_status_ids)
+        return [status for status in reference_data.cache.all(Status)
+                if status.status_id in possible_status_ids]
+
+    def get_current_status(self):
+        """Returns the current status from the reference data cache.
+        """
+        return reference_data.cache.get(Status, self.current_status_id)
 
     def get_related_users(self):
-        work_designers = [work_designer.designer for work_designer in self.work_designers.all()
-                          if work_designer.active_work]
-        executive = [self.executive]
-        related_users = set()
-        related_users_list = work_designers + executive
-        for related_user in related_users_list:
-            related_users.add(related_user)
-        return related_users
+        """Returns the executive and the active designers of the work, fetched with a single
+        query.
+        """
+        related_users = User.objects.filter(
+            Q(id=self.executive_id) |
+            Q(asigned_works__work=self, asigned_works__active_work=True)
+        ).distinct()
+        return set(related_users)
 
 
 class ArtWork(models.Model):
@@ -354,6 +435,11 @@ class ArtWork(models.Model):
     quantity = models.IntegerField()
     is_active = models.BooleanField(default=True)
 
+    class Meta:
+        index_together = [
+            ['work', 'art_type'],
+        ]
+
     def __str__(self):
         return '{} - {} - {}'.format(self.work, self.art_type, self.quantity)
 
@@ -389,6 +475,9 @@ class WorkDesigner(models.Model):
     end_date: DateField
         The date when the designer was unassigned to the work.
     """
+    # A soft deleted assignment is no longer active either
+    SOFT_DELETE_CHANGES = {'active_work': False}
+
     designer = models.ForeignKey(User, related_name='asigned_works', on_delete=models.CASCADE)
     work = models.ForeignKey(Work, related_name='work_designers', on_delete=models.CASCADE)
 
@@ -397,23 +486,42 @@ class WorkDesigner(models.Model):
     active_work = models.BooleanField(default=True)
     is_active = models.BooleanField(default=True)
 
+    class Meta:
+        index_together = [
+            ['work', 'active_work'],
+            ['work', 'designer', 'active_work'],
+        ]
+
     def __str__(self):
         return '{} - {}'.format(self.designer, self.work)
 
     def save(self, *args, **kwargs):
-        if self.pk is None:
-            self.start_date = timezone.now()
-        if not self.active_work:
-            self.end_date = timezone.now()
-            text = utils.notification_text(utils.NOTIF_TYPE_END_ASSIGNMENT, self.work)
-            Notification.objects.create(work=self.work, user=self.designer, text=text,
-                                        notif_type=utils.NOTIF_TYPE_END_ASSIGNMENT)
-        else:
-            text = utils.notification_text(utils.NOTIF_TYPE_ASSIGNMENT, self.work)
-            Notification.objects.create(work=self.work, user=self.designer, text=text,
-                                        notif_type=utils.NOTIF_TYPE_ASSIGNMENT)
+        self.prepare_save(self, self.pk is None)
+        self.notify_designers([self])
         super(WorkDesigner, self).save(*args, **kwargs)
 
+    @staticmethod
+    def prepare_save(work_designer, created):
+        """Sets the dates of an assignment that is about to be written, it starts when it is
+        created and ends when it is no longer active.
+        """
+        if created:
+            work_designer.start_date = timezone.now()
+        if not work_designer.active_work:
+            work_designer.end_date = timezone.now()
+
+    @staticmethod
+    def notify_designers(work_designers):
+        """Notifies the designers of the assignments that have been written, with a single
+        INSERT: the active ones are notified of the assignment and the others of its end.
+        """
+        Notification.create_many([
+            (work_designer.work, work_designer.designer_id,
+             utils.NOTIF_TYPE_ASSIGNMENT if work_designer.active_work
+             else utils.NOTIF_TYPE_END_ASSIGNMENT)
+            for work_designer in work_designers
+        ])
+
 
 class StatusChange(models.Model):
     """ Model that represents the historical change of status of a work.
@@ -457,36 +565,436 @@ class Notification(models.Model):
         Text of the notification.
     seen: BooleanField
         Boolean that represents if the notification has been seen by the user.
+    updated_at: DateTimeField
+        Date when the notification was last changed.
     """
     work = models.ForeignKey(Work, related_name='notifications', on_delete=models.CASCADE)
     user = models.ForeignKey(User, related_name='notifications', on_delete=models.CASCADE)
 
     notif_type = models.IntegerField()
-    date = models.DateTimeField(blank=True, null=True)
+    date = models.DateTimeField(blank=True, null=True, db_index=True)
     text = models.CharField(max_length=2000)
     seen = models.BooleanField(default=False)
     is_active = models.BooleanField(default=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     def __str__(self):
         return '{} - {} - {} - {} - {}'.format(self.work, self.user, self.date,
                                                self.text, self.seen)
 
+    UNREAD_FIELDS = ('user_id', 'is_active', 'seen')
+
+    def __init__(self, *args, **kwargs):
+        super(Notification, self).__init__(*args, **kwargs)
+        self._unread_user_id = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """Override of from_db that remembers which unread counter includes the loaded
+        notification. When any of the fields it depends on is deferred it is left as
+        DEFERRED, and looked up on save, since reading them here would load them again.
+        """
+        notification = super(Notification, cls).from_db(db, field_names, values)
+        if all(field_name in field_names for field_name in cls.UNREAD_FIELDS):
+            notification._unread_user_id = notification.get_unread_user_id()
+        else:
+            notification._unread_user_id = DEFERRED
+        return notification
+
+    def get_unread_user_id(self):
+        """Returns the id of the user whose unread counter includes the notification, or
+        None if the notification is not counted.
+        """
+        return self.user_id if self.is_active and not self.seen else None
+
+    def get_saved_unread_user_id(self):
+        """Returns the unread user id of the notification as it was loaded, querying it
+        when the notification was loaded without the fields it depends on.
+        """
+        if self._unread_user_id is not DEFERRED:
+            return self._unread_user_id
+        saved = Notification.objects.only(*self.UNREAD_FIELDS).filter(pk=self.pk).first()
+        return saved.get_unread_user_id() if saved is not None else None
+
     def save(self, *args, **kwargs):
+        """Override of save function.
+        New notifications are sent to the user, and the unread counters are updated when the
+        notification is created, seen or deleted.
+        """
         send_notif = self.pk is None
         if self.pk is None:
             self.date = timezone.now()
-        super(Notification, self).save(*args, **kwargs)
-        if send_notif:
-            self.send_notification()
-
-    def send_notification(self):
+        unread_user_id = self.get_unread_user_id()
+        with transaction.atomic():
+            saved_unread_user_id = self.get_saved_unread_user_id()
+            super(Notification, self).save(*args, **kwargs)
+            changed_user_ids = []
+            if unread_user_id != saved_unread_user_id:
+                if saved_unread_user_id is not None:
+                    UnreadNotificationCounter.add([saved_unread_user_id], -1)
+                    changed_user_ids.append(saved_unread_user_id)
+                if unread_user_id is not None:
+                    UnreadNotificationCounter.add([unread_user_id], 1)
+                    changed_user_ids.append(unread_user_id)
+        self._unread_user_id = unread_user_id
+        dispatch_notifications([self.id] if send_notif else [], changed_user_ids)
+
+    @classmethod
+    def create_for_users(cls, work, user_ids, notif_type):
+        """Creates the same notification for several users with a single INSERT.
+        The notifications are sent to the users once the current transaction commits.
+
+        Parameters
+        ----------
+        work: Work
+            Work the notifications are about
+        user_ids: iterable
+            Ids of the users to notify
+        notif_type: int
+            One of the utils.NOTIF_TYPE_* constants
+
+        Returns
+        -------
+        list
+            The created notifications
+        """
+        return cls.create_many([(work, user_id, notif_type) for user_id in user_ids])
+
+    @classmethod
+    def create_many(cls, items):
+        """Creates notifications about any number of works with a single INSERT.
+        The notifications are sent to the users once the current transaction commits.
+
+        Parameters
+        ----------
+        items: iterable
+            (work, user_id, notif_type) tuples, one for each notification
+
+        Returns
+        -------
+        list
+            The created notifications
+        """
+        date = timezone.now()
+        texts = {}
+        new_notifications = []
+        for work, user_id, notif_type in items:
+            if (work.id, notif_type) not in texts:
+                texts[(work.id, notif_type)] = utils.notification_text(notif_type, work)
+            new_notifications.append(cls(work=work, user_id=user_id, notif_type=notif_type,
+                                         text=texts[(work.id, notif_type)], date=date))
+        with transaction.atomic():
+            notifications = cls.objects.bulk_create(new_notifications)
+            UnreadNotificationCounter.add([notification.user_id
+                                           for notification in notifications], 1)
+        for notification in notifications:
+            notification._unread_user_id = notification.get_unread_user_id()
+        dispatch_notifications([notification.id for notification in notifications])
+        return notifications
+
+    @classmethod
+    def mark_seen(cls, user, ids=None, before=None):
+        """Marks the unseen notifications of a user as seen with a single UPDATE.
+
+        Parameters
+        ----------
+        user: User
+            Owner of the notifications
+        ids: iterable
+            If given, only the notifications with these ids are marked
+        before: datetime
+            If given, only the notifications created up to this date are marked
+
+        Returns
+        -------
+        int
+            Number of notifications marked as seen
+        """
+        queryset = cls.objects.filter(user=user, is_active=True, seen=False)
+        if ids is not None:
+            queryset = queryset.filter(id__in=ids)
+        if before is not None:
+            queryset = queryset.filter(date__lte=before)
+        with transaction.atomic():
+            updated = queryset.update(seen=True, updated_at=timezone.now())
+            if updated:
+                UnreadNotificationCounter.add([user.id], -updated)
+        if updated:
+            dispatch_notifications([], [user.id])
+        return updated
+
+    def send_notification(self, data=None):
         """Sends a notification to the user.
+
+        Parameters
+        ----------
+        data: dict
+            Optional serialized notification, so the client can show it without
+            requesting it
         """
         notification = {
             'id': self.id,
             'notif_type': self.notif_type,
             'text': self.text,
+            'operation': broadcasts.OPERATION_CREATE,
+            'data': data,
         }
-        Group('user-{}'.format(self.user.id)).send({
+        Group('user-{}'.format(self.user_id)).send({
             'text': json.dumps(notification),
             })
+
+
+class UnreadNotificationCounter(models.Model):
+    """ Model that keeps the number of active notifications that a user hasn't seen, so it
+    doesn't have to be counted every time it is shown.
+
+    The counters are updated with F() expressions whenever notifications are created, seen
+    or deleted. Every user gets a counter when it is created, see create_unread_counter and
+    create_for_users, so there is never a counter to create, and count, while
+    notifications are being added.
+
+    Attributes:
+    -----------
+    user: OneToOneField
+        Relation with the user.
+    count: IntegerField
+        Number of active notifications of the user that haven't been seen.
+    """
+    user = models.OneToOneField(User, primary_key=True, related_name='unread_notification_counter',
+                                on_delete=models.CASCADE)
+
+    count = models.IntegerField(default=0)
+
+    def __str__(self):
+        return '{} - {}'.format(self.user, self.count)
+
+    @classmethod
+    def add(cls, user_ids, amount):
+        """Adds amount to the counters of the users, once for every time their id appears.
+
+        Parameters
+        ----------
+        user_ids: iterable
+            Ids of the users, may contain repeated ids
+        amount: int
+            Amount to add for each appearance of a user id
+        """
+        user_ids_by_delta = collections.defaultdict(list)
+        for user_id, times in collections.Counter(user_ids).items():
+            user_ids_by_delta[times * amount].append(user_id)
+        for delta, delta_user_ids in user_ids_by_delta.items():
+            cls.objects.filter(user_id__in=delta_user_ids).update(count=F('count') + delta)
+
+    @classmethod
+    def get_counts(cls, user_ids):
+        """Returns the number of unread notifications of the users.
+
+        Parameters
+        ----------
+        user_ids: iterable
+            Ids of the users
+
+        Returns
+        -------
+        dict
+            The unread notifications count by user id
+        """
+        user_ids = set(user_ids)
+        counts = dict(cls.objects.filter(user_id__in=user_ids).values_list('user_id', 'count'))
+        return {user_id: counts.get(user_id, 0) for user_id in user_ids}
+
+    @classmethod
+    def create_for_users(cls, user_ids):
+        """Creates the counters of new users with a single INSERT, for users created without
+        save, e.g. with bulk_create.
+        """
+        cls.objects.bulk_create([cls(user_id=user_id) for user_id in user_ids])
+
+    @classmethod
+    def send_counts(cls, user_ids):
+        """Sends the number of unread notifications to each user.
+        """
+        for user_id, count in cls.get_counts(user_ids).items():
+            notification = {
+                'notif_type': utils.NOTIF_TYPE_UNREAD_COUNT,
+                'unread_count': count,
+            }
+            Group('user-{}'.format(user_id)).send({
+                'text': json.dumps(notification),
+                })
+
+
+def create_unread_counter(sender, instance, created, raw, **kwargs):
+    """Creates the unread notifications counter of new users.
+    """
+    if created and not raw:
+        UnreadNotificationCounter.objects.create(user=instance)
+
+
+post_save.connect(create_unread_counter, sender=User)
+
+# Fields of the users shown by the works, as executive_complete and as designers
+USER_REPRESENTATION_FIELDS = {'username', 'first_name', 'last_name'}
+
+
+def touch_works_of_users(user_ids):
+    """Updates the updated_at field of the works that show the users, as executive or as
+    designers, so the works are known to have changed when the users do.
+    """
+    if user_ids:
+        Work.objects.filter(Q(executive_id__in=user_ids) |
+                            Q(work_designers__designer_id__in=user_ids)).update(
+            updated_at=timezone.now())
+
+
+def user_changed(sender, instance, created, update_fields, **kwargs):
+    if created:
+        return
+    if update_fields is None or USER_REPRESENTATION_FIELDS.intersection(update_fields):
+        touch_works_of_users([instance.id])
+
+
+def user_groups_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove'):
+        touch_works_of_users(list(pk_set) if reverse else [instance.id])
+    elif action == 'pre_clear':
+        touch_works_of_users(list(instance.user_set.values_list('id', flat=True))
+                             if reverse else [instance.id])
+
+
+def group_changed(sender, instance, created, **kwargs):
+    if not created:
+        touch_works_of_users(list(instance.user_set.values_list('id', flat=True)))
+
+
+def users_changed_in_bulk(sender, created_ids, updated_ids, **kwargs):
+    """Creates the unread notifications counters of the users created in bulk and touches
+    the works of the ones updated, which post_save would have done.
+    """
+    if created_ids:
+        UnreadNotificationCounter.create_for_users(created_ids)
+    touch_works_of_users(updated_ids)
+
+
+post_save.connect(user_changed, sender=User)
+post_save.connect(group_changed, sender=AuthGroup)
+m2m_changed.connect(user_groups_changed, sender=User.groups.through)
+users_bulk_changed.connect(users_changed_in_bulk, sender=User)
+
+reference_data.cache.register(Status, WorkType, ArtType)
+
+utils.touch_parent_on_change(ArtIguala, 'iguala')
+utils.touch_parent_on_change(ArtWork, 'work')
+utils.touch_parent_on_change(File, 'work')
+utils.touch_parent_on_change(WorkDesigner, 'work')
+utils.touch_parent_on_change(StatusChange, 'work')
+
+
+class PendingTableChange(models.Model):
+    """ Model that keeps a row change reported by balarco.broadcasts.table_changed until the
+    channels worker sends it, so the changes committed by every request during the broadcast
+    window are sent together, see balarco.broadcasts.store_table_changes.
+
+    Attributes:
+    -----------
+    group_name: CharField
+        Name of the websocket group of the table, e.g. 'clients-table'.
+    notif_type: IntegerField
+        One of the utils.NOTIF_TYPE_*_TABLE_CHANGE constants.
+    text: CharField
+        Text shown to the user.
+    serializer: CharField
+        Dotted path of the serializer used to represent the row.
+    row_id: IntegerField
+        Id of the row that changed.
+    operation: CharField
+        One of the balarco.broadcasts.OPERATION_* constants.
+    """
+    group_name = models.CharField(max_length=100)
+    notif_type = models.IntegerField()
+    text = models.CharField(max_length=200)
+    serializer = models.CharField(max_length=200)
+    row_id = models.IntegerField()
+    operation = models.CharField(max_length=10)
+
+    def __str__(self):
+        return '{} - {} {}'.format(self.group_name, self.operation, self.row_id)
+
+
+NOTIFICATIONS_CHANNEL = 'notifications.dispatch'
+
+
+def dispatch_notifications(notification_ids, user_ids=()):
+    """Queues the notifications to be sent through the websockets once the current
+    transaction commits. A single message is queued no matter how many notifications there
+    are; the works.consumers.send_notifications consumer delivers them from a channels
+    worker, outside of the request, together with the unread count of their users and of
+    the users in user_ids.
+    """
+    notification_ids = [notification_id for notification_id in notification_ids
+                        if notification_id is not None]
+    user_ids = list(user_ids)
+    if not notification_ids and not user_ids:
+        return
+    transaction.on_commit(lambda: Channel(NOTIFICATIONS_CHANNEL).send({
+        'ids': notification_ids,
+        'user_ids': user_ids,
+    }))
+
+
+NOTIFICATIONS_PURGE_CHANNEL = 'notifications.purge'
+
+ARCHIVED_NOTIFICATION_FIELDS = ('id', 'work_id', 'user_id', 'notif_type', 'date', 'text',
+                                'seen', 'is_active')
+
+PurgeResult = collections.namedtuple('PurgeResult', ['deleted', 'batches', 'seconds'])
+
+
+def purge_notifications(days=None, batch_size=None, archive=None):
+    """Deletes the notifications older than the given number of days that have been seen or
+    deleted. Unseen notifications are always kept.
+    The rows are deleted by primary key in batches, each one in its own short transaction,
+    so the table is never locked for long.
+
+    Parameters
+    ----------
+    days: int
+        Age in days of the notifications to delete, settings.NOTIFICATION_RETENTION_DAYS
+        by default
+    batch_size: int
+        Number of notifications deleted per statement,
+        settings.NOTIFICATION_PURGE_BATCH_SIZE by default
+    archive: file
+        If given, the deleted notifications are written to it as CSV rows with the
+        ARCHIVED_NOTIFICATION_FIELDS columns before being deleted
+
+    Returns
+    -------
+    PurgeResult
+        Number of notifications deleted, number of batches and seconds spent
+    """
+    if days is None:
+        days = settings.NOTIFICATION_RETENTION_DAYS
+    if batch_size is None:
+        batch_size = settings.NOTIFICATION_PURGE_BATCH_SIZE
+    date_limit = timezone.now() - datetime.timedelta(days=days)
+    queryset = Notification.objects.filter(Q(seen=True) | Q(is_active=False),
+                                           date__lt=date_limit).order_by('id')
+    writer = csv.writer(archive) if archive is not None else None
+
+    start = time.time()
+    deleted = 0
+    batches = 0
+    while True:
+        with transaction.atomic():
+            if writer is not None:
+                rows = list(queryset.values_list(*ARCHIVED_NOTIFICATION_FIELDS)[:batch_size])
+                ids = [row[0] for row in rows]
+                writer.writerows(rows)
+            else:
+                ids = list(queryset.values_list('id', flat=True)[:batch_size])
+            if not ids:
+                break
+            deleted += Notification.objects.filter(id__in=ids).delete()[0]
+        batches += 1
+    return PurgeResult(deleted, batches, time.time() - start)
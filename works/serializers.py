@@ -3,6 +3,7 @@ from rest_framework import serializers
 from . import models
 from clients import serializers as client_serializers
 from users import serializers as user_serializers
+from balarco import reference_data, utils
 
 
 class WorkTypeSerializer(serializers.ModelSerializer):
@@ -23,12 +24,15 @@ class ArtTypeSerializer(serializers.ModelSerializer):
 
 class ArtIgualaSerializer(serializers.ModelSerializer):
 
-    art_type_name = serializers.CharField(source='art_type.name', read_only=True)
+    art_type_name = serializers.SerializerMethodField()
 
     class Meta:
         model = models.ArtIguala
         fields = ('id', 'iguala', 'art_type', 'quantity', 'art_type_name')
 
+    def get_art_type_name(self, obj):
+        return reference_data.cache.get(models.ArtType, obj.art_type_id).name
+
 
 class IgualaSerializer(serializers.ModelSerializer):
 
@@ -52,7 +56,8 @@ class StatusSerializer(serializers.ModelSerializer):
 
 class ArtWorkSerializer(serializers.ModelSerializer):
 
-    art_type_complete = ArtTypeSerializer(source='art_type', read_only=True)
+    art_type_complete = reference_data.ReferenceDataField(ArtTypeSerializer,
+                                                          source='art_type_id')
 
     class Meta:
         model = models.ArtWork
@@ -88,13 +93,15 @@ class StatusChangeSerializer(serializers.ModelSerializer):
         fields = ('id', 'work', 'status', 'user', 'date',)
 
 
-class WorkSerializer(serializers.ModelSerializer):
+class WorkSerializer(utils.DynamicFieldsMixin, serializers.ModelSerializer):
 
     creation_date = serializers.DateField(read_only=True)
     executive_complete = user_serializers.UserSerializer(source='executive', read_only=True)
     contact_complete = client_serializers.ContactSerializer(source='contact', read_only=True)
-    current_status_complete = StatusSerializer(source='current_status', read_only=True)
-    work_type_complete = WorkTypeSerializer(source='work_type', read_only=True)
+    current_status_complete = reference_data.ReferenceDataField(StatusSerializer,
+                                                                source='current_status_id')
+    work_type_complete = reference_data.ReferenceDataField(WorkTypeSerializer,
+                                                           source='work_type_id')
     iguala_complete = IgualaSerializer(source='iguala', read_only=True)
 
     art_works = ArtWorkSerializer(many=True, read_only=True)
@@ -125,6 +132,45 @@ class WorkSerializer(serializers.ModelSerializer):
                   'work_designers',
                   'status_changes'
                   )
+        expandable_fields = ('brief',
+                             'iguala_complete',
+                             'art_works',
+                             'files',
+                             'work_designers',
+                             'status_changes',
+                             )
+
+
+class BulkArtWorkSerializer(serializers.ModelSerializer):
+    """Art work of a work created by WorkViewSet.bulk_create, the work doesn't exist yet.
+    """
+
+    class Meta:
+        model = models.ArtWork
+        fields = ('art_type', 'quantity',)
+
+
+class BulkWorkDesignerSerializer(serializers.ModelSerializer):
+    """Designer of a work created by WorkViewSet.bulk_create, the work doesn't exist yet.
+    """
+
+    class Meta:
+        model = models.WorkDesigner
+        fields = ('designer', 'active_work',)
+
+
+class WorkBulkCreateSerializer(serializers.ModelSerializer):
+    """Validates a work of WorkViewSet.bulk_create together with its art works and designers.
+    """
+
+    art_works = BulkArtWorkSerializer(many=True, required=False)
+    work_designers = BulkWorkDesignerSerializer(many=True, required=False)
+
+    class Meta:
+        model = models.Work
+        fields = ('executive', 'contact', 'current_status', 'work_type', 'iguala', 'name',
+                  'expected_delivery_date', 'brief', 'final_link', 'art_works',
+                  'work_designers',)
 
 
 class NotificationSerializer(serializers.ModelSerializer):
@@ -135,3 +181,16 @@ class NotificationSerializer(serializers.ModelSerializer):
     class Meta:
         model = models.Notification
         fields = ('id', 'work', 'user', 'date', 'text', 'seen')
+
+
+class NotificationMarkSeenSerializer(serializers.Serializer):
+    """Validates the notifications to mark as seen, given by their ids or by the date up to
+    which every notification is marked.
+    """
+    ids = serializers.ListField(child=serializers.IntegerField(), required=False)
+    before = serializers.DateTimeField(required=False)
+
+    def validate(self, data):
+        if 'ids' not in data and 'before' not in data:
+            raise serializers.ValidationError('Either ids or before is required.')
+        return data
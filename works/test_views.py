@@ -1,13 +1,23 @@
 import datetime
-
-from django.contrib.auth.models import User
-from rest_framework.test import APIRequestFactory
+import shutil
+import tempfile
+
+from django.contrib.auth.models import User, Group
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.test import APIRequestFactory, force_authenticate
+from rest_framework.authtoken.models import Token
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.core.urlresolvers import reverse
 
 from . import models, views, serializers
 from clients import models as client_models
-from balarco import utils
+from users import models as users_models
+from balarco import reference_data, utils
+from .tests import WorkFixtureMixin
 
 
 class WorkTypeAPITest(utils.GenericAPITest):
@@ -527,6 +537,407 @@ class WorkAPITest(utils.GenericAPITest):
         self.url_detail = 'works:works-detail'
         self.factory = APIRequestFactory()
 
+    def count_list_queries(self, data=None):
+        request = self.factory.get(reverse(self.url_list), data=data)
+        token = Token.objects.get(user=self.user)
+        force_authenticate(request, user=self.user, token=token)
+        with CaptureQueriesContext(connection) as context:
+            response = self.view(request)
+            response.render()
+        return len(context.captured_queries)
+
+    def create_complete_work(self, idx):
+        template_work = self.test_objects[0]
+        designer = User.objects.create_user(username='designer_{}'.format(idx),
+                                            password='test_password')
+        work = models.Work.objects.create(
+            executive=designer,
+            contact=template_work.contact,
+            current_status=template_work.current_status,
+            work_type=template_work.work_type,
+            iguala=template_work.iguala,
+            name='Extra work {}'.format(idx),
+            expected_delivery_date=datetime.date.today(),
+            brief='Brief')
+        art_type = models.ArtType.objects.create(name='Arte {}'.format(idx),
+                                                 work_type=work.work_type)
+        models.ArtIguala.objects.create(iguala=work.iguala, art_type=art_type, quantity=idx)
+        models.ArtWork.objects.create(work=work, art_type=art_type, quantity=idx)
+        models.WorkDesigner.objects.create(designer=designer, work=work)
+        models.StatusChange.objects.create(work=work, status=work.current_status,
+                                           user=designer)
+
+    def test_listing_query_count_does_not_grow(self):
+        """Test that listing works issues the same number of queries regardless of how many
+        works, and how many nested objects, there are.
+        """
+        self.create_complete_work(0)
+        initial_queries = self.count_list_queries()
+
+        for idx in range(1, 6):
+            self.create_complete_work(idx)
+
+        self.assertEqual(initial_queries, self.count_list_queries())
+
+    def test_sparse_fieldsets(self):
+        """Test that ?fields= and ?expand= prune the listed works and the queries behind them,
+        without selecting the columns that are not listed.
+        """
+        self.create_complete_work(0)
+        token = Token.objects.get(user=self.user)
+
+        data = {'fields': 'id,name,current_status_complete,expected_delivery_date'}
+        request = self.factory.get(reverse(self.url_list), data=data)
+        force_authenticate(request, user=self.user, token=token)
+        response = self.view(request)
+        for obj in response.data:
+            self.assertEqual({'id', 'name', 'current_status_complete',
+                              'expected_delivery_date'}, set(obj.keys()))
+
+        request = self.factory.get(reverse(self.url_list), data={'expand': 'files'})
+        force_authenticate(request, user=self.user, token=token)
+        with CaptureQueriesContext(connection) as context:
+            response = self.view(request)
+        for query in context.captured_queries:
+            self.assertNotIn('"works_work"."brief"', query['sql'])
+        for obj in response.data:
+            self.assertIn('files', obj)
+            self.assertIn('executive_complete', obj)
+            self.assertNotIn('brief', obj)
+            self.assertNotIn('status_changes', obj)
+
+        self.assertLess(self.count_list_queries(data={'fields': 'id,name'}),
+                        self.count_list_queries())
+
+    def test_unassigned_works(self):
+        """Test that unassigned_works lists only works in design without an active designer,
+        with a number of queries that doesn't depend on the number of works.
+        """
+        view = views.WorkViewSet.as_view({'get': 'unassigned_works'})
+        token = Token.objects.get(user=self.user)
+        url = reverse('works:works-unassigned-works')
+        for idx in range(3):
+            self.create_complete_work(idx)
+
+        request = self.factory.get(url)
+        force_authenticate(request, user=self.user, token=token)
+        with CaptureQueriesContext(connection) as context:
+            response = view(request)
+        self.assertEqual([self.test_objects[0].id], [obj['id'] for obj in response.data])
+        initial_queries = len(context.captured_queries)
+
+        for idx in range(3, 6):
+            self.create_complete_work(idx)
+        models.WorkDesigner.objects.create(designer=self.user, work=self.test_objects[0])
+
+        request = self.factory.get(url)
+        force_authenticate(request, user=self.user, token=token)
+        with CaptureQueriesContext(connection) as context:
+            response = view(request)
+        self.assertEqual([], response.data)
+        self.assertLessEqual(len(context.captured_queries), initial_queries)
+
+    def test_my_assignments(self):
+        """Test that my_assignments returns, once and ordered, the managed works, the active
+        assignments and, for Administración, the works to charge or invoice.
+        """
+        view = views.WorkViewSet.as_view({'get': 'my_assignments'})
+        token = Token.objects.get(user=self.user)
+        url = reverse('works:works-my-assignments')
+        self.create_complete_work(0)
+        self.create_complete_work(1)
+        assigned_work = models.Work.objects.get(name='Extra work 0')
+        models.WorkDesigner.objects.create(designer=self.user, work=assigned_work)
+        models.WorkDesigner.objects.create(designer=self.user, work=self.test_objects[0])
+        finished_assignment = models.Work.objects.get(name='Extra work 1')
+        models.WorkDesigner.objects.create(designer=self.user, work=finished_assignment,
+                                           active_work=False)
+        status_por_cobrar = models.Status.objects.create(
+            status_id=models.Status.STATUS_POR_COBRAR)
+        to_charge_work = models.Work.objects.create(
+            executive=assigned_work.executive,
+            contact=assigned_work.contact,
+            current_status=status_por_cobrar,
+            work_type=assigned_work.work_type,
+            name='Work to charge',
+            expected_delivery_date=datetime.date.today(),
+            brief='Brief')
+
+        request = self.factory.get(url)
+        force_authenticate(request, user=self.user, token=token)
+        response = view(request)
+        expected_ids = sorted([assigned_work.id] + [work.id for work in self.test_objects],
+                              reverse=True)
+        self.assertEqual(expected_ids, [obj['id'] for obj in response.data])
+
+        Group.objects.create(name=utils.GROUP_ADMINISTRACION).user_set.add(self.user)
+        request = self.factory.get(url)
+        force_authenticate(request, user=self.user, token=token)
+        response = view(request)
+        self.assertEqual(sorted(expected_ids + [to_charge_work.id], reverse=True),
+                         [obj['id'] for obj in response.data])
+
+    def test_batch_possible_status_changes(self):
+        """Test that the possible status changes of many works are returned at once and match
+        the ones of the single work endpoint.
+        """
+        batch_view = views.WorkViewSet.as_view({'get': 'batch_possible_status_changes'})
+        detail_view = views.WorkViewSet.as_view({'get': 'possible_status_changes'})
+        token = Token.objects.get(user=self.user)
+        Group.objects.create(name=utils.GROUP_EJECUTIVO_SR).user_set.add(self.user)
+        Group.objects.create(name=utils.GROUP_DIR_ARTE).user_set.add(self.user)
+        for status_id, _ in models.Status.STATUS:
+            if not models.Status.objects.filter(status_id=status_id).exists():
+                models.Status.objects.create(status_id=status_id)
+        work_ids = [work.id for work in self.test_objects]
+
+        request = self.factory.get(reverse('works:works-batch-possible-status-changes'),
+                                   data={'ids': ','.join(str(work_id) for work_id in work_ids)})
+        force_authenticate(request, user=self.user, token=token)
+        reference_data.cache.all(models.Status)
+        with CaptureQueriesContext(connection) as context:
+            response = batch_view(request)
+        self.assertEqual(2, len(context.captured_queries))
+        self.assertEqual(sorted(work_ids), [obj['work'] for obj in response.data])
+
+        for obj in response.data:
+            request = self.factory.get(reverse('works:works-possible-status-changes',
+                                               kwargs={'pk': obj['work']}))
+            force_authenticate(request, user=self.user, token=token)
+            response = detail_view(request, pk=obj['work'])
+            self.assertEqual(sorted(status['id'] for status in response.data),
+                             sorted(status['id'] for status in obj['possible_status_changes']))
+            self.assertNotEqual([], obj['possible_status_changes'])
+
+    def test_list_etag_changes_with_nested_objects(self):
+        """Test that the ETag of the works list changes when the art works of a work or its
+        contact change.
+        """
+        token = Token.objects.get(user=self.user)
+
+        def get_etag():
+            request = self.factory.get(reverse(self.url_list))
+            force_authenticate(request, user=self.user, token=token)
+            return self.view(request)['ETag']
+
+        etag = get_etag()
+        self.assertEqual(etag, get_etag())
+        work = self.test_objects[0]
+        models.ArtWork.objects.create(work=work, art_type=models.ArtType.objects.first(),
+                                      quantity=1)
+        new_etag = get_etag()
+        self.assertNotEqual(etag, new_etag)
+        work.contact.save()
+        self.assertNotEqual(new_etag, get_etag())
+
+    def test_list_etag_changes_with_users_and_reference_data(self):
+        """Test that the ETag of the works list changes when the executive of a work, its
+        groups or the reference data shown by the works change, even though they have no
+        updated_at.
+        """
+        token = Token.objects.get(user=self.user)
+
+        def get_etag():
+            request = self.factory.get(reverse(self.url_list))
+            force_authenticate(request, user=self.user, token=token)
+            return self.view(request)['ETag']
+
+        executive = self.test_objects[0].executive
+        etags = [get_etag()]
+        executive.first_name = 'Edited'
+        executive.save()
+        etags.append(get_etag())
+        executive.groups.add(Group.objects.create(name=utils.GROUP_DISENADOR_JR))
+        etags.append(get_etag())
+        Group.objects.filter(name=utils.GROUP_DISENADOR_JR).get().save()
+        etags.append(get_etag())
+        users_models.set_groups({executive.id: []})
+        etags.append(get_etag())
+        work_type = self.test_objects[0].work_type
+        work_type.work_type_id = (work_type.work_type_id + 1) % len(models.WorkType.IDS)
+        work_type.save()
+        etags.append(get_etag())
+        self.assertEqual(len(etags), len(set(etags)))
+
+    def test_search(self):
+        """Test that ?q= matches the words of the name and the brief of the works, also when
+        they change with a queryset update, and that it is rejected by lists of models
+        without a search index.
+        """
+        token = Token.objects.get(user=self.user)
+        work = self.test_objects[1]
+        models.Work.objects.filter(id=work.id).update(brief='Tarjetas para la boda')
+
+        request = self.factory.get(reverse(self.url_list),
+                                   data={utils.SEARCH_QUERY_PARAM: 'tarjeta'})
+        force_authenticate(request, user=self.user, token=token)
+        response = self.view(request)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([work.id], [obj['id'] for obj in response.data])
+
+        request = self.factory.get(reverse('works:igualas-list'),
+                                   data={utils.SEARCH_QUERY_PARAM: 'starbucks'})
+        force_authenticate(request, user=self.user, token=token)
+        response = views.IgualaViewSet.as_view({'get': 'list'})(request)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_bulk_create(self):
+        """Test that bulk creation inserts the works and their rows with one INSERT per model,
+        and that nothing is created when any of the works is invalid.
+        """
+        bulk_view = views.WorkViewSet.as_view({'post': 'bulk_create'})
+        token = Token.objects.get(user=self.user)
+        template_work = self.test_objects[0]
+        designer = User.objects.create_user(username='designer', password='test_password')
+        art_type = models.ArtType.objects.first()
+
+        def work_data(idx):
+            return {
+                'executive': self.user.id,
+                'contact': template_work.contact_id,
+                'current_status': template_work.current_status_id,
+                'work_type': template_work.work_type_id,
+                'iguala': template_work.iguala_id,
+                'name': 'Bulk work {}'.format(idx),
+                'expected_delivery_date': datetime.date.today(),
+                'brief': 'Brief',
+                'art_works': [{'art_type': art_type.id, 'quantity': idx}],
+                'work_designers': [{'designer': designer.id, 'active_work': True}],
+            }
+
+        def bulk_create(data):
+            request = self.factory.post(reverse('works:works-bulk'), data, format='json')
+            force_authenticate(request, user=self.user, token=token)
+            with CaptureQueriesContext(connection) as context:
+                response = bulk_view(request)
+            inserts = [query for query in context.captured_queries
+                       if query['sql'].startswith('INSERT')]
+            return response, len(inserts)
+
+        invalid_work = work_data(1)
+        invalid_work['art_works'][0]['art_type'] = None
+        response, inserts = bulk_create([work_data(0), invalid_work])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual({}, response.data[0])
+        self.assertIn('art_works', response.data[1])
+        self.assertEqual(0, inserts)
+        self.assertFalse(models.Work.objects.filter(name__startswith='Bulk work').exists())
+
+        response, inserts = bulk_create([work_data(idx) for idx in range(1, 6)])
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(5, inserts)
+        self.assertEqual(['Bulk work {}'.format(idx) for idx in range(1, 6)],
+                         [obj['name'] for obj in response.data])
+        works = models.Work.objects.filter(name__startswith='Bulk work')
+        self.assertEqual(5, works.filter(creation_date=datetime.date.today()).count())
+        self.assertEqual(5, models.ArtWork.objects.filter(work__in=works).count())
+        self.assertEqual(5, models.WorkDesigner.objects.filter(work__in=works, designer=designer,
+                                                               active_work=True).count())
+        self.assertEqual(5, models.StatusChange.objects.filter(work__in=works,
+                                                               user=self.user).count())
+        self.assertEqual(5, models.Notification.objects.filter(
+            work__in=works, user=designer, notif_type=utils.NOTIF_TYPE_ASSIGNMENT).count())
+        self.assertEqual(5, models.Notification.objects.filter(
+            work__in=works, user=self.user, notif_type=utils.NOTIF_TYPE_WORK_CHANGE).count())
+
+    def test_update_nested_children(self):
+        """Test that updating a work upserts its art works and designers by art type and
+        designer, writing each kind of change with a single statement.
+        """
+        update_view = views.WorkViewSet.as_view({'patch': 'partial_update'})
+        token = Token.objects.get(user=self.user)
+        work = self.test_objects[0]
+        art_types = list(models.ArtType.objects.order_by('id'))
+        designers = [User.objects.create_user(username='designer_{}'.format(idx),
+                                              password='test_password') for idx in range(3)]
+        existing_art_work = models.ArtWork.objects.create(work=work, art_type=art_types[0],
+                                                          quantity=1)
+        models.WorkDesigner.objects.create(work=work, designer=designers[0])
+        models.WorkDesigner.objects.create(work=work, designer=designers[1])
+
+        data = {
+            'art_works': [{'art_type': art_type.id, 'quantity': 5} for art_type in art_types],
+            'work_designers': [{'designer': designers[0].id, 'active_work': False},
+                               {'designer': designers[1].id, 'active_work': True},
+                               {'designer': designers[2].id, 'active_work': True}],
+        }
+        request = self.factory.patch(reverse(self.url_detail, kwargs={'pk': work.id}), data,
+                                     format='json')
+        force_authenticate(request, user=self.user, token=token)
+        with CaptureQueriesContext(connection) as context:
+            response = update_view(request, pk=work.id)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        for table in ('works_artwork', 'works_workdesigner'):
+            writes = [query['sql'] for query in context.captured_queries
+                      if query['sql'].startswith(('INSERT INTO "{}"'.format(table),
+                                                  'UPDATE "{}"'.format(table)))]
+            self.assertEqual(2, len(writes))
+        art_works = models.ArtWork.objects.filter(work=work)
+        self.assertEqual(len(art_types), art_works.count())
+        self.assertEqual({5}, set(art_works.values_list('quantity', flat=True)))
+        self.assertEqual(existing_art_work.id, art_works.get(art_type=art_types[0]).id)
+        work_designers = models.WorkDesigner.objects.filter(work=work)
+        self.assertEqual([designers[1].id, designers[2].id],
+                         list(work_designers.filter(active_work=True).order_by('designer')
+                              .values_list('designer', flat=True)))
+        ended = work_designers.get(designer=designers[0])
+        self.assertIsNotNone(ended.end_date)
+        self.assertTrue(models.Notification.objects.filter(
+            user=designers[0], notif_type=utils.NOTIF_TYPE_END_ASSIGNMENT).exists())
+
+    def test_update_repeated_children(self):
+        """Test that items repeating the key of a new child create a single child with the
+        data of the last one.
+        """
+        update_view = views.WorkViewSet.as_view({'patch': 'partial_update'})
+        token = Token.objects.get(user=self.user)
+        work = self.test_objects[0]
+        art_type = models.ArtType.objects.order_by('id').first()
+        models.ArtWork.objects.filter(work=work, art_type=art_type).delete()
+
+        data = {'art_works': [{'art_type': art_type.id, 'quantity': 2},
+                              {'art_type': art_type.id, 'quantity': 7}]}
+        request = self.factory.patch(reverse(self.url_detail, kwargs={'pk': work.id}), data,
+                                     format='json')
+        force_authenticate(request, user=self.user, token=token)
+        response = update_view(request, pk=work.id)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        art_works = models.ArtWork.objects.filter(work=work, art_type=art_type)
+        self.assertEqual([7], list(art_works.values_list('quantity', flat=True)))
+
+    def test_iguala_report(self):
+        """Test that the iguala report adds up the used arts and that the number of queries
+        does not depend on the number of works.
+        """
+        report_view = views.IgualaViewSet.as_view({'get': 'report'})
+        token = Token.objects.get(user=self.user)
+        iguala = self.test_objects[0].iguala
+
+        def read_report():
+            request = self.factory.get(reverse('works:igualas-report',
+                                               kwargs={'pk': iguala.id}))
+            force_authenticate(request, user=self.user, token=token)
+            with CaptureQueriesContext(connection) as context:
+                response = report_view(request, pk=iguala.id)
+                content = b''.join(response.streaming_content).decode('utf-8')
+            return content, len(context.captured_queries)
+
+        self.create_complete_work(1)
+        _, initial_queries = read_report()
+        for idx in range(2, 6):
+            self.create_complete_work(idx)
+        models.ArtWork.objects.create(work=self.test_objects[0],
+                                      art_type=models.ArtType.objects.get(name='Arte 2'),
+                                      quantity=1)
+        content, queries = read_report()
+
+        self.assertEqual(initial_queries, queries)
+        self.assertIn('Arte 2,2,3,-1\r\n', content)
+        self.assertIn('Arte 5,5,5,0\r\n', content)
+        self.assertIn('Extra work 5', content)
+
 
 class ArtWorkAPITest(utils.GenericAPITest):
     """Tests to verify the basic usage of the REST API to create, modify and list arts from an iguala.
@@ -668,7 +1079,21 @@ class ArtWorkAPITest(utils.GenericAPITest):
 class FileAPITest(utils.GenericAPITest):
     """Tests to verify the basic usage of the REST API to create, modify and list arts from an iguala.
     It inherits from utils.GenericAPITest and add the necessary class attributes.
+    The uploads are stored in a temporary MEDIA_ROOT that is removed after the tests.
     """
+    @classmethod
+    def setUpClass(cls):
+        cls.media_root = tempfile.mkdtemp()
+        cls.media_settings = override_settings(MEDIA_ROOT=cls.media_root)
+        cls.media_settings.enable()
+        super(FileAPITest, cls).setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(FileAPITest, cls).tearDownClass()
+        cls.media_settings.disable()
+        shutil.rmtree(cls.media_root, ignore_errors=True)
+
     def setUp(self):
         self.user = User.objects.create_user(username='test_user',
                                              password='test_password')
@@ -1040,3 +1465,76 @@ class StatusChangeAPITest(utils.GenericAPITest):
         self.url_list = 'works:status_changes-list'
         self.url_detail = 'works:status_changes-detail'
         self.factory = APIRequestFactory()
+
+
+class NotificationSeenAPITest(WorkFixtureMixin, TestCase):
+    """Tests to verify that notifications are marked as seen in bulk.
+    """
+    def setUp(self):
+        self.user = User.objects.create_user(username='test_user', password='test_password')
+        self.token = Token.objects.create(user=self.user)
+        work = self.create_work(self.user)
+        models.Notification.objects.filter(user=self.user).delete()
+        models.UnreadNotificationCounter.objects.filter(user=self.user).update(count=0)
+        self.notifications = models.Notification.create_for_users(
+            work, [self.user.id] * 5, utils.NOTIF_TYPE_WORK_CHANGE)
+        other_user = User.objects.create_user(username='other_user', password='test_password')
+        models.Notification.create_for_users(work, [other_user.id], utils.NOTIF_TYPE_WORK_CHANGE)
+        self.factory = APIRequestFactory()
+
+    def request(self, action, method='get', data=None, queries=1):
+        view = views.NotificationViewSet.as_view({method: action})
+        url = reverse('works:notifications-{}'.format(action.replace('_', '-')))
+        request = getattr(self.factory, method)(url, data=data, format='json')
+        force_authenticate(request, user=self.user, token=self.token)
+        with CaptureQueriesContext(connection) as context:
+            response = view(request)
+        # The savepoints only exist because the test runs inside a transaction
+        self.assertEqual(queries, len([query for query in context.captured_queries
+                                       if 'SAVEPOINT' not in query['sql']]))
+        return response
+
+    def unseen_count(self):
+        return models.Notification.objects.filter(seen=False).count()
+
+    def test_unread_count(self):
+        self.assertEqual({'unread_count': 5}, self.request('unread_count').data)
+        models.Notification.create_for_users(self.notifications[0].work, [self.user.id],
+                                             utils.NOTIF_TYPE_WORK_CHANGE)
+        self.assertEqual({'unread_count': 6}, self.request('unread_count').data)
+        self.request('mark_seen', 'post', {'ids': [self.notifications[0].id]}, queries=2)
+        self.assertEqual({'unread_count': 5}, self.request('unread_count').data)
+        self.notifications[1].is_active = False
+        self.notifications[1].save()
+        self.assertEqual({'unread_count': 4}, self.request('unread_count').data)
+        notification = models.Notification.objects.only('id', 'text').get(
+            id=self.notifications[2].id)
+        notification.seen = True
+        notification.save()
+        self.assertEqual({'unread_count': 3}, self.request('unread_count').data)
+        self.request('read_all', queries=2)
+        self.assertEqual({'unread_count': 0}, self.request('unread_count').data)
+        self.request('read_all')
+
+    def test_new_users_have_a_counter(self):
+        user = User.objects.create_user(username='new_user', password='test_password')
+        self.assertEqual(0, models.UnreadNotificationCounter.objects.get(user=user).count)
+
+    def test_read_all(self):
+        response = self.request('read_all', queries=2)
+        self.assertEqual({'updated': 5}, response.data)
+        self.assertEqual(1, self.unseen_count())
+
+    def test_mark_seen_by_ids(self):
+        ids = [notification.id for notification in self.notifications[:2]]
+        response = self.request('mark_seen', 'post', {'ids': ids}, queries=2)
+        self.assertEqual({'updated': 2}, response.data)
+        self.assertEqual(4, self.unseen_count())
+
+    def test_mark_seen_before(self):
+        models.Notification.objects.filter(id=self.notifications[0].id).update(
+            date=timezone.now() - datetime.timedelta(days=2))
+        before = timezone.now() - datetime.timedelta(days=1)
+        response = self.request('mark_seen', 'post', {'before': before}, queries=2)
+        self.assertEqual({'updated': 1}, response.data)
+        self.assertEqual(5, self.unseen_count())
@@ -0,0 +1,415 @@
+import datetime
+import io
+import json
+from unittest import skipUnless
+
+from channels import Group
+from channels.tests import ChannelTestCase
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
+
+from . import consumers, models
+from clients import models as client_models
+from balarco import reference_data, utils
+
+
+Status = models.Status
+
+ALL_STATUS_IDS = {status_id for status_id, _ in Status.STATUS}
+
+# Allowed statuses for every (current status, group) pair, any pair missing from here
+# must not allow any change.
+EXPECTED_TRANSITIONS = {
+    (Status.STATUS_PENDIENTE, utils.GROUP_DIR_CUENTAS):
+        {Status.STATUS_PENDIENTE, Status.STATUS_DISENO, Status.STATUS_CANCELADO},
+    (Status.STATUS_PENDIENTE, utils.GROUP_EJECUTIVO_SR):
+        {Status.STATUS_PENDIENTE, Status.STATUS_DISENO, Status.STATUS_CANCELADO},
+    (Status.STATUS_DISENO, utils.GROUP_DIR_ARTE):
+        {Status.STATUS_DISENO, Status.STATUS_CUENTAS},
+    (Status.STATUS_DISENO, utils.GROUP_DISENADOR_SR):
+        {Status.STATUS_DISENO, Status.STATUS_CUENTAS},
+    (Status.STATUS_CUENTAS, utils.GROUP_DIR_CUENTAS):
+        {Status.STATUS_CUENTAS, Status.STATUS_DISENO, Status.STATUS_VALIDACION,
+         Status.STATUS_CANCELADO},
+    (Status.STATUS_CUENTAS, utils.GROUP_EJECUTIVO_SR):
+        {Status.STATUS_CUENTAS, Status.STATUS_DISENO, Status.STATUS_VALIDACION,
+         Status.STATUS_CANCELADO},
+    (Status.STATUS_VALIDACION, utils.GROUP_DIR_CUENTAS):
+        {Status.STATUS_VALIDACION, Status.STATUS_CUENTAS, Status.STATUS_DISENO,
+         Status.STATUS_PRODUCCION, Status.STATUS_POR_COBRAR, Status.STATUS_CANCELADO},
+    (Status.STATUS_VALIDACION, utils.GROUP_EJECUTIVO_SR):
+        {Status.STATUS_VALIDACION, Status.STATUS_CUENTAS, Status.STATUS_DISENO,
+         Status.STATUS_PRODUCCION, Status.STATUS_POR_COBRAR, Status.STATUS_CANCELADO},
+    (Status.STATUS_PRODUCCION, utils.GROUP_DIR_CUENTAS):
+        {Status.STATUS_PRODUCCION, Status.STATUS_DISENO, Status.STATUS_POR_COBRAR,
+         Status.STATUS_CANCELADO},
+    (Status.STATUS_PRODUCCION, utils.GROUP_EJECUTIVO_SR):
+        {Status.STATUS_PRODUCCION, Status.STATUS_DISENO, Status.STATUS_POR_COBRAR,
+         Status.STATUS_CANCELADO},
+    (Status.STATUS_POR_COBRAR, utils.GROUP_ADMINISTRACION):
+        {Status.STATUS_POR_COBRAR, Status.STATUS_POR_FACTURAR, Status.STATUS_CUENTAS,
+         Status.STATUS_TERMINADO, Status.STATUS_CANCELADO},
+    (Status.STATUS_POR_FACTURAR, utils.GROUP_ADMINISTRACION):
+        {Status.STATUS_POR_FACTURAR, Status.STATUS_CUENTAS, Status.STATUS_TERMINADO,
+         Status.STATUS_CANCELADO},
+}
+
+
+class StatusTransitionsTest(SimpleTestCase):
+    """Tests the workflow rules used by Work.get_possible_status_ids for every pair of
+    status and group.
+    """
+
+    def test_every_status_and_group(self):
+        for status_id in ALL_STATUS_IDS:
+            for group_name, _ in utils.GROUPS:
+                if group_name == utils.GROUP_SUPERUSUARIO:
+                    expected = ALL_STATUS_IDS
+                else:
+                    expected = EXPECTED_TRANSITIONS.get((status_id, group_name), set())
+                self.assertEqual(expected,
+                                 models.get_possible_status_ids(status_id, [group_name]),
+                                 (status_id, group_name))
+
+    def test_groups_are_combined(self):
+        group_names = [utils.GROUP_DIR_ARTE, utils.GROUP_ADMINISTRACION]
+        self.assertEqual({Status.STATUS_DISENO, Status.STATUS_CUENTAS},
+                         models.get_possible_status_ids(Status.STATUS_DISENO, group_names))
+        self.assertEqual(EXPECTED_TRANSITIONS[(Status.STATUS_POR_COBRAR,
+                                               utils.GROUP_ADMINISTRACION)],
+                         models.get_possible_status_ids(Status.STATUS_POR_COBRAR,
+                                                        group_names))
+
+    def test_no_groups(self):
+        for status_id in ALL_STATUS_IDS:
+            self.assertEqual(set(), models.get_possible_status_ids(status_id, []))
+
+    def test_unknown_group(self):
+        self.assertEqual(set(), models.get_possible_status_ids(Status.STATUS_PENDIENTE,
+                                                               ['Unknown group']))
+
+
+class WorkFixtureMixin(object):
+    """Mixin for TestCase classes that need works, created by create_work for the
+    'Julian Niebieskikiwat' contact of the 'Test Starbucks' client. The contact, the project
+    work type and the design status are created with the first work and shared by the rest.
+    """
+
+    def create_work(self, executive, **kwargs):
+        """Creates a work of the executive, kwargs override the default fields.
+        """
+        if not hasattr(self, 'contact'):
+            client = client_models.Client.objects.create(name='Test Starbucks',
+                                                         address='Felipe Ángeles 225')
+            self.contact = client_models.Contact.objects.create(
+                name='Julian', last_name='Niebieskikiwat', charge='Manager',
+                landline='4471172395', mobile_phone_1='26416231', email='julian@elguandul.com',
+                client=client)
+            self.work_type = models.WorkType.objects.create(
+                work_type_id=models.WorkType.ID_PROJECT)
+            self.status = models.Status.objects.create(status_id=Status.STATUS_DISENO)
+        fields = {
+            'executive': executive,
+            'contact': self.contact,
+            'current_status': self.status,
+            'work_type': self.work_type,
+            'name': 'Work',
+            'expected_delivery_date': datetime.date.today(),
+            'brief': 'Brief',
+        }
+        fields.update(kwargs)
+        return models.Work.objects.create(**fields)
+
+
+class NotificationDispatchTest(WorkFixtureMixin, utils.CommitHooksTestMixin, ChannelTestCase):
+    """Tests that notifications are inserted in bulk and delivered through the
+    notifications channel after the transaction commits.
+    """
+
+    def setUp(self):
+        self.executive = User.objects.create_user(username='executive', password='password')
+        self.designers = [User.objects.create_user(username='designer{}'.format(idx),
+                                                   password='password')
+                          for idx in range(10)]
+        self.work = self.create_work(self.executive)
+        for designer in self.designers:
+            models.WorkDesigner.objects.create(designer=designer, work=self.work)
+        # Only the notifications created by the tests themselves are dispatched.
+        self.clear_commit_hooks()
+
+    def test_work_save_inserts_notifications_once(self):
+        work_change_notifications = models.Notification.objects.filter(
+            notif_type=utils.NOTIF_TYPE_WORK_CHANGE)
+        initial_count = work_change_notifications.count()
+        with CaptureQueriesContext(connection) as context:
+            self.work.name = 'Work edited'
+            self.work.save()
+        notification_inserts = [query for query in context.captured_queries
+                                if query['sql'].startswith('INSERT INTO "works_notification"')]
+        self.assertEqual(1, len(notification_inserts))
+        self.assertEqual(initial_count + 11, work_change_notifications.count())
+
+    def test_notifications_are_sent_after_commit(self):
+        Group('user-{}'.format(self.executive.id)).add('test-executive')
+        self.work.save()
+        self.assertIsNone(self.get_next_message(models.NOTIFICATIONS_CHANNEL))
+
+        self.run_commit_hooks()
+        message = self.get_next_message(models.NOTIFICATIONS_CHANNEL, require=True)
+        self.assertEqual(11, len(message.content['ids']))
+        self.assertIsNone(self.get_next_message('test-executive'))
+
+        consumers.send_notifications(message)
+        sent = json.loads(self.get_next_message('test-executive', require=True)['text'])
+        self.assertEqual('create', sent['operation'])
+        self.assertEqual(sent['id'], sent['data']['id'])
+        self.assertEqual(self.executive.id, sent['data']['user'])
+
+
+class WorkSoftDeleteTest(WorkFixtureMixin, TestCase):
+    """Tests that soft deleting a work soft deletes its art works, files and designers.
+    """
+
+    def test_work_soft_delete_cascade(self):
+        user = User.objects.create_user(username='executive', password='password')
+        works = [self.create_work(user, name='Work {}'.format(idx)) for idx in range(2)]
+        art_type = models.ArtType.objects.create(name='Arte', work_type=self.work_type)
+        for work in works:
+            models.ArtWork.objects.create(work=work, art_type=art_type, quantity=1)
+            models.File.objects.create(work=work, upload='file.pdf', filename='file.pdf')
+            models.WorkDesigner.objects.create(work=work, designer=user)
+
+        works[0].is_active = False
+        works[0].save()
+
+        for related_model in (models.ArtWork, models.File, models.WorkDesigner):
+            self.assertEqual([works[1].id], list(related_model.objects.filter(is_active=True)
+                                                 .values_list('work', flat=True)))
+        self.assertEqual([works[1].id], list(models.WorkDesigner.objects.filter(
+            active_work=True).values_list('work', flat=True)))
+
+
+class NotificationPurgeTest(WorkFixtureMixin, TestCase):
+    """Tests that old seen notifications are deleted in batches and unseen ones are kept.
+    """
+
+    def setUp(self):
+        user = User.objects.create_user(username='executive', password='password')
+        work = self.create_work(user)
+        models.Notification.objects.all().delete()
+        notifications = models.Notification.create_for_users(work, [user.id] * 8,
+                                                             utils.NOTIF_TYPE_WORK_CHANGE)
+        old_date = timezone.now() - datetime.timedelta(days=100)
+        self.old_seen_ids = [notification.id for notification in notifications[:5]]
+        models.Notification.objects.filter(id__in=self.old_seen_ids).update(seen=True,
+                                                                            date=old_date)
+        self.old_unseen_id = notifications[5].id
+        models.Notification.objects.filter(id=self.old_unseen_id).update(date=old_date)
+        models.Notification.objects.filter(id=notifications[6].id).update(seen=True)
+
+    def test_purge_notifications(self):
+        archive = io.StringIO()
+        result = models.purge_notifications(days=90, batch_size=2, archive=archive)
+
+        self.assertEqual(5, result.deleted)
+        self.assertEqual(3, result.batches)
+        self.assertFalse(models.Notification.objects.filter(id__in=self.old_seen_ids).exists())
+        self.assertEqual(3, models.Notification.objects.count())
+        self.assertTrue(models.Notification.objects.filter(id=self.old_unseen_id).exists())
+        archived_ids = [int(line.split(',')[0]) for line in archive.getvalue().splitlines()]
+        self.assertEqual(sorted(self.old_seen_ids), archived_ids)
+
+    def test_purge_notifications_command(self):
+        out = io.StringIO()
+        call_command('purge_notifications', days=90, stdout=out)
+        self.assertIn('Removed 5 notifications in 1 batches', out.getvalue())
+        self.assertEqual(3, models.Notification.objects.count())
+
+
+@skipUnless(connection.vendor == 'postgresql', 'The indexes are PostgreSQL partial indexes')
+class HotPathIndexesTest(TestCase):
+    """Tests that the most frequent queries are answered with the indexes meant for them.
+    The queries are explained with the default planner settings on a dataset big enough,
+    and spread enough, for a sequential scan to be the wrong choice, so the tests fail if
+    the planner stops using the indexes, and not only if they are missing.
+    """
+    NUMBER_OF_USERS = 50
+    NUMBER_OF_CLIENTS = 500
+    NUMBER_OF_CONTACTS = 5000
+    NUMBER_OF_WORKS = 10000
+    NUMBER_OF_NOTIFICATIONS = 20000
+
+    @classmethod
+    def setUpTestData(cls):
+        User.objects.bulk_create([User(username='user{}'.format(idx))
+                                  for idx in range(cls.NUMBER_OF_USERS)])
+        users = list(User.objects.order_by('id'))
+        cls.user = users[0]
+        client_models.Client.objects.bulk_create([
+            client_models.Client(name='Client {}'.format(idx), address='Felipe Ángeles 225')
+            for idx in range(cls.NUMBER_OF_CLIENTS)])
+        clients = list(client_models.Client.objects.order_by('id'))
+        client_models.Contact.objects.bulk_create([client_models.Contact(
+            name='Julian', last_name='Niebieskikiwat', charge='Manager',
+            landline='4471172395', mobile_phone_1='26416231', email='julian@elguandul.com',
+            client=clients[idx % len(clients)]) for idx in range(cls.NUMBER_OF_CONTACTS)])
+        contacts = list(client_models.Contact.objects.order_by('id'))
+        cls.client_obj = contacts[0].client
+        statuses = [models.Status.objects.create(status_id=status_id)
+                    for status_id, _ in Status.STATUS]
+        work_type = models.WorkType.objects.create(work_type_id=models.WorkType.ID_PROJECT)
+        cls.art_type = models.ArtType.objects.create(name='Arte', work_type=work_type)
+        models.Work.objects.bulk_create([models.Work(
+            executive=users[idx % len(users)], contact=contacts[idx % len(contacts)],
+            current_status=statuses[idx % len(statuses)],
+            work_type=work_type, name='Work {}'.format(idx), brief='Brief',
+            creation_date=datetime.date.today(),
+            expected_delivery_date=datetime.date.today() + datetime.timedelta(days=idx % 1000),
+            is_active=idx % 5 != 0) for idx in range(cls.NUMBER_OF_WORKS)])
+        works = list(models.Work.objects.order_by('id'))
+        cls.work = works[1]
+        models.ArtWork.objects.bulk_create([
+            models.ArtWork(work=work, art_type=cls.art_type, quantity=1) for work in works])
+        models.WorkDesigner.objects.bulk_create([
+            models.WorkDesigner(work=work, designer=users[idx % len(users)],
+                                active_work=idx % 20 == 0)
+            for idx, work in enumerate(works)])
+        models.Notification.objects.bulk_create([models.Notification(
+            work=works[idx % len(works)], user=users[idx % len(users)],
+            notif_type=utils.NOTIF_TYPE_WORK_CHANGE, text='Text', date=timezone.now(),
+            seen=idx % 10 != 0) for idx in range(cls.NUMBER_OF_NOTIFICATIONS)])
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def get_index_name(self, model, *column_names):
+        """Returns the name of the index of the model over exactly the given columns.
+        """
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor,
+                                                                   model._meta.db_table)
+        return next(name for name, constraint in constraints.items()
+                    if (constraint['index'] or constraint['primary_key']) and
+                    constraint['columns'] == list(column_names))
+
+    def assertUsesIndex(self, queryset, *index_names):
+        """Asserts that the plan of the queryset uses one of the indexes, and never scans the
+        whole table of the queryset. The small tables it joins may still be scanned.
+        """
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN ' + sql, params)
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+        self.assertNotIn('Seq Scan on {}'.format(queryset.model._meta.db_table), plan)
+        self.assertTrue(any(index_name in plan for index_name in index_names), plan)
+
+    def test_active_works(self):
+        works = models.Work.objects.filter(is_active=True)
+        self.assertUsesIndex(works.order_by('-id')[:50],
+                             self.get_index_name(models.Work, 'id'))
+        self.assertUsesIndex(works.filter(
+            expected_delivery_date__gte=datetime.date.today(),
+            expected_delivery_date__lte=datetime.date.today() + datetime.timedelta(days=7)),
+            'works_work_active_delivery_idx')
+        self.assertUsesIndex(works.filter(current_status__status_id=Status.STATUS_DISENO),
+                             self.get_index_name(models.Work, 'current_status_id'))
+        self.assertUsesIndex(works.filter(contact__client=self.client_obj),
+                             self.get_index_name(models.Work, 'contact_id'))
+
+    def test_notifications(self):
+        notifications = models.Notification.objects.filter(is_active=True, user=self.user)
+        self.assertUsesIndex(notifications.filter(seen=False), 'works_notification_unseen_idx')
+        self.assertUsesIndex(notifications.order_by('-date', '-id')[:50],
+                             'works_notification_active_user_date_idx')
+
+    def test_work_relations(self):
+        self.assertUsesIndex(
+            models.ArtWork.objects.filter(work=self.work, art_type=self.art_type),
+            self.get_index_name(models.ArtWork, 'work_id', 'art_type_id'))
+        self.assertUsesIndex(
+            models.WorkDesigner.objects.filter(work=self.work, designer=self.user,
+                                               active_work=True),
+            self.get_index_name(models.WorkDesigner, 'work_id', 'designer_id', 'active_work'),
+            self.get_index_name(models.WorkDesigner, 'work_id'),
+            'works_workdesigner_active_designer_idx')
+        self.assertUsesIndex(
+            models.WorkDesigner.objects.filter(designer=self.user, active_work=True),
+            'works_workdesigner_active_designer_idx')
+        self.assertUsesIndex(
+            client_models.Contact.objects.filter(client=self.client_obj, is_active=True),
+            'clients_contact_active_client_idx')
+
+
+class ReferenceDataCacheTest(TransactionTestCase):
+    """Tests that the reference data is read from the cache and reloaded when it changes.
+    """
+
+    def tearDown(self):
+        reference_data.cache.invalidate(publish=False)
+
+    def test_cached_rows(self):
+        status = models.Status.objects.create(status_id=Status.STATUS_DISENO)
+        self.assertEqual([status], reference_data.cache.all(models.Status))
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(status, reference_data.cache.get(models.Status, status.id))
+            reference_data.cache.all(models.WorkType)
+        self.assertEqual(0, len(context.captured_queries))
+
+        status.status_id = Status.STATUS_CUENTAS
+        status.save()
+        self.assertEqual(Status.STATUS_CUENTAS,
+                         reference_data.cache.get(models.Status, status.id).status_id)
+
+    def test_transaction_changes(self):
+        status = models.Status.objects.create(status_id=Status.STATUS_DISENO)
+        reference_data.cache.all(models.Status)
+        with transaction.atomic():
+            new_status = models.Status.objects.create(status_id=Status.STATUS_CUENTAS)
+            self.assertEqual([status, new_status], reference_data.cache.all(models.Status))
+            transaction.set_rollback(True)
+        self.assertEqual([status], reference_data.cache.all(models.Status))
+
+        with transaction.atomic():
+            new_status = models.Status.objects.create(status_id=Status.STATUS_CUENTAS)
+        self.assertEqual([status, new_status], reference_data.cache.all(models.Status))
+
+    def test_digest(self):
+        """Test that the digest is computed when the rows are loaded and changes with them.
+        """
+        status = models.Status.objects.create(status_id=Status.STATUS_DISENO)
+        digest = reference_data.cache.get_digest()
+        self.assertEqual(digest, reference_data.cache.digest)
+        self.assertEqual(digest, reference_data.cache.get_digest())
+
+        status.status_id = Status.STATUS_CUENTAS
+        status.save()
+        self.assertIsNone(reference_data.cache.data)
+        self.assertNotEqual(digest, reference_data.cache.get_digest())
+
+    @override_settings(REFERENCE_DATA_REDIS_HOST='redis.invalid')
+    def test_redis_failure_backoff(self):
+        """Test that Redis isn't tried again for a while after it fails.
+        """
+        cache = reference_data.ReferenceDataCache()
+        self.assertIsNotNone(cache.get_redis())
+        self.assertIs(cache.get_redis(), cache.get_redis())
+        cache.publish()
+        self.assertIsNone(cache.get_redis())
+        cache.redis_retry_at = 0
+        self.assertIsNotNone(cache.get_redis())
+
+    def test_rolled_back_savepoints(self):
+        status = models.Status.objects.create(status_id=Status.STATUS_DISENO)
+        with transaction.atomic():
+            status.status_id = Status.STATUS_CUENTAS
+            status.save()
+            with transaction.atomic():
+                models.Status.objects.create(status_id=Status.STATUS_VALIDACION)
+                self.assertEqual(2, len(reference_data.cache.all(models.Status)))
+                transaction.set_rollback(True)
+            self.assertEqual([status], reference_data.cache.all(models.Status))
+        self.assertEqual(Status.STATUS_CUENTAS,
+                         reference_data.cache.get(models.Status, status.id).status_id)
@@ -6,13 +6,14 @@ from rest_framework.response import Response
 from rest_framework import status
 from rest_framework import serializers as serializers_library
 from django.db import transaction
-from django.http import HttpResponse
+from django.db.models import Prefetch, Q, Sum
+from django.http import StreamingHttpResponse
 from django.utils import timezone
 from django.http import Http404
 
 from . import models, serializers
 from . import filters as works_filters
-from balarco import utils
+from balarco import reference_data, utils
 
 
 class WorkTypeViewSet(utils.GenericViewSet):
@@ -33,6 +34,77 @@ class ArtTypeViewSet(utils.GenericViewSet):
     filter_class = works_filters.ArtTypeFilter
 
 
+REPORT_CHUNK_SIZE = 500
+
+
+class Echo(object):
+    """File-like object that returns what is written to it instead of storing it, so the
+    rows of a csv.writer can be streamed.
+    """
+
+    def write(self, value):
+        return value
+
+
+def report_rows(iguala):
+    """Generates the rows of the CSV report of an iguala.
+    The quantities used of each art type are added up by the database and the works are
+    read in chunks of REPORT_CHUNK_SIZE, so the memory used does not depend on the size of
+    the iguala.
+
+    Parameters
+    ----------
+    iguala: Iguala
+        The iguala of the report
+
+    Returns
+    -------
+    generator
+        The rows of the report as lists of values
+    """
+    works = models.Work.objects.filter(is_active=True, iguala=iguala)
+
+    yield [iguala.name, timezone.now().strftime('%d-%m-%Y %H:%M')]
+    yield []
+    yield []
+
+    art_works_count = dict(models.ArtWork.objects.filter(work__in=works)
+                           .values_list('art_type')
+                           .annotate(used=Sum('quantity'))
+                           .order_by())
+
+    yield ['Tipo de arte', 'Contratadas', 'Usadas', 'Restantes']
+
+    for art_iguala in iguala.art_iguala.select_related('art_type').order_by('id'):
+        agreed = art_iguala.quantity
+        used = art_works_count.get(art_iguala.art_type_id, 0)
+        yield [art_iguala.art_type.name, agreed, used, agreed - used]
+
+    yield []
+    yield []
+    yield ['Trabajos relacionados con la iguala']
+
+    works = works.select_related('contact__client', 'current_status').prefetch_related(
+        Prefetch('art_works', queryset=models.ArtWork.objects.select_related('art_type')))
+    last_id = 0
+    while True:
+        chunk = list(works.filter(id__gt=last_id).order_by('id')[:REPORT_CHUNK_SIZE])
+        if not chunk:
+            break
+        for work in chunk:
+            yield []
+            yield []
+            yield ['Trabajo', 'Contacto', 'Empresa', 'Fecha entrada', 'Status actual']
+            contact_name = '{} {}'.format(work.contact.name, work.contact.last_name)
+            yield [work.name, contact_name, work.contact.client.name,
+                   work.creation_date.strftime('%d-%m-%Y'), str(work.current_status)]
+            yield []
+            yield ['', 'Tipo de arte', 'Cantidad']
+            for art_work in work.art_works.all():
+                yield ['', art_work.art_type.name, art_work.quantity]
+        last_id = chunk[-1].id
+
+
 class IgualaViewSet(utils.GenericViewSet):
     """ViewSet for Iguala CRUD REST Service that inherits from utils.GenericViewSet
     """
@@ -40,6 +112,7 @@ class IgualaViewSet(utils.GenericViewSet):
     queryset = models.Iguala.objects.filter(is_active=True)
     serializer_class = serializers.IgualaSerializer
     filter_class = works_filters.IgualaFilter
+    last_modified_fields = ('updated_at', 'client__updated_at')
 
     def destroy(self, request, pk=None):
         """Override of destroy method, with raises an exception when the selected
@@ -49,14 +122,14 @@ class IgualaViewSet(utils.GenericViewSet):
         obj = get_object_or_404(queryset, pk=pk)
         work_queryset = models.Work.objects.filter(iguala=obj)
         error_message = 'Antes de eliminar la iguala, reasigna todos los proyectos'
-        if work_queryset.count() > 0:
+        if work_queryset.exists():
             raise serializers_library.ValidationError(error_message)
         else:
             obj.is_active = False
             try:
                 obj.save()
-                serializer = self.serializer_class(queryset, many=True)
-                return Response(serializer.data, status.HTTP_200_OK)
+                return utils.soft_delete_response(request, self.serializer_class, queryset,
+                                                  obj)
             except:
                 return Http404('No se pudo borrar la iguala en este momento')
 
@@ -94,27 +167,12 @@ class IgualaViewSet(utils.GenericViewSet):
         if serializer.is_valid():
             updated_obj = serializer.save()
             if 'art_iguala' in request.data:
-                art_igualas = request.data['art_iguala']
-                for art_iguala in art_igualas:
-                    art_iguala['iguala'] = updated_obj.id
-                    art_type_id = art_iguala['art_type']
-                    try:
-                        update_art_iguala_obj = models.ArtIguala.objects.get(iguala=updated_obj.id,
-                                                                             art_type=art_type_id)
-                    except models.ArtIguala.DoesNotExist:
-                        update_art_iguala_obj = None
-                    if update_art_iguala_obj is not None:
-                        if not utils.update_object_from_data(serializers.ArtIgualaSerializer,
-                                                             update_art_iguala_obj,
-                                                             art_iguala):
-                            transaction.savepoint_rollback(sid)
-                            return utils.response_object_could_not_be_created(self.obj_class)
-                    else:
-                        if not utils.save_object_from_data(models.ArtIguala,
-                                                           serializers.ArtIgualaSerializer,
-                                                           art_iguala):
-                            transaction.savepoint_rollback(sid)
-                            return utils.response_object_could_not_be_created(self.obj_class)
+                changes = utils.upsert_children(updated_obj, 'art_iguala', ('art_type',),
+                                                serializers.ArtIgualaSerializer,
+                                                request.data['art_iguala'])
+                if changes is None:
+                    transaction.savepoint_rollback(sid)
+                    return utils.response_object_could_not_be_created(self.obj_class)
 
             return Response(self.serializer_class(updated_obj).data, status.HTTP_200_OK)
 
@@ -126,65 +184,17 @@ class IgualaViewSet(utils.GenericViewSet):
 
     @detail_route(methods=['get'], url_path='report')
     def report(self, request, pk=None):
+        """Streams a CSV with the art types contracted and used in the iguala, followed by
+        the works related with it.
+        """
         queryset = models.Iguala.objects.filter(is_active=True)
         iguala = get_object_or_404(queryset, pk=pk)
-        response = HttpResponse(content_type='text/csv')
+        writer = csv.writer(Echo())
+        response = StreamingHttpResponse((writer.writerow(row) for row in report_rows(iguala)),
+                                         content_type='text/csv')
         str_now = timezone.now().strftime('%d-%m-%Y %H-%M')
         response['Content-Disposition'] = 'attachment; filename="{}-{}.csv"'.format(iguala.name,
                                                                                     str_now)
-
-        works = models.Work.objects.filter(is_active=True, iguala=iguala)
-        writer = csv.writer(response)
-
-        writer.writerow([iguala.name, timezone.now().strftime('%d-%m-%Y %H:%M')])
-        writer.writerow([])
-        writer.writerow([])
-
-        art_works_count = {}
-        for work in works:
-            for art_work in work.art_works.all():
-                art_type_id = art_work.art_type.id
-                if art_type_id in art_works_count:
-                    art_works_count[art_type_id] += art_work.quantity
-                else:
-                    art_works_count[art_type_id] = art_work.quantity
-
-        writer.writerow(['Tipo de arte', 'Contratadas', 'Usadas', 'Restantes'])
-
-        for art_iguala in iguala.art_iguala.all():
-            art_type_id = art_iguala.art_type.id
-            art_type_name = art_iguala.art_type.name
-            agreed = art_iguala.quantity
-            if art_type_id in art_works_count:
-                used = art_works_count[art_type_id]
-                remaining = agreed - used
-                writer.writerow([art_type_name, agreed, used, remaining])
-            else:
-                used = 0
-                remaining = agreed - used
-                writer.writerow([art_type_name, agreed, used, remaining])
-
-        writer.writerow([])
-        writer.writerow([])
-        writer.writerow(['Trabajos relacionados con la iguala'])
-
-        for work in works:
-            writer.writerow([])
-            writer.writerow([])
-            writer.writerow(['Trabajo', 'Contacto', 'Empresa', 'Fecha entrada', 'Status actual'])
-            work_name = work.name
-            contact_name = '{} {}'.format(work.contact.name, work.contact.last_name)
-            client_name = work.contact.client.name
-            creation_date = work.creation_date.strftime('%d-%m-%Y')
-            current_status = work.current_status.__str__()
-            writer.writerow([work_name, contact_name, client_name, creation_date, current_status])
-            writer.writerow([])
-            writer.writerow(['', 'Tipo de arte', 'Cantidad'])
-            for art_work in work.art_works.all():
-                art_type_name = art_work.art_type.name
-                quantity = art_work.quantity
-                writer.writerow(['', art_type_name, quantity])
-
         return response
 
 
@@ -213,36 +223,39 @@ class WorkViewSet(utils.GenericViewSet):
     queryset = models.Work.objects.filter(is_active=True)
     serializer_class = serializers.WorkSerializer
     filter_class = works_filters.WorkFilter
+    last_modified_fields = ('updated_at', 'contact__updated_at', 'contact__client__updated_at',
+                            'iguala__updated_at', 'iguala__client__updated_at')
 
     @list_route(methods=['get'], url_path='my_assignments')
     def my_assignments(self, request):
+        """Works the user is actively assigned to as designer or manages as executive, plus
+        the works waiting to be charged or invoiced for the Administración group.
+        Everything is resolved with a single query, the subquery keeps each work once.
+        """
         user = request.user
-        asigned_works = user.asigned_works.filter(active_work=True)
-        managed_works = user.managed_works.filter(is_active=True)
-        works = set()
-        for asigned_work in asigned_works:
-            works.add(asigned_work.work)
-        for managed_work in managed_works:
-            works.add(managed_work)
-        if user.groups.filter(name=utils.GROUP_ADMINISTRACION).exists():
-            admin_works = models.Work.objects.filter(is_active=True,
-                                                     current_status__status_id__range=(5, 6))
-            for admin_work in admin_works:
-                works.add(admin_work)
-        serializer = serializers.WorkSerializer(works, many=True)
-        return Response(serializer.data, status.HTTP_200_OK)
+        active_assignments = models.WorkDesigner.objects.filter(designer=user,
+                                                                active_work=True).values('work')
+        assignments_filter = Q(id__in=active_assignments) | Q(executive=user)
+        if utils.GROUP_ADMINISTRACION in utils.get_request_group_names(request):
+            assignments_filter |= Q(current_status__status_id__in=(
+                models.Status.STATUS_POR_COBRAR, models.Status.STATUS_POR_FACTURAR))
+        queryset = self.get_queryset().filter(assignments_filter).order_by('-id')
+        return self.list_response(queryset)
 
     @list_route(methods=['get'], url_path='unassigned_works')
     def unassigned_works(self, request):
-        works = models.Work.objects.filter(is_active=True)
-        unassigned_works = set()
-        for work in works:
-            work_designers = work.work_designers.filter(active_work=True)
-            current_status_id = work.current_status.status_id
-            if current_status_id == models.Status.STATUS_DISENO and len(work_designers) == 0:
-                unassigned_works.add(work)
-        serializer = serializers.WorkSerializer(unassigned_works, many=True)
-        return Response(serializer.data, status.HTTP_200_OK)
+        """Works in design that have no active designer, resolved in a single query.
+        The design statuses are taken from the reference data cache and matched by primary
+        key, so the works are found through the index of current_status instead of joining
+        and scanning every work.
+        """
+        design_status_ids = [status.id for status in reference_data.cache.all(models.Status)
+                             if status.status_id == models.Status.STATUS_DISENO]
+        active_assignments = models.WorkDesigner.objects.filter(active_work=True).values('work')
+        queryset = self.get_queryset().filter(
+            current_status_id__in=design_status_ids
+        ).exclude(id__in=active_assignments)
+        return self.list_response(queryset)
 
     @detail_route(methods=['get'], url_path='possible-status-changes')
     def possible_status_changes(self, request, pk=None):
@@ -252,6 +265,63 @@ class WorkViewSet(utils.GenericViewSet):
         serializer = serializers.StatusSerializer(possible_status_changes, many=True)
         return Response(serializer.data, status.HTTP_200_OK)
 
+    @list_route(methods=['get'], url_path='batch-possible-status-changes')
+    def batch_possible_status_changes(self, request):
+        """Possible status changes of many works in a single response.
+        The works are the ones in the ?ids= query param (e.g. ?ids=1,2,3) or, when it's not
+        given, the ones matched by WorkFilter. It costs one query for the works and one for
+        the user groups, the statuses come from the reference data cache.
+        """
+        queryset = self.filter_queryset(models.Work.objects.filter(is_active=True))
+        if 'ids' in request.query_params:
+            try:
+                ids = [int(work_id)
+                       for work_id in utils.parse_query_list(request.query_params['ids'])]
+            except ValueError:
+                raise serializers_library.ValidationError('ids must be a list of integers')
+            queryset = queryset.filter(id__in=ids)
+
+        group_names = utils.get_request_group_names(request)
+        possible_status_ids = {
+            work_id: models.get_possible_status_ids(status_id, group_names)
+            for work_id, status_id in queryset.values_list('id', 'current_status__status_id')
+        }
+
+        serialized_statuses = {}
+        all_status_ids = set().union(*possible_status_ids.values())
+        for status_obj in reference_data.cache.all(models.Status):
+            if status_obj.status_id not in all_status_ids:
+                continue
+            serialized_statuses.setdefault(status_obj.status_id, []).append(
+                serializers.StatusSerializer(status_obj).data)
+
+        data = []
+        for work_id in sorted(possible_status_ids):
+            changes = []
+            for status_id in sorted(possible_status_ids[work_id]):
+                changes += serialized_statuses.get(status_id, [])
+            data.append({'work': work_id, 'possible_status_changes': changes})
+        return Response(data, status.HTTP_200_OK)
+
+    @list_route(methods=['post'], url_path='bulk')
+    def bulk_create(self, request):
+        """Creates the works of a list, each one with the same data as create() plus its
+        art_works and work_designers, e.g.
+        [{'name': ..., 'art_works': [{'art_type': 1, 'quantity': 2}],
+          'work_designers': [{'designer': 3, 'active_work': true}]}, ...]
+        Every work is validated before inserting anything, and none is created if any of
+        them is invalid; the errors are returned in a list with an item for each work, empty
+        for the valid ones. The rows are inserted with a few queries no matter how many
+        works there are, see Work.create_many.
+        """
+        serializer = serializers.WorkBulkCreateSerializer(data=request.data, many=True)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status.HTTP_400_BAD_REQUEST)
+        works = models.Work.create_many(serializer.validated_data, request.user)
+        queryset = self.get_queryset().filter(id__in=[work.id for work in works]).order_by('id')
+        return Response(self.serializer_class(queryset, many=True).data,
+                        status.HTTP_201_CREATED)
+
     def create(self, request):
         sid = transaction.savepoint()
         serializer = self.serializer_class(data=request.data)
@@ -296,63 +366,32 @@ class WorkViewSet(utils.GenericViewSet):
         if serializer.is_valid():
             status_has_changed = False
             if 'current_status' in request.data:
-                status_has_changed = request.data['current_status'] != obj.current_status.id
+                status_has_changed = request.data['current_status'] != obj.current_status_id
             updated_obj = serializer.save()
             if 'art_works' in request.data:
-                art_works = request.data['art_works']
-                for art_work in art_works:
-                    art_work['work'] = updated_obj.id
-                    art_type_id = art_work['art_type']
-                    try:
-                        update_art_work_obj = models.ArtWork.objects.get(work=updated_obj.id,
-                                                                         art_type=art_type_id)
-                    except models.ArtWork.DoesNotExist:
-                        update_art_work_obj = None
-                    if update_art_work_obj is not None:
-                        if not utils.update_object_from_data(serializers.ArtWorkSerializer,
-                                                             update_art_work_obj,
-                                                             art_work):
-                            transaction.savepoint_rollback(sid)
-                            return utils.response_object_could_not_be_created(self.obj_class)
-                    else:
-                        if not utils.save_object_from_data(models.ArtWork,
-                                                           serializers.ArtWorkSerializer,
-                                                           art_work):
-                            transaction.savepoint_rollback(sid)
-                            return utils.response_object_could_not_be_created(self.obj_class)
+                changes = utils.upsert_children(updated_obj, 'art_works', ('art_type',),
+                                                serializers.ArtWorkSerializer,
+                                                request.data['art_works'])
+                if changes is None:
+                    transaction.savepoint_rollback(sid)
+                    return utils.response_object_could_not_be_created(self.obj_class)
 
             for filename, file in request.FILES.items():
                 name = request.FILES[filename].name
                 models.File.objects.create(work=updated_obj, filename=name, upload=file)
 
             if 'work_designers' in request.data and \
-               updated_obj.current_status.status_id == models.Status.STATUS_DISENO:
-                work_designers = request.data['work_designers']
-                for work_designer in work_designers:
-                    work_designer['work'] = updated_obj.id
-                    designer_id = work_designer['designer']
-                    active_work = work_designer['active_work']
-                    try:
-                        update_work_designer = \
-                            models.WorkDesigner.objects.get(work=updated_obj.id,
-                                                            designer=designer_id,
-                                                            active_work=True)
-                    except models.WorkDesigner.DoesNotExist:
-                        update_work_designer = None
-
-                    if update_work_designer is not None:
-                        if not utils.update_object_from_data(serializers.WorkDesignerSerializer,
-                                                             update_work_designer,
-                                                             work_designer):
-                            transaction.savepoint_rollback(sid)
-                            return utils.response_object_could_not_be_created(self.obj_class)
-                    else:
-                        if active_work:
-                            if not utils.save_object_from_data(models.WorkDesigner,
-                                                               serializers.WorkDesignerSerializer,
-                                                               work_designer):
-                                transaction.savepoint_rollback(sid)
-                                return utils.response_object_could_not_be_created(self.obj_class)
+               updated_obj.get_current_status().status_id == models.Status.STATUS_DISENO:
+                changes = utils.upsert_children(
+                    updated_obj, 'work_designers', ('designer',),
+                    serializers.WorkDesignerSerializer, request.data['work_designers'],
+                    existing_filter={'active_work': True},
+                    create_if=lambda data: data.get('active_work', True),
+                    before_save=models.WorkDesigner.prepare_save)
+                if changes is None:
+                    transaction.savepoint_rollback(sid)
+                    return utils.response_object_could_not_be_created(self.obj_class)
+                models.WorkDesigner.notify_designers(changes.created + changes.updated)
 
             if status_has_changed:
                 models.StatusChange.objects.create(work=updated_obj,
@@ -410,15 +449,28 @@ class NotificationViewSet(utils.GenericViewSet):
     queryset = models.Notification.objects.filter(is_active=True)
     serializer_class = serializers.NotificationSerializer
     filter_class = works_filters.NotificationFilter
+    cursor_ordering = ('-date', '-id')
 
     @list_route(methods=['get'], url_path='read_all')
     def read_all(self, request):
-        user = request.user
-        unseen_notifications = models.Notification.objects.filter(user=user, seen=False)
-        for notification in unseen_notifications:
-            notification.seen = True
-            notification.save()
-        return self.unseen_notifications(request)
+        updated = models.Notification.mark_seen(request.user)
+        return Response({'updated': updated}, status.HTTP_200_OK)
+
+    @list_route(methods=['post'], url_path='mark_seen')
+    def mark_seen(self, request):
+        """Marks as seen the notifications of the user with the given ids, or every
+        notification created up to the given date.
+        """
+        serializer = serializers.NotificationMarkSeenSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status.HTTP_400_BAD_REQUEST)
+        updated = models.Notification.mark_seen(request.user, **serializer.validated_data)
+        return Response({'updated': updated}, status.HTTP_200_OK)
+
+    @list_route(methods=['get'], url_path='unread_count')
+    def unread_count(self, request):
+        count = models.UnreadNotificationCounter.get_counts([request.user.id])[request.user.id]
+        return Response({'unread_count': count}, status.HTTP_200_OK)
 
     @list_route(methods=['get'], url_path='unseen_notifications')
     def unseen_notifications(self, request):